@@ -1,9 +1,8 @@
+import argparse
+
 import numpy as np
 import pandas as pd
 
-# Reproducible RNG
-rng = np.random.default_rng(42)
-
 # --- config ---
 universities = ["UC Berkeley", "Stanford", "UCLA", "UC San Diego", "San Jose State"]
 n_per_uni = 100  # exactly 100 per university
@@ -34,55 +33,100 @@ exp_within_sd  = 1.5    # per-student spread
 uni_intercept_sd = 15_000
 salary_noise_sd  = 15_000
 
-rows = []
-for u in universities:
-    N = n_per_uni
-
-    # Per-university parameters (jittered)
-    mu_gpa_u = np.clip(rng.normal(gpa_targets[u], gpa_between_sd), 2.5, 4.0)
-    mu_exp_u = np.clip(rng.normal(work_exp_targets[u], exp_between_sd), 0, 20)
-
-    # Predictors
-    gpa = np.clip(rng.normal(mu_gpa_u, gpa_within_sd, N), 2.5, 4.0)
-    work_exp = np.clip(rng.normal(mu_exp_u, exp_within_sd, N), 0, 20).round()
-
-    # Skills (must be <= work_exp)
-    yrs_py  = np.array([rng.integers(0, int(w) + 1) for w in work_exp])
-    yrs_sql = np.array([rng.integers(0, int(w) + 1) for w in work_exp])
-
-    # ---- Salary: signal + uni random intercept + noise, bounded [85k, 300k]
-    uni_eff = rng.normal(0, uni_intercept_sd)
-    signal = (
-        110_000
-        + 35_000 * (gpa - 3.0)
-        + 4_000  * work_exp           # strong positive linear effect
-        + 10_000 * np.log1p(work_exp) # gentle diminishing returns
-        + 1_500  * yrs_py
-        + 1_000  * yrs_sql
-        + uni_eff
-    )
-    salary = np.clip(signal + rng.normal(0, salary_noise_sd, N), 85_000, 300_000).round().astype(int)
-
-    rows.append(pd.DataFrame({
-        "masters_university": u,
-        "masters_gpa": np.round(gpa, 2),
-        "relevant_work_years": work_exp.astype(int),
-        "years_python": yrs_py.astype(int),
-        "years_sql": yrs_sql.astype(int),
-        "first_job_salary": salary
-    }))
-
-df = pd.concat(rows, ignore_index=True)
-
-# Sanity checks
-assert (df["masters_gpa"].between(2.5, 4.0)).all()
-assert (df["relevant_work_years"].between(0, 20)).all()
-assert ((df["years_python"] <= df["relevant_work_years"]) & (df["years_python"].between(0, 20))).all()
-assert ((df["years_sql"]    <= df["relevant_work_years"]) & (df["years_sql"].between(0, 20))).all()
-assert (df["first_job_salary"].between(85_000, 300_000)).all()
-
-# Save + quick peek at university means
-df.to_csv("masters_salary.csv", index=False)
-print("Saved: masters_salary.csv")
-print(df.groupby("masters_university")[["masters_gpa","relevant_work_years","years_python","years_sql","first_job_salary"]]
-      .mean().round(2))
+# Cohort knobs (only used with --cohorts): a market effect per graduation
+# year shared by every school (crossed with university) plus a school-by-year
+# effect (cohort nested within university)
+cohort_sd = 8_000
+uni_cohort_sd = 4_000
+last_cohort = 2024
+
+
+def generate(n_per_uni=n_per_uni, cohorts=0, seed=42, uni_intercept_sd=uni_intercept_sd,
+             salary_noise_sd=salary_noise_sd, gpa_targets=gpa_targets, work_exp_targets=work_exp_targets,
+             gpa_within_sd=gpa_within_sd, exp_within_sd=exp_within_sd):
+    # Reproducible RNG; cohorts draw from their own stream so the default
+    # dataset is unchanged when they're off. seed may also be a SeedSequence
+    # (e.g. one of many spawned for a simulation study).
+    rng = np.random.default_rng(seed)
+    if isinstance(seed, np.random.SeedSequence):
+        cohort_rng = np.random.default_rng(np.random.SeedSequence(seed.entropy, spawn_key=(*seed.spawn_key, 1)))
+    else:
+        cohort_rng = np.random.default_rng([seed, 1])
+    cohort_years = np.arange(last_cohort - cohorts + 1, last_cohort + 1)
+    cohort_eff = cohort_rng.normal(0, cohort_sd, cohorts)
+
+    rows = []
+    for u in universities:
+        N = n_per_uni
+
+        # Per-university parameters (jittered)
+        mu_gpa_u = np.clip(rng.normal(gpa_targets[u], gpa_between_sd), 2.5, 4.0)
+        mu_exp_u = np.clip(rng.normal(work_exp_targets[u], exp_between_sd), 0, 20)
+
+        # Predictors
+        gpa = np.clip(rng.normal(mu_gpa_u, gpa_within_sd, N), 2.5, 4.0)
+        work_exp = np.clip(rng.normal(mu_exp_u, exp_within_sd, N), 0, 20).round()
+
+        # Skills (must be <= work_exp)
+        yrs_py  = np.array([rng.integers(0, int(w) + 1) for w in work_exp])
+        yrs_sql = np.array([rng.integers(0, int(w) + 1) for w in work_exp])
+
+        # ---- Cohort: year effect + school-by-year effect
+        cohort_shift = np.zeros(N)
+        if cohorts:
+            cohort_idx = cohort_rng.integers(0, cohorts, N)
+            uni_cohort_eff = cohort_rng.normal(0, uni_cohort_sd, cohorts)
+            cohort_shift = cohort_eff[cohort_idx] + uni_cohort_eff[cohort_idx]
+
+        # ---- Salary: signal + uni random intercept + noise, bounded [85k, 300k]
+        uni_eff = rng.normal(0, uni_intercept_sd)
+        signal = (
+            110_000
+            + 35_000 * (gpa - 3.0)
+            + 4_000  * work_exp           # strong positive linear effect
+            + 10_000 * np.log1p(work_exp) # gentle diminishing returns
+            + 1_500  * yrs_py
+            + 1_000  * yrs_sql
+            + uni_eff
+        )
+        salary = np.clip(signal + rng.normal(0, salary_noise_sd, N) + cohort_shift, 85_000, 300_000).round().astype(int)
+
+        frame = pd.DataFrame({
+            "masters_university": u,
+            "masters_gpa": np.round(gpa, 2),
+            "relevant_work_years": work_exp.astype(int),
+            "years_python": yrs_py.astype(int),
+            "years_sql": yrs_sql.astype(int),
+            "first_job_salary": salary
+        })
+        if cohorts:
+            frame.insert(1, "graduation_cohort", cohort_years[cohort_idx])
+        rows.append(frame)
+
+    df = pd.concat(rows, ignore_index=True)
+
+    # Sanity checks
+    assert (df["masters_gpa"].between(2.5, 4.0)).all()
+    assert (df["relevant_work_years"].between(0, 20)).all()
+    assert ((df["years_python"] <= df["relevant_work_years"]) & (df["years_python"].between(0, 20))).all()
+    assert ((df["years_sql"]    <= df["relevant_work_years"]) & (df["years_sql"].between(0, 20))).all()
+    assert (df["first_job_salary"].between(85_000, 300_000)).all()
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the master's graduate salary dataset.")
+    parser.add_argument("--n-per-uni", type=int, default=n_per_uni, help="graduates per university")
+    parser.add_argument("--cohorts", type=int, default=0,
+                        help="add a graduation_cohort column with this many years (0 = none)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="masters_salary.csv")
+    args = parser.parse_args()
+
+    df = generate(args.n_per_uni, args.cohorts, args.seed)
+
+    # Save + quick peek at university means
+    df.to_csv(args.out, index=False)
+    print(f"Saved: {args.out}")
+    print(df.groupby("masters_university")[["masters_gpa","relevant_work_years","years_python","years_sql","first_job_salary"]]
+          .mean().round(2))
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Predictors are small integers and GPA has two decimals, so a big cohort is
+# mostly repeats of the same (university, predictors) pattern. compress()
+# turns each pattern into one record with its count, sum(y) and sum(y^2);
+# those are sufficient for every cross-product a linear or linear mixed model
+# needs, so the fits below are exact while their cost depends on the number
+# of patterns, not graduates.
+
+GROUP = "masters_university"
+ENDOG = "first_job_salary"
+# Fit from records only when they are at most this fraction of the rows;
+# otherwise compressing saves too little to bother.
+MAX_RATIO = float(os.environ.get("COMPRESS_MAX_RATIO", 0.5))
+
+
+def compress(data, columns, group=GROUP, endog=ENDOG):
+    # data may itself be records (it has a count column), e.g. the full
+    # model's records collapsed again onto one predictor. Returns the records
+    # and, for every row of data, the index of its record.
+    keys = [group, *columns]
+    if "count" in data:
+        sums = data[["count", "sum_y", "sum_y2"]]
+    else:
+        y = data[endog].to_numpy(dtype=float)
+        sums = pd.DataFrame({"count": 1, "sum_y": y, "sum_y2": y * y}, index=data.index)
+    codes = data.groupby(keys, sort=True, observed=True).ngroup().to_numpy()
+    records = sums.groupby(codes).sum()
+    first = pd.Series(np.arange(len(data))).groupby(codes).first().to_numpy()
+    records.insert(0, group, data[group].to_numpy()[first])
+    for i, col in enumerate(columns, start=1):
+        records.insert(i, col, data[col].to_numpy()[first])
+    records[endog] = records["sum_y"] / records["count"]
+    return records.reset_index(drop=True), codes
+
+
+def worth_compressing(data, columns, group=GROUP):
+    patterns = len(data.drop_duplicates([group, *columns]))
+    return patterns <= MAX_RATIO * len(data)
+
+
+def fit_ols(records, columns, endog=ENDOG):
+    # Weighted normal equations; identical to OLS on the rows
+    X = np.column_stack([np.ones(len(records))] + [records[c].to_numpy(dtype=float) for c in columns])
+    w = records["count"].to_numpy(dtype=float)
+    xtx = X.T @ (X * w[:, None])
+    xty = X.T @ records["sum_y"].to_numpy(dtype=float)
+    params = np.linalg.solve(xtx, xty)
+    n, p = w.sum(), X.shape[1]
+    rss = records["sum_y2"].sum() - params @ xty
+    scale = rss / (n - p)
+    names = ["Intercept", *columns]
+    return {
+        "params": pd.Series(params, index=names),
+        "bse": pd.Series(np.sqrt(np.diag(scale * np.linalg.inv(xtx))), index=names),
+        "scale": float(scale),
+        "nobs": int(n),
+        "fittedvalues": X @ params,
+    }
+
+
+class GroupedFit:
+    # The parts of MixedLMResults the figure builders and the store read,
+    # for fits that don't come from statsmodels.
+
+    def __init__(self, fe_params, cov_re, scale, random_effects, fittedvalues, fixedvalues, endog, fit_history,
+                 converged=True, reml=False, llf=None):
+        self.fe_params = fe_params
+        self.cov_re = cov_re
+        self.scale = scale
+        self.random_effects = random_effects
+        self.fittedvalues = fittedvalues
+        self.resid = endog - fittedvalues
+        self._fixedvalues = fixedvalues
+        self.fit_history = fit_history
+        self.fit_seconds = sum(entry["seconds"] for entry in fit_history)
+        self.converged = converged
+        self.reml = reml
+        self.llf = llf
+
+    def predict(self):
+        # Like MixedLMResults.predict(): the fixed effects part only
+        return self._fixedvalues
+
+
+def records_model(records, fixed, reml=True, group=GROUP, endog=ENDOG):
+    # Random intercept and a random slope for every fixed effect (the slope
+    # models and the full model in graphs.py), as a Models/sparse_lmm.py
+    # model of the records
+    from Models.sparse_lmm import SparseMixedLM
+
+    terms = " + ".join(fixed)
+    return SparseMixedLM(f"{endog} ~ {terms}", records, f"({terms} | {group})", reml=reml,
+                         weights=records["count"].to_numpy(), yty=records["sum_y2"].sum())
+
+
+def fit_best(model, data, fixed, group=GROUP, endog=ENDOG, name=None, fields=None):
+    # From the default start L-BFGS-B sometimes stops on a variance boundary
+    # short of the optimum; starting from the moment estimates of data
+    # (Cholesky factor of Delta / s2) doesn't, so fit from both and keep the
+    # better.
+    from Models.fitting import fit_sparse
+    from Models.moments import fit_moments
+
+    moments = fit_moments(data, fixed, group, endog)
+    relative = np.asarray(moments.cov_re) / moments.scale
+    ridge = np.diag(np.maximum(np.diag(relative), 1e-12)) * 1e-6
+    start = np.linalg.cholesky(relative + ridge)[np.tril_indices(len(relative))]
+    return fit_sparse(model, name=name or "records", starts=(None, start), fields=fields)
+
+
+def fit_records(data, fixed, name=None, reml=True, records=None, group=GROUP, endog=ENDOG):
+    # Fitted on the records of data. records=(records, row index) reuses an
+    # earlier compress() of data, collapsing it further when it has more
+    # columns.
+    if records is None:
+        records, inverse = compress(data, fixed, group, endog)
+    else:
+        records, inverse = records
+        if [c for c in records.columns if c not in (group, endog, "count", "sum_y", "sum_y2")] != list(fixed):
+            records, again = compress(records, fixed, group, endog)
+            inverse = again[inverse]
+    model = records_model(records, fixed, reml, group, endog)
+    result = fit_best(model, data, fixed, group, endog, name=name,
+                      fields={"rows": model.n, "patterns": len(records)})
+    term = model.terms[0]
+
+    X = model.X[inverse]
+    fixedvalues = X @ result.fe_params.to_numpy()
+    fittedvalues = np.asarray(result.fittedvalues)[inverse]
+    effects = result.random_effects[term.name]
+    return GroupedFit(
+        fe_params=result.fe_params,
+        cov_re=result.cov_re[term.name],
+        scale=float(result.scale),
+        random_effects={label: effects.loc[label] for label in effects.index},
+        fittedvalues=fittedvalues,
+        fixedvalues=fixedvalues,
+        endog=data[endog].to_numpy(dtype=float),
+        fit_history=result.fit_history,
+        converged=result.converged,
+        reml=reml,
+        llf=float(result.llf),
+    )
@@ -0,0 +1,192 @@
+import math
+
+import numpy as np
+
+CHUNK_ROWS = 65536
+
+
+class QuantileSketch:
+    # Log-bucketed quantile sketch (DDSketch): each value is counted in the
+    # bucket (gamma^(k-1), gamma^k] of its magnitude, so every quantile comes
+    # back within `relative_accuracy` of the exact one. Two sketches with the
+    # same accuracy merge by adding bucket counts, and the number of buckets
+    # depends on the range of the values, not on how many there are.
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048, min_value=1e-9):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.max_buckets = max_buckets
+        self.min_value = min_value
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        small = np.abs(values) <= self.min_value
+        self.zeros += int(small.sum())
+        for buckets, part in [(self.positive, values[~small & (values > 0)]),
+                              (self.negative, -values[~small & (values < 0)])]:
+            keys, counts = np.unique(np.ceil(np.log(part) / math.log(self.gamma)).astype(np.int64),
+                                     return_counts=True)
+            for key, n in zip(keys.tolist(), counts.tolist()):
+                buckets[key] = buckets.get(key, 0) + n
+            self._collapse(buckets)
+        return self
+
+    def _collapse(self, buckets):
+        # Past max_buckets, fold the smallest magnitudes together; only
+        # quantiles very close to zero lose accuracy.
+        if len(buckets) > self.max_buckets:
+            keys = sorted(buckets)
+            floor = keys[-self.max_buckets]
+            buckets[floor] += sum(buckets.pop(k) for k in keys[:-self.max_buckets])
+
+    def merge(self, other):
+        if not math.isclose(self.gamma, other.gamma):
+            raise ValueError("can only merge sketches with the same relative accuracy")
+        for buckets, theirs in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for key, n in theirs.items():
+                buckets[key] = buckets.get(key, 0) + n
+            self._collapse(buckets)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantiles(self, probabilities):
+        probabilities = np.asarray(probabilities, dtype=float)
+        if not self.count:
+            return np.full(probabilities.shape, np.nan)
+        negative = sorted(self.negative, reverse=True)
+        positive = sorted(self.positive)
+        values = np.concatenate([
+            -self._bucket_value(np.array(negative, dtype=float)),
+            [0.0],
+            self._bucket_value(np.array(positive, dtype=float)),
+        ])
+        counts = np.array([self.negative[k] for k in negative] + [self.zeros] + [self.positive[k] for k in positive])
+        ranks = probabilities * self.count
+        index = np.searchsorted(np.cumsum(counts), ranks, side="right")
+        return np.clip(values[np.minimum(index, len(values) - 1)], self.min, self.max)
+
+    def _bucket_value(self, keys):
+        return 2 * self.gamma ** keys / (self.gamma + 1)
+
+    def __len__(self):
+        return len(self.positive) + len(self.negative) + (self.zeros > 0)
+
+
+class BinnedResiduals:
+    # Count, mean and sum of squared deviations of the residuals in fixed
+    # width bins of the fitted value. Bins combine with Chan's parallel
+    # update, so chunks and groups can be summarised separately and merged.
+
+    def __init__(self, width):
+        self.width = width
+        self.bins = {}
+
+    def add(self, fitted, resid):
+        fitted = np.asarray(fitted, dtype=float)
+        resid = np.asarray(resid, dtype=float)
+        keys, inverse = np.unique(np.floor(fitted / self.width).astype(np.int64), return_inverse=True)
+        n = np.bincount(inverse)
+        mean = np.bincount(inverse, resid) / n
+        m2 = np.bincount(inverse, (resid - mean[inverse]) ** 2)
+        for key, stats in zip(keys.tolist(), zip(n.tolist(), mean.tolist(), m2.tolist())):
+            self._combine(key, *stats)
+        return self
+
+    def _combine(self, key, n, mean, m2):
+        if key not in self.bins:
+            self.bins[key] = (n, mean, m2)
+            return
+        n0, mean0, m20 = self.bins[key]
+        total = n0 + n
+        delta = mean - mean0
+        self.bins[key] = (total, mean0 + delta * n / total, m20 + m2 + delta ** 2 * n0 * n / total)
+
+    def merge(self, other):
+        if not math.isclose(self.width, other.width):
+            raise ValueError("can only merge residual bins of the same width")
+        for key, stats in other.bins.items():
+            self._combine(key, *stats)
+        return self
+
+    def summary(self):
+        keys = sorted(self.bins)
+        stats = np.array([self.bins[k] for k in keys], dtype=float).reshape(-1, 3)
+        n, mean, m2 = stats.T
+        return {
+            "center": (np.array(keys, dtype=float) + 0.5) * self.width,
+            "count": n,
+            "mean": mean,
+            "sd": np.sqrt(np.divide(m2, n - 1, out=np.zeros_like(m2), where=n > 1)),
+        }
+
+
+def residual_diagnostics(result, groups, chunk_rows=CHUNK_ROWS, relative_accuracy=0.01, bin_width=None):
+    # A quantile sketch of the standardized residuals and residual-vs-fitted
+    # bins per group; the overall summaries are the groups' merged. The
+    # residuals come from the fitted result, so they are all in memory
+    # already: chunk_rows only bounds the temporaries of sorting rows into
+    # groups. Random effects are one value per group and term, standardized by
+    # the fitted variance of the term.
+    fitted = np.asarray(result.fittedvalues, dtype=float)
+    resid = np.asarray(result.resid, dtype=float)
+    groups = np.asarray(groups)
+    sigma = math.sqrt(result.scale)
+    width = bin_width or sigma / 2
+
+    by_group = {}
+    for start in range(0, len(resid), chunk_rows):
+        chunk = slice(start, start + chunk_rows)
+        labels, inverse = np.unique(groups[chunk], return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse))
+        chunk_fitted, chunk_resid = fitted[chunk][order], resid[chunk][order]
+        for label, lo, hi in zip(labels.tolist(), [0, *bounds[:-1].tolist()], bounds.tolist()):
+            sketch, bins = by_group.setdefault(label, (QuantileSketch(relative_accuracy), BinnedResiduals(width)))
+            sketch.add(chunk_resid[lo:hi] / sigma)
+            bins.add(chunk_fitted[lo:hi], chunk_resid[lo:hi])
+
+    overall = QuantileSketch(relative_accuracy)
+    overall_bins = BinnedResiduals(width)
+    for sketch, bins in by_group.values():
+        overall.merge(sketch)
+        overall_bins.merge(bins)
+
+    random_effects = {}
+    re_values = np.array([np.asarray(v, dtype=float) for v in result.random_effects.values()])
+    for j, term in enumerate(result.cov_re.columns):
+        sd = math.sqrt(result.cov_re.iloc[j, j])
+        random_effects[term] = QuantileSketch(relative_accuracy).add(re_values[:, j] / sd if sd > 0 else re_values[:, j])
+
+    return {
+        "rows": len(resid),
+        "residuals": overall,
+        "residuals_by_group": {label: sketch for label, (sketch, _) in sorted(by_group.items())},
+        "bins": overall_bins,
+        "bins_by_group": {label: bins for label, (_, bins) in sorted(by_group.items())},
+        "random_effects": random_effects,
+    }
+
+
+def qq_points(sketch, max_points=101):
+    # Plotting positions for a normal Q-Q plot: one per value for small
+    # samples, otherwise max_points evenly spaced probabilities.
+    from scipy.stats import norm
+
+    n = min(sketch.count, max_points)
+    probabilities = (np.arange(n) + 0.5) / n
+    return norm.ppf(probabilities), sketch.quantiles(probabilities)
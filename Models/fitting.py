@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Tried in order until one converges. The first two steps are what a bare
+# MixedLM.fit() does (bfgs, then lbfgs warm-started from it); the rest are
+# derivative-free fallbacks and finally ML, whose estimates are still
+# usable when the REML surface is flat along a variance parameter.
+DEFAULT_CHAIN = [
+    ("bfgs", True),
+    ("lbfgs", True),
+    ("nm", True),
+    ("powell", True),
+    ("lbfgs", False),
+]
+
+# The same idea for Models/sparse_lmm.py fits, which minimize the deviance
+# with scipy: L-BFGS-B, then the derivative-free methods, each warm-started
+# from the last (all keep the variance factors' diagonals non-negative).
+SPARSE_CHAIN = [
+    ("lbfgs", "L-BFGS-B"),
+    ("powell", "Powell"),
+    ("nm", "Nelder-Mead"),
+]
+
+DEFAULT_BUDGET = float(os.environ.get("FIT_BUDGET_SECONDS", 60))
+
+fit_log = deque(maxlen=int(os.environ.get("FIT_LOG_SIZE", 500)))
+_log_lock = threading.Lock()
+
+
+class FitTimeout(Exception):
+    pass
+
+
+class FitFailed(Exception):
+    pass
+
+
+def _budgeted_loglike(model, deadline, counter):
+    loglike = type(model).loglike
+
+    # Optimizers call loglike once or more per iteration, so checking the
+    # clock here cancels a stuck fit within one evaluation of the deadline.
+    def wrapped(params, *args, **kwargs):
+        counter[0] += 1
+        if time.monotonic() > deadline:
+            raise FitTimeout(f"over budget after {counter[0]} evaluations")
+        return loglike(model, params, *args, **kwargs)
+
+    return wrapped
+
+
+def _budgeted_deviance(model, deadline, counter):
+    deviance = type(model).deviance
+
+    def wrapped(theta, *args, **kwargs):
+        counter[0] += 1
+        if time.monotonic() > deadline:
+            raise FitTimeout(f"over budget after {counter[0]} evaluations")
+        return deviance(model, theta, *args, **kwargs)
+
+    return wrapped
+
+
+def record(entry):
+    with _log_lock:
+        fit_log.append(entry)
+
+
+def recent_fits(name=None):
+    with _log_lock:
+        entries = list(fit_log)
+    return [e for e in entries if name is None or e["model"] == name]
+
+
+def fit_mixedlm(model, name="mixedlm", budget=None, chain=None, start_params=None, **fit_kwargs):
+    budget = DEFAULT_BUDGET if budget is None else budget
+    chain = DEFAULT_CHAIN if chain is None else chain
+    deadline = time.monotonic() + budget
+    started = time.monotonic()
+
+    best = None
+    attempts = []
+    # A caller's start_params (e.g. a related model's estimates) seed every
+    # attempt until one finishes and its own estimates take over.
+    start_params = {reml: start_params for _, reml in chain} if start_params is not None else {}
+    for method, reml in chain:
+        remaining = deadline - time.monotonic()
+        entry = {
+            "model": name,
+            "method": method,
+            "reml": reml,
+            "status": None,
+            "iterations": None,
+            "fevals": 0,
+            "grad_norm": None,
+            "seconds": 0.0,
+            "llf": None,
+            "error": None,
+            "at": time.time(),
+        }
+        if remaining <= 0:
+            entry["status"] = "skipped"
+            entry["error"] = "budget exhausted"
+            record(entry)
+            attempts.append(entry)
+            continue
+
+        counter = [0]
+        model.loglike = _budgeted_loglike(model, deadline, counter)
+        t0 = time.perf_counter()
+        try:
+            result = model.fit(method=[method], reml=reml, start_params=start_params.get(reml),
+                               full_output=True, **fit_kwargs)
+        except FitTimeout as exc:
+            entry["status"] = "timeout"
+            entry["error"] = str(exc)
+            result = None
+        except Exception as exc:
+            entry["status"] = "error"
+            entry["error"] = f"{type(exc).__name__}: {exc}"
+            result = None
+        finally:
+            del model.loglike
+            entry["seconds"] = time.perf_counter() - t0
+            entry["fevals"] = counter[0]
+
+        if result is not None:
+            retvals = result.hist[-1] if result.hist else {}
+            packed = result.params_object.get_packed(use_sqrt=model.use_sqrt, has_fe=False)
+            entry["status"] = "converged" if result.converged else "not_converged"
+            entry["iterations"] = retvals.get("iterations", retvals.get("gcalls"))
+            entry["grad_norm"] = float(np.linalg.norm(model.score(packed)))
+            entry["llf"] = float(result.llf)
+            # Warm-start the next REML (or ML) attempt from where this one stopped
+            start_params[reml] = packed
+            if best is None or (result.converged and not best.converged) or \
+                    (result.converged == best.converged and result.reml == best.reml and result.llf > best.llf):
+                best = result
+        record(entry)
+        attempts.append(entry)
+        if result is not None and result.converged:
+            break
+
+    if best is None:
+        raise FitFailed(f"{name}: no optimizer finished within {budget:.0f}s "
+                        f"(tried {', '.join(m for m, _ in chain)})")
+    best.fit_history = attempts
+    best.fit_seconds = time.monotonic() - started
+    return best
+
+
+def fit_sparse(model, name="sparse", budget=None, chain=None, starts=(None,), fields=None):
+    # fit_mixedlm() for a SparseMixedLM: the chain is run from each start
+    # (None is the model's default) until an attempt converges, all within
+    # one budget, and the best result is kept. fields are added to every
+    # telemetry entry.
+    from scipy.optimize import approx_fprime
+
+    budget = DEFAULT_BUDGET if budget is None else budget
+    chain = SPARSE_CHAIN if chain is None else chain
+    deadline = time.monotonic() + budget
+    started = time.monotonic()
+
+    best = None
+    attempts = []
+    for start in starts:
+        for method, scipy_method in chain:
+            remaining = deadline - time.monotonic()
+            entry = {
+                "model": name,
+                "method": method,
+                "reml": model.reml,
+                "status": None,
+                "iterations": None,
+                "fevals": 0,
+                "grad_norm": None,
+                "seconds": 0.0,
+                "llf": None,
+                "error": None,
+                "at": time.time(),
+                **(fields or {}),
+            }
+            if remaining <= 0:
+                entry["status"] = "skipped"
+                entry["error"] = "budget exhausted"
+                record(entry)
+                attempts.append(entry)
+                continue
+
+            counter = [0]
+            model.deviance = _budgeted_deviance(model, deadline, counter)
+            t0 = time.perf_counter()
+            try:
+                result = model.fit(start=start, method=scipy_method)
+            except FitTimeout as exc:
+                entry["status"] = "timeout"
+                entry["error"] = str(exc)
+                result = None
+            except Exception as exc:
+                entry["status"] = "error"
+                entry["error"] = f"{type(exc).__name__}: {exc}"
+                result = None
+            finally:
+                del model.deviance
+                entry["seconds"] = time.perf_counter() - t0
+                entry["fevals"] = counter[0]
+
+            if result is not None:
+                entry["status"] = "converged" if result.converged else "not_converged"
+                entry["iterations"] = result.n_iter
+                # Score of the log-likelihood, as fit_mixedlm() reports it
+                gradient = approx_fprime(result.theta, model.deviance, 1e-7)
+                entry["grad_norm"] = float(0.5 * np.linalg.norm(gradient))
+                entry["llf"] = float(result.llf)
+                start = result.theta
+                if best is None or (result.converged and not best.converged) or \
+                        (result.converged == best.converged and result.llf > best.llf):
+                    best = result
+            record(entry)
+            attempts.append(entry)
+            if result is not None and result.converged:
+                break
+
+    if best is None:
+        raise FitFailed(f"{name}: no optimizer finished within {budget:.0f}s "
+                        f"(tried {', '.join(m for m, _ in chain)})")
+    best.fit_history = attempts
+    best.fit_seconds = time.monotonic() - started
+    return best
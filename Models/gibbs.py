@@ -0,0 +1,268 @@
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import invwishart
+
+from Models.compress import ENDOG, GROUP, GroupedFit, compress
+
+# Bayesian fit of the random intercept and slopes model
+#
+#   y_ij = x_ij' (beta + u_j) + e_ij,   u_j ~ N(0, tau),   e_ij ~ N(0, s2)
+#
+# by blocked Gibbs sampling: beta and the university effects u_j jointly
+# (beta with the u_j integrated out, then all u_j at once), then tau from its
+# inverse-Wishart full conditional, then s2. Every conditional only needs
+# each university's X'X, X'y, y'y and n, formed once from the compressed
+# records, so an iteration costs a handful of batched p x p operations
+# whatever the number of rows.
+#
+# Priors: flat on beta, p(s2) ~ 1/s2, tau ~ IW(p + 2, S0) with S0 the moment
+# estimates' variances (Models/moments.py), so the prior mean of tau is
+# diagonal at those. With five universities the prior on tau matters; --prior-df
+# loosens or tightens it. Chains run in separate processes from dispersed
+# starts and are checked with split R-hat and effective sample size.
+
+PREDICTORS = ["masters_gpa", "relevant_work_years", "years_python", "years_sql"]
+CHAINS = 4
+ITERATIONS = 4000
+WARMUP = 1000
+# R-hat above this, or fewer effective draws than this, gets flagged
+MAX_RHAT = 1.01
+MIN_ESS = 400
+
+
+def group_stats(data, fixed, group=GROUP, endog=ENDOG):
+    records, _ = compress(data, fixed, group, endog)
+    labels, codes = np.unique(records[group].to_numpy(), return_inverse=True)
+    G = len(labels)
+    X = np.column_stack([np.ones(len(records))] + [records[c].to_numpy(dtype=float) for c in fixed])
+    w = records["count"].to_numpy(dtype=float)
+    p = X.shape[1]
+    XtX = np.zeros((G, p, p))
+    np.add.at(XtX, codes, (X * w[:, None])[:, :, None] * X[:, None, :])
+    Xty = np.zeros((G, p))
+    np.add.at(Xty, codes, X * records["sum_y"].to_numpy(dtype=float)[:, None])
+    return {"labels": labels.tolist(), "names": ["Intercept", *fixed], "XtX": XtX, "Xty": Xty,
+            "yty": np.bincount(codes, weights=records["sum_y2"].to_numpy(dtype=float), minlength=G),
+            "n": np.bincount(codes, weights=w, minlength=G)}
+
+
+def draw_normal(rng, precision, linear):
+    # One draw from N(P^-1 b, P^-1) for each of a stack of (P, b)
+    L = np.linalg.cholesky(precision)
+    mean = np.linalg.solve(precision, linear[..., None])[..., 0]
+    z = rng.standard_normal(linear.shape)
+    return mean + np.linalg.solve(np.swapaxes(L, -1, -2), z[..., None])[..., 0]
+
+
+def run_chain(stats, prior_df, prior_scale, start, seed, iterations, warmup):
+    rng = np.random.default_rng(seed)
+    XtX, Xty, yty, n = stats["XtX"], stats["Xty"], stats["yty"].sum(), stats["n"].sum()
+    XtX_all, Xty_all = XtX.sum(axis=0), Xty.sum(axis=0)
+    G, p = Xty.shape
+    tau, s2 = start["tau"], start["s2"]
+    kept = iterations - warmup
+    out = {"beta": np.empty((kept, p)), "u": np.empty((kept, G, p)), "tau": np.empty((kept, p, p)),
+           "s2": np.empty(kept)}
+    for it in range(iterations):
+        # (beta, u) | tau, s2 in one block: beta with u integrated out, then
+        # every u_j given beta. Drawing them apart mixes badly, since a
+        # slope can move between beta and all the u_j at no cost.
+        precision = XtX / s2 + np.linalg.inv(tau)
+        H = np.linalg.solve(precision, XtX / s2)
+        beta = draw_normal(rng, XtX_all / s2 - np.einsum("gki,gkj->ij", XtX / s2, H),
+                           (Xty_all - np.einsum("gki,gk->i", H, Xty)) / s2)
+        u = draw_normal(rng, precision, (Xty - XtX @ beta) / s2)
+        # tau | u
+        tau = np.atleast_2d(invwishart.rvs(prior_df + G, prior_scale + u.T @ u, random_state=rng))
+        # s2 | beta, u: residual sum of squares from the cross-products
+        coef = beta[None, :] + u
+        rss = yty - 2 * np.sum(coef * Xty) + np.einsum("gi,gij,gj->", coef, XtX, coef)
+        s2 = rss / 2 / rng.gamma(n / 2)
+        if it >= warmup:
+            k = it - warmup
+            out["beta"][k], out["u"][k], out["tau"][k], out["s2"][k] = beta, u, tau, s2
+    return out
+
+
+def split_chains(x):
+    # (chains, draws) -> (2 chains, draws / 2): each half as its own chain
+    half = x.shape[1] // 2
+    return np.concatenate([x[:, :half], x[:, half:2 * half]])
+
+
+def rhat(x):
+    x = split_chains(x)
+    m = x.shape[1]
+    W = x.var(axis=1, ddof=1).mean()
+    B = m * x.mean(axis=1).var(ddof=1)
+    if W == 0:
+        return 1.0
+    return float(np.sqrt(((m - 1) / m * W + B / m) / W))
+
+
+def ess(x):
+    # Effective sample size from the chains' combined autocorrelation,
+    # truncated by Geyer's initial monotone sequence (Gelman et al., BDA3)
+    x = split_chains(x)
+    chains, m = x.shape
+    centered = x - x.mean(axis=1, keepdims=True)
+    size = 2 ** int(np.ceil(np.log2(2 * m)))
+    f = np.fft.rfft(centered, size, axis=1)
+    acov = np.fft.irfft(f * np.conj(f), size, axis=1)[:, :m] / m
+    W = x.var(axis=1, ddof=1).mean()
+    var_plus = (m - 1) / m * W + m * x.mean(axis=1).var(ddof=1) / m
+    if var_plus == 0:
+        return float(chains * m)
+    rho = 1 - (W - acov.mean(axis=0)) / var_plus
+    pairs = rho[:-1:2] + rho[1::2]
+    positive = np.flatnonzero(pairs <= 0)
+    pairs = pairs[:positive[0]] if len(positive) else pairs
+    pairs = np.minimum.accumulate(pairs)
+    tau = -1 + 2 * pairs.sum()
+    return float(chains * m / max(tau, 1 / np.log10(chains * m)))
+
+
+def summarize(draws, names, labels):
+    # One row per scalar: mean, sd, 95% interval, R-hat and ESS over chains
+    p = len(names)
+    sd = np.sqrt(np.maximum(np.diagonal(draws["tau"], axis1=-2, axis2=-1), 0))
+    scalars = {f"beta[{n}]": draws["beta"][..., k] for k, n in enumerate(names)}
+    scalars.update({f"sd[{n}]": sd[..., k] for k, n in enumerate(names)})
+    for k in range(p):
+        for l in range(k):
+            scalars[f"corr[{names[k]}, {names[l]}]"] = draws["tau"][..., k, l] / (sd[..., k] * sd[..., l])
+    scalars["sigma"] = np.sqrt(draws["s2"])
+    for j, label in enumerate(labels):
+        scalars.update({f"u[{label}, {n}]": draws["u"][..., j, k] for k, n in enumerate(names)})
+    rows = []
+    for name, x in scalars.items():
+        lo, hi = np.percentile(x, [2.5, 97.5])
+        rows.append({"parameter": name, "mean": float(x.mean()), "sd": float(x.std()), "lower": float(lo),
+                     "upper": float(hi), "rhat": rhat(x), "ess": ess(x)})
+    return pd.DataFrame(rows)
+
+
+def starts(stats, data, fixed, chains, rng, group=GROUP, endog=ENDOG):
+    # Over-dispersed around the moment estimates: tau drawn from the prior,
+    # s2 within a factor of about two (beta and u are drawn first)
+    from Models.moments import fit_moments
+
+    moments = fit_moments(data, fixed, group, endog)
+    p = len(fixed) + 1
+    XtX_all = stats["XtX"].sum(axis=0)
+    floor = 1e-4 * moments.scale / np.diag(XtX_all / stats["n"].sum())
+    prior_scale = np.diag(np.maximum(np.diag(np.asarray(moments.cov_re)), floor))
+    out = []
+    for _ in range(chains):
+        out.append({"tau": np.atleast_2d(invwishart.rvs(p + 2, prior_scale, random_state=rng)),
+                    "s2": moments.scale * np.exp(rng.normal(0, 0.7))})
+    return out, prior_scale
+
+
+def sample(data, fixed, chains=CHAINS, iterations=ITERATIONS, warmup=WARMUP, prior_df=None, seed=2024, workers=None,
+           group=GROUP, endog=ENDOG):
+    stats = group_stats(data, fixed, group, endog)
+    p = len(fixed) + 1
+    prior_df = p + 2 if prior_df is None else prior_df
+    seeds = np.random.SeedSequence(seed).spawn(chains + 1)
+    inits, prior_scale = starts(stats, data, fixed, chains, np.random.default_rng(seeds[0]), group, endog)
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, chains)) as pool:
+        futures = [pool.submit(run_chain, stats, prior_df, prior_scale, init, s, iterations, warmup)
+                   for init, s in zip(inits, seeds[1:])]
+        results = [f.result() for f in futures]
+    draws = {key: np.stack([r[key] for r in results]) for key in results[0]}
+    return {"draws": draws, "stats": stats, "prior_df": prior_df, "prior_scale": prior_scale,
+            "seconds": time.perf_counter() - t0}
+
+
+def bayes_fit(data, fixed, name=None, group=GROUP, endog=ENDOG, **options):
+    # Posterior means as a GroupedFit, for graphs.py's figures; the draws and
+    # their diagnostics ride along as .posterior and .summary
+    from Models.fitting import record
+
+    posterior = sample(data, fixed, group=group, endog=endog, **options)
+    draws, stats = posterior["draws"], posterior["stats"]
+    names = stats["names"]
+    re_names = ["Group", *fixed]
+    summary = summarize(draws, names, stats["labels"])
+    beta = draws["beta"].mean(axis=(0, 1))
+    effects = draws["u"].mean(axis=(0, 1))
+
+    X = np.column_stack([np.ones(len(data))] + [data[c].to_numpy(dtype=float) for c in fixed])
+    codes = pd.Index(stats["labels"]).get_indexer(data[group].to_numpy())
+    fixedvalues = X @ beta
+    fittedvalues = fixedvalues + np.einsum("ij,ij->i", X, effects[codes])
+    entry = {"model": name or "gibbs", "method": "gibbs", "reml": False,
+             "status": "converged" if summary["rhat"].max() <= MAX_RHAT else "not_converged",
+             "iterations": int(draws["s2"].size), "fevals": None, "grad_norm": None,
+             "seconds": posterior["seconds"], "llf": None, "error": None, "at": time.time(),
+             "rhat_max": float(summary["rhat"].max()), "ess_min": float(summary["ess"].min())}
+    record(entry)
+    fit = GroupedFit(
+        fe_params=pd.Series(beta, index=names),
+        cov_re=pd.DataFrame(draws["tau"].mean(axis=(0, 1)), index=re_names, columns=re_names),
+        scale=float(draws["s2"].mean()),
+        random_effects={label: pd.Series(effects[j], index=re_names) for j, label in enumerate(stats["labels"])},
+        fittedvalues=fittedvalues,
+        fixedvalues=fixedvalues,
+        endog=data[endog].to_numpy(dtype=float),
+        fit_history=[entry],
+        converged=entry["status"] == "converged",
+    )
+    fit.posterior = posterior
+    fit.summary = summary
+    return fit
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gibbs sampler for the random intercept and slopes model.")
+    parser.add_argument("--data", default="Data/masters_salary.csv")
+    parser.add_argument("--predictors", nargs="+", default=PREDICTORS, choices=PREDICTORS,
+                        help="fixed effects, each with a random slope (default: model_full's)")
+    parser.add_argument("--chains", type=int, default=CHAINS)
+    parser.add_argument("--iterations", type=int, default=ITERATIONS, help="per chain, warmup included")
+    parser.add_argument("--warmup", type=int, default=WARMUP)
+    parser.add_argument("--prior-df", type=float, default=None, help="inverse-Wishart degrees of freedom (default p + 2)")
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per chain, up to the CPUs)")
+    parser.add_argument("--figures", metavar="DIR",
+                        help="also write the spaghetti and predicted-vs-actual figures from the posterior means")
+    args = parser.parse_args()
+
+    with open(args.data, "rb") as f:
+        data = pd.read_csv(io.BytesIO(f.read()))
+    options = dict(chains=args.chains, iterations=args.iterations, warmup=args.warmup, prior_df=args.prior_df,
+                   seed=args.seed, workers=args.workers)
+    fit = bayes_fit(data, args.predictors, name="gibbs", **options)
+    entry = fit.fit_history[0]
+    print(f"{args.chains} chains x {args.iterations - args.warmup} draws in {entry['seconds']:.1f}s; "
+          f"max R-hat {entry['rhat_max']:.3f}, min ESS {entry['ess_min']:.0f}")
+    print(f"{'parameter':<44} {'mean':>12} {'sd':>11} {'2.5%':>12} {'97.5%':>12} {'R-hat':>6} {'ESS':>7}")
+    for row in fit.summary.itertuples():
+        flag = " *" if row.rhat > MAX_RHAT or row.ess < MIN_ESS else ""
+        print(f"{row.parameter:<44} {row.mean:>12.4g} {row.sd:>11.4g} {row.lower:>12.4g} {row.upper:>12.4g} "
+              f"{row.rhat:>6.3f} {row.ess:>7.0f}{flag}")
+
+    if args.figures:
+        from graphs import SLOPE_PREDICTORS, build_mixed_effects_figure, build_predicted_vs_actual_figure
+
+        # The spaghetti plot draws one model per predictor, as in the app
+        models = {f"model{i}": fit if args.predictors == [x_var] else bayes_fit(data, [x_var], f"gibbs-model{i}",
+                                                                                   **options)
+                  for i, x_var in enumerate(SLOPE_PREDICTORS, start=1)}
+        os.makedirs(args.figures, exist_ok=True)
+        figures = {"me": build_mixed_effects_figure(data, models), "me_pred": build_predicted_vs_actual_figure(data, fit)}
+        for name, fig in figures.items():
+            fig.write_html(os.path.join(args.figures, f"{name}.html"), include_plotlyjs="cdn")
+        print(f"figures written to {args.figures}/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import time
+
+import numpy as np
+
+from Models.compress import ENDOG, GROUP, compress, records_model
+from Models.sparse_lmm import block_fit, block_solve, group_blocks
+
+# Leave-one-university-out influence on the fixed effects and tau. With five
+# universities one of them can carry a fixed effect on its own, so for every
+# university we refit without it and report how far the estimates move.
+#
+# Nothing is refitted from the rows. Every cross-product in the model is a
+# sum over universities, so the model without university g is the full one
+# with g's blocks of Z'Z, Z'X and Z'y removed and g's share of X'X, X'y, y'y
+# and n subtracted (its "downdate"); each refit then starts from the full
+# model's optimum, which it is usually close to. The shares are formed in one
+# pass over the records, so the cost grows with the number of universities,
+# not graduates.
+
+
+def group_shares(model, records):
+    # Each university's part of X'X, X'y, y'y and n
+    codes = model.terms[0].codes
+    G = len(model.terms[0].levels)
+    w = records["count"].to_numpy(dtype=float)
+    wX = model.X * w[:, None]
+    XtX = np.zeros((G, model.p, model.p))
+    np.add.at(XtX, codes, wX[:, :, None] * model.X[:, None, :])
+    Xty = np.zeros((G, model.p))
+    np.add.at(Xty, codes, wX * model.y[:, None])
+    yty = np.bincount(codes, weights=records["sum_y2"].to_numpy(dtype=float), minlength=G)
+    n = np.bincount(codes, weights=w, minlength=G)
+    return {"XtX": XtX, "Xty": Xty, "yty": yty, "n": n}
+
+
+def downdate(blocks, shares, g, n_fixed):
+    keep = np.arange(len(blocks["ZtZ"])) != g
+    n = blocks["dof"] + (n_fixed if blocks["reml"] else 0) - shares["n"][g]
+    return dict(blocks, ZtZ=blocks["ZtZ"][keep], ZtX=blocks["ZtX"][keep], Zty=blocks["Zty"][keep],
+                XtX=blocks["XtX"] - shares["XtX"][g], Xty=blocks["Xty"] - shares["Xty"][g],
+                yty=blocks["yty"] - shares["yty"][g], dof=n - n_fixed if blocks["reml"] else n)
+
+
+def estimates(blocks, theta):
+    s = block_solve(blocks, theta)
+    scale = s["prss"] / blocks["dof"]
+    T = np.zeros((blocks["p"], blocks["p"]))
+    T[np.tril_indices(blocks["p"])] = theta
+    return {"beta": s["beta"], "scale": scale, "tau": scale * T @ T.T, "S": s["S"]}
+
+
+def start_from(result, p):
+    # Relative covariance factor of a fitted model (any of graphs.py's fits)
+    relative = np.asarray(result.cov_re, dtype=float) / float(result.scale)
+    ridge = np.diag(np.maximum(np.diag(relative), 1e-12)) * 1e-6
+    return np.linalg.cholesky(relative + ridge)[np.tril_indices(p)]
+
+
+def influence(records, fixed, result=None, group=GROUP):
+    # records: compress() output with at least the columns in fixed; result:
+    # the model already fitted to the same data, whose optimum the refits
+    # start from
+    if [c for c in records.columns if c not in (group, ENDOG, "count", "sum_y", "sum_y2")] != list(fixed):
+        records, _ = compress(records, fixed, group)
+    t0 = time.perf_counter()
+    model = records_model(records, fixed, group=group)
+    blocks = group_blocks(model)
+    starts = [model.theta0()] + ([start_from(result, blocks["p"])] if result is not None else [])
+    theta = block_fit(blocks, starts).x
+    full = estimates(blocks, theta)
+    shares = group_shares(model, records)
+    k = model.p
+
+    universities = []
+    for g, level in enumerate(model.terms[0].levels):
+        without = downdate(blocks, shares, g, k)
+        opt = block_fit(without, [theta])
+        dropped = estimates(without, opt.x)
+        delta = dropped["beta"] - full["beta"]
+        universities.append({
+            "university": str(level),
+            "graduates": int(shares["n"][g]),
+            "fe_params": dropped["beta"].tolist(),
+            "fe_change": delta.tolist(),
+            # Cook's distance on the fixed effects, in the full fit's metric
+            "cooks_d": float(delta @ full["S"] @ delta / (k * full["scale"])),
+            "tau": dropped["tau"].tolist(),
+            "tau_change": (dropped["tau"] - full["tau"]).tolist(),
+            "scale": float(dropped["scale"]),
+            "converged": bool(opt.success),
+        })
+    return {"fe_names": model.exog_names, "re_names": model.terms[0].columns, "fe_params": full["beta"].tolist(),
+            "tau": full["tau"].tolist(), "scale": float(full["scale"]), "universities": universities,
+            "seconds": time.perf_counter() - t0}
+
+
+def model_influence(records, models, predictors):
+    # The store's slope models (model1..) and model_full
+    out = {name: influence(records, [x_var], models[name]) for name, x_var in
+           zip([f"model{i}" for i in range(1, len(predictors) + 1)], predictors)}
+    out["model_full"] = influence(records, predictors, models["model_full"])
+    return out
+
+
+if __name__ == "__main__":
+    from refresh import file_digest, load_or_build
+
+    parser = argparse.ArgumentParser(description="Leave-one-university-out influence on each model's estimates.")
+    parser.add_argument("--data", default="Data/masters_salary.csv")
+    parser.add_argument("--model", default="model_full", help="model1..model4 or model_full")
+    args = parser.parse_args()
+
+    store = load_or_build(args.data, file_digest(args.data))
+    result = store.json("influence")[args.model]
+    names = result["fe_names"]
+    print(f"{args.model}: fixed effects without each university (change from the full fit in brackets)")
+    print(f"{'dropped':<18} {'graduates':>9} {'Cook D':>8}  " + "  ".join(f"{n[:18]:>28}" for n in names))
+    for entry in result["universities"]:
+        cells = [f"{v:>14.2f} ({d:>+11.2f})" for v, d in zip(entry["fe_params"], entry["fe_change"])]
+        print(f"{entry['university']:<18} {entry['graduates']:>9} {entry['cooks_d']:>8.3f}  " + "  ".join(cells))
+    print()
+    print("Random-effect sds without each university (full fit: "
+          + ", ".join(f"{n} {np.sqrt(max(v, 0)):.4g}" for n, v in zip(result["re_names"], np.diag(result["tau"])))
+          + ")")
+    for entry in result["universities"]:
+        sds = np.sqrt(np.maximum(np.diag(entry["tau"]), 0))
+        flag = "" if entry["converged"] else "  (not converged)"
+        print(f"{entry['university']:<18} " + "  ".join(f"{v:>12.4g}" for v in sds) + flag)
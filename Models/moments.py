@@ -0,0 +1,84 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from Models.compress import GroupedFit
+
+# Method-of-moments fit of the random coefficients model
+#
+#   y_ij = x_ij' (beta + u_j) + e_ij,   u_j ~ N(0, Delta),   e_ij ~ N(0, s2)
+#
+# from one OLS per group (Swamy's estimator): beta is the mean of the group
+# coefficients, s2 the pooled residual variance, and Delta the spread of the
+# group coefficients less the part that OLS noise alone explains, clipped to
+# be positive semi-definite. Random effects are the BLUPs given those. Every
+# step works from per-group X'X, X'y and y'y, so it is one pass over the data
+# and no optimizer; a preview of the REML fit in a fraction of its time.
+
+
+def psd_clip(matrix):
+    values, vectors = np.linalg.eigh((matrix + matrix.T) / 2)
+    return (vectors * np.clip(values, 0, None)) @ vectors.T
+
+
+def fit_moments(data, fixed, group="masters_university", endog="first_job_salary", name=None):
+    # Random intercept and a random slope for every fixed effect, which is
+    # the structure of the slope models and the full model in graphs.py.
+    t0 = time.perf_counter()
+    names = ["Intercept", *fixed]
+    y = data[endog].to_numpy(dtype=float)
+    X = np.column_stack([np.ones(len(data))] + [data[c].to_numpy(dtype=float) for c in fixed])
+    labels, inverse = np.unique(data[group].to_numpy(), return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(labels)))])
+    p = X.shape[1]
+
+    xtx = np.empty((len(labels), p, p))
+    xty = np.empty((len(labels), p))
+    yty = np.empty(len(labels))
+    n = np.diff(bounds)
+    for j in range(len(labels)):
+        rows = order[bounds[j]:bounds[j + 1]]
+        Xj, yj = X[rows], y[rows]
+        xtx[j], xty[j], yty[j] = Xj.T @ Xj, Xj.T @ yj, yj @ yj
+
+    # Groups with more rows than coefficients and a full-rank design get
+    # their own OLS fit; the rest only receive BLUPs at the end.
+    usable = [j for j in range(len(labels)) if n[j] > p and np.linalg.matrix_rank(xtx[j]) == p]
+    if usable:
+        coefs = np.array([np.linalg.solve(xtx[j], xty[j]) for j in usable])
+        rss = np.array([yty[j] - coefs[k] @ xty[j] for k, j in enumerate(usable)])
+        scale = float(rss.sum() / sum(n[j] - p for j in usable))
+        beta = coefs.mean(axis=0)
+    else:
+        beta = np.linalg.lstsq(X, y, rcond=None)[0]
+        scale = float(np.mean((y - X @ beta) ** 2))
+    if len(usable) > 1:
+        noise = np.mean([np.linalg.inv(xtx[j]) for j in usable], axis=0) * scale
+        delta = psd_clip(np.cov(coefs, rowvar=False).reshape(p, p) - noise)
+    else:
+        delta = np.zeros((p, p))
+
+    # BLUP: u_j = Delta (Z'Z Delta + s2 I)^-1 Z'(y - X beta), which holds
+    # when Delta is singular too
+    effects = np.array([delta @ np.linalg.solve(xtx[j] @ delta + scale * np.eye(p), xty[j] - xtx[j] @ beta)
+                        for j in range(len(labels))])
+    fixedvalues = X @ beta
+    fittedvalues = fixedvalues + np.einsum("ij,ij->i", X, effects[inverse])
+
+    re_names = ["Group", *fixed]
+    seconds = time.perf_counter() - t0
+    history = [{"model": name or "moments", "method": "moments", "reml": False, "status": "converged",
+                "iterations": None, "fevals": 0, "grad_norm": None, "seconds": seconds, "llf": None,
+                "error": None, "at": time.time()}]
+    return GroupedFit(
+        fe_params=pd.Series(beta, index=names),
+        cov_re=pd.DataFrame(delta, index=re_names, columns=re_names),
+        scale=scale,
+        random_effects={label: pd.Series(effects[j], index=re_names) for j, label in enumerate(labels.tolist())},
+        fittedvalues=fittedvalues,
+        fixedvalues=fixedvalues,
+        endog=y,
+        fit_history=history,
+    )
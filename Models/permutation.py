@@ -0,0 +1,195 @@
+import argparse
+import io
+import json
+import math
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from Models.sparse_lmm import SparseMixedLM, block_fit, group_blocks
+from refresh import CACHE_DIR, file_digest, write_json
+
+# Permutation test for a random slope: does (x | university) fit better than
+# (1 | university) by more than chance? The REML likelihood ratio for a
+# variance on its boundary has no trustworthy reference distribution, so we
+# build one. Fit the null model, keep its fitted values (fixed effects plus
+# university intercepts) and shuffle its residuals, within each university
+# ("within") or across all graduates ("between"), then refit both models to
+# every shuffled response (Freedman and Lane's scheme). The p-value is the
+# share of shuffles whose statistic reaches the observed one.
+#
+# Only the response changes between shuffles, so X, Z and every cross-product
+# without y are computed once; a batch of shuffles needs one product of Z' and
+# X' with the batch's responses, and each fit runs on the per-university
+# blocks (Models/sparse_lmm.group_blocks). Batches go to a process pool and
+# the run stops as soon as the p-value is known to within --precision.
+
+PREDICTORS = ["masters_gpa", "relevant_work_years", "years_python", "years_sql"]
+SCHEMES = ("within", "between")
+GROUP = "masters_university"
+ENDOG = "first_job_salary"
+Z_95 = 1.96
+
+_problem = None
+
+
+def models(data, x_var):
+    full = SparseMixedLM(f"{ENDOG} ~ {x_var}", data, f"({x_var} | {GROUP})")
+    null = SparseMixedLM(f"{ENDOG} ~ {x_var}", data, f"(1 | {GROUP})")
+    return full, null
+
+
+def statistic(full_blocks, null_blocks, full_start, null_start):
+    # 2 x (REML log-likelihood gain of the slope). The null optimum embedded
+    # in the full model is one of the starts, so this is never negative.
+    null = block_fit(null_blocks, [null_start])
+    embedded = np.zeros(len(full_start))
+    embedded[0] = null.x[0]
+    full = block_fit(full_blocks, [full_start, embedded])
+    return max(null.fun - full.fun, 0.0), full.x, null.x
+
+
+def with_response(blocks, model, Y):
+    # The blocks of model for each column of Y instead of its own response
+    G, p = blocks["ZtX"].shape[:2]
+    Zty = np.asarray(model.Z.T @ Y).T.reshape(-1, G, p)
+    Xty = (model.X.T @ Y).T
+    yty = np.einsum("ib,ib->b", Y, Y)
+    return [dict(blocks, Zty=Zty[b], Xty=Xty[b], yty=yty[b]) for b in range(Y.shape[1])]
+
+
+def shuffles(rng, codes, scheme, count):
+    # count permutations of range(n), as rows; "within" only moves rows
+    # among graduates of the same university
+    n = len(codes)
+    if scheme == "between":
+        return rng.permuted(np.tile(np.arange(n), (count, 1)), axis=1)
+    out = np.empty((count, n), dtype=np.intp)
+    for g in np.unique(codes):
+        rows = np.flatnonzero(codes == g)
+        out[:, rows] = rng.permuted(np.tile(rows, (count, 1)), axis=1)
+    return out
+
+
+def _init_worker(data, x_var, scheme):
+    global _problem
+    full, null = models(data, x_var)
+    full_blocks, null_blocks = group_blocks(full), group_blocks(null)
+    observed, full_theta, null_theta = statistic(full_blocks, null_blocks, full.theta0(), null.theta0())
+    null_fit = null.fit(start=null_theta)
+    fitted = np.asarray(null_fit.fittedvalues)
+    _problem = {"full": full, "null": null, "full_blocks": full_blocks, "null_blocks": null_blocks,
+                "full_theta": full_theta, "null_theta": null_theta, "observed": observed,
+                "fitted": fitted, "resid": null.y - fitted, "codes": null.terms[0].codes, "scheme": scheme}
+
+
+def run_batch(seed, index, count):
+    # Seeded by the batch's index alone, so a run is reproducible however
+    # the batches are spread over workers
+    P = _problem
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(index,)))
+    order = shuffles(rng, P["codes"], P["scheme"], count)
+    Y = (P["fitted"][None, :] + P["resid"][order]).T
+    full = with_response(P["full_blocks"], P["full"], Y)
+    null = with_response(P["null_blocks"], P["null"], Y)
+    return [statistic(f, n, P["full_theta"], P["null_theta"])[0] for f, n in zip(full, null)]
+
+
+def p_value(exceed, n):
+    # (1 + exceedances) / (1 + shuffles): never zero, and exact as a test
+    p = (exceed + 1) / (n + 1)
+    return p, Z_95 * math.sqrt(p * (1 - p) / max(n, 1))
+
+
+def test(data, x_var, scheme="within", precision=0.01, max_permutations=10000, batch=100, seed=2024, workers=None,
+         progress=None):
+    workers = workers or os.cpu_count() or 1
+    _init_worker(data, x_var, scheme)
+    observed = _problem["observed"]
+    exceed = n = 0
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data, x_var, scheme)) as pool:
+        # Batches are counted in index order whatever order they finish in,
+        # so where the run stops doesn't depend on scheduling
+        pending, results, submitted, next_index = set(), {}, 0, 0
+        total = math.ceil(max_permutations / batch)
+        done = False
+        while not done:
+            while submitted < total and len(pending) < 2 * workers:
+                count = min(batch, max_permutations - submitted * batch)
+                future = pool.submit(run_batch, seed, submitted, count)
+                future.index = submitted
+                pending.add(future)
+                submitted += 1
+            if not pending:
+                break
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                results[future.index] = future.result()
+            while next_index in results:
+                stats = results.pop(next_index)
+                exceed += int(sum(s >= observed - 1e-9 for s in stats))
+                n += len(stats)
+                next_index += 1
+                p, half_width = p_value(exceed, n)
+                if progress is not None:
+                    progress(n, p, half_width)
+                if half_width <= precision or n >= max_permutations:
+                    done = True
+                    break
+        for future in pending:
+            future.cancel()
+    p, half_width = p_value(exceed, n)
+    return {"predictor": x_var, "scheme": scheme, "observed": float(observed), "permutations": n, "exceed": exceed,
+            "p_value": p, "half_width": half_width, "precision": precision, "seed": seed,
+            "seconds": time.perf_counter() - t0}
+
+
+def results_path(digest):
+    return os.path.join(CACHE_DIR, f"permutation-{digest[:16]}.json")
+
+
+def main():
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Permutation test for each random slope by university.")
+    parser.add_argument("--data", default="Data/masters_salary.csv")
+    parser.add_argument("--predictors", nargs="+", default=PREDICTORS, choices=PREDICTORS)
+    parser.add_argument("--scheme", choices=SCHEMES, default="within",
+                        help="shuffle null-model residuals within each university or across all of them")
+    parser.add_argument("--precision", type=float, default=0.01,
+                        help="stop once the 95%% Monte Carlo half-width of the p-value is this small")
+    parser.add_argument("--max-permutations", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=100, help="shuffles per task")
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    with open(args.data, "rb") as f:
+        raw = f.read()
+    data = pd.read_csv(io.BytesIO(raw))
+    path = results_path(file_digest(args.data))
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        saved = {}
+
+    print(f"{'predictor':<22} {'scheme':<8} {'LRT':>8} {'shuffles':>9} {'p-value':>9} {'+/-':>7} {'seconds':>8}")
+    for x_var in args.predictors:
+        def progress(n, p, half_width):
+            print(f"\r{x_var:<22} {args.scheme:<8} {'':>8} {n:>9} {p:>9.4f} {half_width:>7.4f}", end="", flush=True)
+
+        result = test(data, x_var, args.scheme, args.precision, args.max_permutations, args.batch, args.seed,
+                      args.workers, progress)
+        print(f"\r{x_var:<22} {args.scheme:<8} {result['observed']:>8.2f} {result['permutations']:>9} "
+              f"{result['p_value']:>9.4f} {result['half_width']:>7.4f} {result['seconds']:>8.1f}")
+        saved[f"{x_var}/{args.scheme}"] = dict(result, built_at=time.time())
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    write_json(path, saved)
+
+
+if __name__ == "__main__":
+    main()
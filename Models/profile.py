@@ -0,0 +1,291 @@
+import argparse
+import fcntl
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from refresh import CACHE_DIR, file_digest, write_json
+
+# Profile-likelihood intervals for every variance and covariance in model_full's
+# tau matrix. With five universities the REML criterion is far from quadratic
+# in them, so Wald intervals mislead; instead, for each parameter we walk a grid
+# of fixed values away from the estimate, re-maximizing the REML likelihood
+# over everything else at each point (warm-started from the previous one), and
+# read off where it has dropped by chi2(1) / 2. The walks are independent, two
+# per parameter, and run in parallel; the result is cached per dataset.
+#
+# The model is Models/sparse_lmm.py's on the frequency-weighted records, with
+# s2 made explicit: x = (theta, log s2) and tau = s2 * T T', T the lower
+# triangle filled from theta. Its deviance is evaluated per university block
+# (group_blocks), tens of thousands of times.
+
+PREDICTORS = ["masters_gpa", "relevant_work_years", "years_python", "years_sql"]
+LEVEL = 0.95
+PROFILE_FORMAT = 1
+# Grid spacing: the first step is this many sds (sd_k * sd_l for a
+# covariance), later ones aim at 1/ZETA_STEPS of the critical rise in the
+# signed root deviance and at most MAX_GROWTH times the previous step.
+FIRST_STEP = 0.1
+ZETA_STEPS = 8
+MAX_GROWTH = 4
+MAX_STEPS = 40
+RESTARTS = 3
+
+_problem = None
+
+
+def critical_root():
+    # scipy is imported here, not with the module: app.py imports this module
+    # for its status functions and must stay cheap to import
+    from scipy.stats import chi2
+
+    return math.sqrt(chi2.ppf(LEVEL, 1))
+
+
+def lower_triangle(theta, p):
+    T = np.zeros((p, p))
+    T[np.tril_indices(p)] = theta
+    return T
+
+
+def tau(x, p):
+    T = lower_triangle(x[:-1], p)
+    return math.exp(x[-1]) * T @ T.T
+
+
+def neg2_reml(b, x):
+    # -2 REML log-likelihood at theta and s2; minimizing over log s2 alone
+    # gives back the profiled deviance. sparse_lmm brings pandas, patsy and
+    # scipy with it, so like scipy it is imported where it's used.
+    from Models.sparse_lmm import block_solve
+
+    s = block_solve(b, x[:-1])
+    return s["logdet_A"] + s["logdet_S"] + b["dof"] * (math.log(2 * math.pi) + x[-1]) + s["prss"] * math.exp(-x[-1])
+
+
+def _init_worker(records, fixed, x_hat, units):
+    from Models.compress import records_model
+    from Models.sparse_lmm import group_blocks
+
+    global _problem
+    b = group_blocks(records_model(records, fixed))
+    _problem = {"blocks": b, "p": len(fixed) + 1, "x_hat": x_hat, "dev_hat": neg2_reml(b, x_hat), "units": units}
+
+
+def next_value(k, l, direction, points, estimate):
+    # lme4's stepping: aim each step at the same rise in the signed root of
+    # the deviance increase, from its slope over the last step. Variances
+    # step on the sd scale and stop at zero.
+    to_scale = (lambda v: math.sqrt(max(v, 0))) if k == l else (lambda v: v)
+    units = _problem["units"]
+    unit = units[k] if k == l else units[k] * units[l]
+    previous = [(estimate, 0.0), *points][-2:]
+    (v0, d0), (v1, d1) = previous if len(previous) == 2 else (previous[0], previous[0])
+    step = unit * FIRST_STEP
+    if len(points) and to_scale(v1) != to_scale(v0):
+        slope = (math.sqrt(d1) - math.sqrt(d0)) / abs(to_scale(v1) - to_scale(v0))
+        last = abs(to_scale(v1) - to_scale(v0))
+        target = critical_root() / ZETA_STEPS
+        step = min(max(target / slope, last) if slope > 0 else last * MAX_GROWTH, last * MAX_GROWTH)
+    value = to_scale(v1) + direction * step
+    if k == l:
+        return max(value, 0.0) ** 2
+    return value
+
+
+def walk(k, l, direction):
+    from scipy.optimize import minimize
+
+    b, p, x = _problem["blocks"], _problem["p"], _problem["x_hat"].copy()
+    estimate = tau(x, p)[k, l]
+    diagonal = np.isin(np.arange(len(x) - 1), [i * (i + 3) // 2 for i in range(p)])
+    # s2 can't plausibly leave e^+-10 of its estimate; the bound keeps SLSQP's
+    # line search from overflowing on the way
+    bounds = [(0, None) if d else (None, None) for d in diagonal] + [(x[-1] - 10, x[-1] + 10)]
+    # Constraint in units of the parameter's scale, so it is neither
+    # negligible nor dominant next to the deviance
+    norm = _problem["units"][k] * _problem["units"][l]
+    crit = critical_root() ** 2
+    points = []
+    while len(points) < MAX_STEPS:
+        if k == l and direction < 0 and points and points[-1][0] == 0:
+            break
+        value = next_value(k, l, direction, points, estimate)
+        if k == l:
+            # Rescale row k so the warm start already meets the constraint
+            current = tau(x, p)[k, k]
+            if current > 0:
+                T = lower_triangle(x[:-1], p)
+                T[k] *= math.sqrt(value / current)
+                x = np.append(T[np.tril_indices(p)], x[-1])
+        constraint = {"type": "eq", "fun": lambda x, value=value: (tau(x, p)[k, l] - value) / norm}
+        try:
+            opt = minimize(lambda x: neg2_reml(b, x), x, method="SLSQP", bounds=bounds, constraints=[constraint],
+                           options={"ftol": 1e-9, "maxiter": 500})
+            # Flat directions (a covariance traded against two sds) can take
+            # SLSQP past its iteration limit; carry on from where it stopped
+            for _ in range(RESTARTS):
+                if opt.status != 9:
+                    break
+                opt = minimize(lambda x: neg2_reml(b, x), opt.x, method="SLSQP", bounds=bounds,
+                               constraints=[constraint], options={"ftol": 1e-9, "maxiter": 500})
+        except np.linalg.LinAlgError:
+            break
+        if not opt.success or abs(constraint["fun"](opt.x)) > 1e-6:
+            break
+        x = opt.x
+        points.append((float(value), float(max(opt.fun - _problem["dev_hat"], 0.0))))
+        if points[-1][1] > crit:
+            break
+    return k, l, direction, points
+
+
+def limit(estimate, points, boundary=None):
+    # Where the signed root of the deviance increase crosses the chi2(1)
+    # quantile, interpolated linearly between grid points. None means the
+    # walk never got there: the interval is open on that side.
+    root = critical_root()
+    previous = (estimate, 0.0)
+    for value, delta in points:
+        z = math.sqrt(delta)
+        if z >= root:
+            v0, z0 = previous[0], math.sqrt(previous[1])
+            return v0 + (root - z0) / (z - z0) * (value - v0)
+        previous = (value, delta)
+    if boundary is not None and points and points[-1][0] == boundary:
+        return boundary
+    return None
+
+
+def profile(data, workers=None, progress=None):
+    from Models.compress import compress, fit_best, records_model
+
+    records, _ = compress(data, PREDICTORS)
+    model = records_model(records, PREDICTORS)
+    result = fit_best(model, data, PREDICTORS)
+    p = len(PREDICTORS) + 1
+    x_hat = np.append(result.theta, math.log(result.scale))
+    cov = tau(x_hat, p)
+    # A parameter's grid unit is its sd, or for a variance estimated at zero
+    # a small fraction of the residual sd per unit of its predictor
+    w = records["count"].to_numpy(dtype=float)
+    rms = [1.0] + [math.sqrt(w @ records[c].to_numpy(dtype=float) ** 2 / w.sum()) for c in PREDICTORS]
+    units = np.array([max(math.sqrt(max(cov[k, k], 0)), 1e-3 * math.sqrt(result.scale) / rms[k]) for k in range(p)])
+
+    names = model.terms[0].columns
+    tasks = [(k, l, d) for k in range(p) for l in range(k + 1) for d in (-1, 1)]
+    walks = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(records, PREDICTORS, x_hat, units)) as pool:
+        futures = [pool.submit(walk, *task) for task in tasks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            k, l, direction, points = future.result()
+            walks[k, l, direction] = points
+            if progress is not None:
+                progress(done, len(tasks))
+
+    parameters = []
+    for k in range(p):
+        for l in range(k + 1):
+            estimate = float(cov[k, l])
+            below, above = walks[k, l, -1], walks[k, l, 1]
+            parameters.append({
+                "terms": [names[k], names[l]],
+                "estimate": estimate,
+                "lower": limit(estimate, below, boundary=0.0 if k == l else None),
+                "upper": limit(estimate, above),
+                "profile": sorted([(v, d) for v, d in below + above] + [(estimate, 0.0)]),
+            })
+    return {"level": LEVEL, "llf": float(result.llf), "scale": float(result.scale), "parameters": parameters}
+
+
+def profile_path(digest):
+    return os.path.join(CACHE_DIR, f"profile-{digest[:16]}-f{PROFILE_FORMAT}.json")
+
+
+def load_profile(digest):
+    try:
+        with open(profile_path(digest)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def profile_status(digest):
+    if os.path.exists(profile_path(digest)):
+        return {"state": "done"}
+    try:
+        with open(profile_path(digest) + ".progress") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"state": "idle"}
+
+
+def start_profile(data_file, workers=None, version=None):
+    # Same arrangement as Models/subsets.py: its own process, and the CLI's
+    # lock makes a second start a no-op.
+    cmd = [sys.executable, "-m", "Models.profile", "--data", data_file]
+    if workers:
+        cmd += ["--workers", str(workers)]
+    if version:
+        cmd += ["--version", version]
+    return subprocess.Popen(cmd, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def main():
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Profile-likelihood intervals for model_full's variance components.")
+    parser.add_argument("--data", default="Data/masters_salary.csv")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--version", help="save under this dataset version instead of the file's hash (the app "
+                                          "passes an uploaded store's, whose CSV it wrote back out)")
+    parser.add_argument("--force", action="store_true", help="recompute even if the intervals are saved")
+    args = parser.parse_args()
+
+    with open(args.data, "rb") as f:
+        raw = f.read()
+    digest = args.version or file_digest(args.data)
+    out_path = profile_path(digest)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(out_path + ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            sys.exit("profiling for this dataset is already running")
+        result = load_profile(digest)
+        if result is None or args.force:
+            def progress(done, total):
+                write_json(out_path + ".progress", {"state": "running", "done": done, "total": total})
+
+            t0 = time.perf_counter()
+            try:
+                result = profile(pd.read_csv(io.BytesIO(raw)), args.workers, progress)
+            except Exception as exc:
+                write_json(out_path + ".progress", {"state": "error", "error": f"{type(exc).__name__}: {exc}"})
+                raise
+            result.update(version=digest, format=PROFILE_FORMAT, built_at=time.time(),
+                          seconds=time.perf_counter() - t0, workers=args.workers or os.cpu_count())
+            write_json(out_path, result)
+            os.remove(out_path + ".progress")
+
+    print(f"{result['level']:.0%} profile-likelihood intervals, REML log-likelihood {result['llf']:.2f}, "
+          f"{result['seconds']:.1f}s on {result['workers']} processes")
+    print(f"{'parameter':<44} {'estimate':>14} {'lower':>14} {'upper':>14}")
+    for entry in result["parameters"]:
+        a, b = entry["terms"]
+        name = f"var({a})" if a == b else f"cov({a}, {b})"
+        bounds = ["-" if v is None else f"{v:.4g}" for v in (entry["lower"], entry["upper"])]
+        print(f"{name:<44} {entry['estimate']:>14.4g} {bounds[0]:>14} {bounds[1]:>14}")
+
+
+if __name__ == "__main__":
+    main()
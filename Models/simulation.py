@@ -0,0 +1,287 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import time
+import warnings
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from refresh import CACHE_DIR
+
+# Monte Carlo study of the mixed models on data from Data/DataCreation.py:
+# every setting of the generator's knobs gets `replicates` datasets, each
+# fitted with every model, and the estimates are compared with the values the
+# generator used. Results are appended to a JSON-lines checkpoint as they
+# finish, so an interrupted study picks up where it stopped.
+
+STUDY_DIR = os.path.join(CACHE_DIR, "simulation")
+
+# Knobs a study can sweep (see generate()). The target spreads scale how far
+# each school's GPA / experience target sits from the average of the targets:
+# 0 gives every school the same target, 1 is the dataset as shipped.
+KNOBS = {
+    "n_per_uni": int,
+    "uni_intercept_sd": float,
+    "salary_noise_sd": float,
+    "gpa_within_sd": float,
+    "exp_within_sd": float,
+    "gpa_target_spread": float,
+    "exp_target_spread": float,
+}
+
+# Spec as in Models/subsets.py: 1 = fixed effect, 2 = fixed with a random
+# slope by university. "full" is the model in graphs.py.
+MODELS = {
+    "ols": None,
+    "intercept": (1, 1, 1, 1),
+    "full": (2, 2, 2, 2),
+}
+DEFAULT_MODELS = ["ols", "intercept"]
+
+# What generate() builds the salary from. relevant_work_years enters as
+# 4000 * x + 10000 * log1p(x), which has no single linear coefficient, so it
+# is estimated but not scored.
+TRUE_COEFFICIENTS = {"masters_gpa": 35_000, "years_python": 1_500, "years_sql": 1_000}
+Z95 = 1.959963984540054
+
+
+def settings(grid):
+    # Every combination of the swept values; the key names the setting in
+    # checkpoints and seeds, so it must not depend on the other settings.
+    names = sorted(grid)
+    for values in itertools.product(*(grid[n] for n in names)):
+        params = dict(zip(names, values))
+        yield ",".join(f"{n}={v:g}" for n, v in params.items()) or "default", params
+
+
+def replicate_seed(seed, key, rep):
+    # The same child SeedSequence.spawn() would give, keyed by the setting's
+    # name instead of its position, so adding a setting or replicates to a
+    # study leaves every existing replicate's data unchanged.
+    return np.random.SeedSequence(seed, spawn_key=(zlib.crc32(key.encode()), rep))
+
+
+def simulate(params, seed):
+    from Data import DataCreation as dc
+
+    def spread(targets, scale):
+        center = np.mean(list(targets.values()))
+        return {u: center + scale * (t - center) for u, t in targets.items()}
+
+    kwargs = {k: v for k, v in params.items() if k in KNOBS and not k.endswith("_target_spread")}
+    return dc.generate(seed=seed, gpa_targets=spread(dc.gpa_targets, params.get("gpa_target_spread", 1)),
+                       work_exp_targets=spread(dc.work_exp_targets, params.get("exp_target_spread", 1)), **kwargs)
+
+
+def truth(params):
+    from Data import DataCreation as dc
+
+    values = {f"beta_{name}": value for name, value in TRUE_COEFFICIENTS.items()}
+    values["intercept_sd"] = params.get("uni_intercept_sd", dc.uni_intercept_sd)
+    values["residual_sd"] = params.get("salary_noise_sd", dc.salary_noise_sd)
+    return values
+
+
+def fit_model(name, endog, exog, groups):
+    from statsmodels.regression.linear_model import OLS
+    from statsmodels.regression.mixed_linear_model import MixedLM
+    from Models.fitting import fit_mixedlm
+    from Models.subsets import PREDICTORS, columns
+
+    spec = MODELS[name]
+    if spec is None:
+        result = OLS(endog, exog).fit()
+        fe = PREDICTORS
+        estimates = {"residual_sd": math.sqrt(result.scale)}
+        converged = True
+    else:
+        fe_cols, re_cols = columns(spec)
+        result = fit_mixedlm(MixedLM(endog, exog[:, fe_cols], groups, exog_re=exog[:, re_cols]), name=f"sim {name}")
+        fe = [PREDICTORS[c - 1] for c in fe_cols[1:]]
+        # Wald interval for the intercept variance from the (scale-free)
+        # covariance parameter; it can cross zero, which is part of the story.
+        scale = result.scale
+        variance = float(np.asarray(result.cov_re)[0, 0])
+        # At a singular covariance the Hessian is no use for an interval
+        var_param = np.asarray(result.cov_params())[result.k_fe, result.k_fe]
+        se = math.sqrt(var_param) if var_param > 0 else math.nan
+        estimates = {"intercept_sd": math.sqrt(max(variance, 0)), "residual_sd": math.sqrt(scale)}
+        converged = bool(result.converged)
+    params = np.asarray(result.params)
+    ci = np.asarray(result.conf_int())
+    intervals = {}
+    for i, predictor in enumerate(fe, start=1):
+        estimates[f"beta_{predictor}"] = float(params[i])
+        intervals[f"beta_{predictor}"] = [float(ci[i, 0]), float(ci[i, 1])]
+    if spec is not None and np.isfinite(se):
+        lo, hi = scale * (variance / scale - Z95 * se), scale * (variance / scale + Z95 * se)
+        intervals["intercept_sd"] = [math.sqrt(max(lo, 0)), math.sqrt(max(hi, 0))]
+    return estimates, intervals, converged
+
+
+def run_replicate(key, params, rep, seed, models):
+    from statsmodels.tools.sm_exceptions import ConvergenceWarning
+    from Models.fitting import FitFailed
+    from Models.subsets import design
+
+    # Convergence is recorded per fit, not warned about
+    warnings.filterwarnings("ignore", category=ConvergenceWarning)
+    warnings.filterwarnings("ignore", message="Random effects covariance is singular")
+    endog, exog, groups = design(simulate(params, replicate_seed(seed, key, rep)))
+    records = []
+    for name in models:
+        record = {"setting": key, "params": params, "rep": rep, "model": name, "converged": False,
+                  "estimates": {}, "intervals": {}, "error": None}
+        t0 = time.perf_counter()
+        try:
+            record["estimates"], record["intervals"], record["converged"] = fit_model(name, endog, exog, groups)
+        except (FitFailed, np.linalg.LinAlgError, ValueError) as exc:
+            record["error"] = f"{type(exc).__name__}: {exc}"
+        record["seconds"] = time.perf_counter() - t0
+        records.append(record)
+    return records
+
+
+def load_checkpoint(path):
+    done = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by an interrupted run
+                done[(record["setting"], record["rep"], record["model"])] = record
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def run_study(path, grid, replicates, models, seed=2024, workers=None, progress=None):
+    done = load_checkpoint(path)
+    tasks = []
+    for key, params in settings(grid):
+        for rep in range(replicates):
+            missing = [m for m in models if (key, rep, m) not in done]
+            if missing:
+                tasks.append((key, params, rep, seed, missing))
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    finished = 0
+    with open(path, "a") as checkpoint, ProcessPoolExecutor(max_workers=workers) as pool:
+        if checkpoint.tell() and not _ends_with_newline(path):
+            checkpoint.write("\n")
+        # Keep a couple of replicates per worker in flight rather than every
+        # task at once, so an interrupt loses little and memory stays flat.
+        pending = set()
+        queue = iter(tasks)
+        limit = 2 * (workers or os.cpu_count() or 1)
+        while True:
+            for task in itertools.islice(queue, limit - len(pending)):
+                pending.add(pool.submit(run_replicate, *task))
+            if not pending:
+                break
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                for record in future.result():
+                    checkpoint.write(json.dumps(record) + "\n")
+                    done[(record["setting"], record["rep"], record["model"])] = record
+                checkpoint.flush()
+                finished += 1
+                if progress is not None:
+                    progress(finished, len(tasks))
+    return done
+
+
+def summarize(records, grid, models):
+    rows = []
+    for key, params in settings(grid):
+        true = truth(params)
+        for name in models:
+            fits = [r for r in records if r["setting"] == key and r["model"] == name]
+            ok = [r for r in fits if r["error"] is None]
+            for estimand in sorted({e for r in ok for e in r["estimates"]}):
+                values = np.array([r["estimates"][estimand] for r in ok if estimand in r["estimates"]])
+                intervals = [r["intervals"][estimand] for r in ok if estimand in r["intervals"]]
+                target = true.get(estimand)
+                row = {"setting": key, "model": name, "estimand": estimand, "reps": len(fits),
+                       "failed": len(fits) - len(ok), "converged": sum(r["converged"] for r in ok) / max(len(ok), 1),
+                       "seconds": float(np.mean([r["seconds"] for r in fits])), "truth": target,
+                       "mean": float(values.mean()), "sd": float(values.std(ddof=1)) if len(values) > 1 else math.nan,
+                       "bias": math.nan, "rel_bias": math.nan, "rmse": math.nan, "coverage": math.nan,
+                       "coverage_se": math.nan}
+                if target is not None:
+                    row["bias"] = float(values.mean() - target)
+                    row["rel_bias"] = row["bias"] / target
+                    row["rmse"] = float(np.sqrt(np.mean((values - target) ** 2)))
+                    if intervals:
+                        covered = np.mean([lo <= target <= hi for lo, hi in intervals])
+                        row["coverage"] = float(covered)
+                        row["coverage_se"] = math.sqrt(covered * (1 - covered) / len(intervals))
+                rows.append(row)
+    return rows
+
+
+def parse_grid(pairs):
+    grid = {}
+    for pair in pairs or []:
+        name, _, values = pair.partition("=")
+        if name not in KNOBS or not values:
+            raise SystemExit(f"--set expects one of {', '.join(KNOBS)} as name=v1,v2,...; got {pair!r}")
+        grid[name] = [KNOBS[name](v) for v in values.split(",")]
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo study of the mixed models on simulated data.")
+    parser.add_argument("--set", action="append", metavar="KNOB=V1,V2",
+                        help=f"sweep a generator knob ({', '.join(KNOBS)}); repeat for a grid")
+    parser.add_argument("--replicates", type=int, default=100)
+    parser.add_argument("--models", nargs="+", choices=list(MODELS), default=DEFAULT_MODELS)
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--study", default="default", help=f"checkpoint name under {STUDY_DIR}")
+    parser.add_argument("--report-only", action="store_true", help="summarize the checkpoint without fitting")
+    parser.add_argument("--csv", help="also write the summary table here")
+    args = parser.parse_args()
+
+    grid = parse_grid(args.set)
+    path = os.path.join(STUDY_DIR, f"{args.study}-seed{args.seed}.jsonl")
+    t0 = time.perf_counter()
+    if args.report_only:
+        records = load_checkpoint(path)
+    else:
+        def progress(done, total):
+            print(f"\r{done}/{total} replicates ({time.perf_counter() - t0:.0f}s)", end="", flush=True)
+
+        records = run_study(path, grid, args.replicates, args.models, args.seed, args.workers, progress)
+        print()
+    reps = set(range(args.replicates))
+    rows = summarize([r for r in records.values() if r["rep"] in reps], grid, args.models)
+
+    print(f"{'setting':<32} {'model':<9} {'estimand':<24} {'n':>4} {'truth':>9} {'mean':>9} {'bias':>8} "
+          f"{'rel':>6} {'sd':>8} {'cover':>6} {'conv':>5} {'s/fit':>6}")
+    for r in rows:
+        truth_text = f"{r['truth']:>9,.0f}" if r["truth"] is not None else f"{'-':>9}"
+        cover = f"{r['coverage']:>6.1%}" if not math.isnan(r["coverage"]) else f"{'-':>6}"
+        bias = f"{r['bias']:>8,.0f} {r['rel_bias']:>6.1%}" if not math.isnan(r["bias"]) else f"{'-':>8} {'-':>6}"
+        print(f"{r['setting'][:32]:<32} {r['model']:<9} {r['estimand']:<24} {r['reps'] - r['failed']:>4} {truth_text} "
+              f"{r['mean']:>9,.0f} {bias} {r['sd']:>8,.0f} {cover} {r['converged']:>5.0%} {r['seconds']:>6.2f}")
+    print(f"checkpoint: {path}")
+    if args.csv:
+        import pandas as pd
+
+        pd.DataFrame(rows).to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
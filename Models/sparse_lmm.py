@@ -0,0 +1,381 @@
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import patsy
+import scipy.sparse as sp
+from scipy.optimize import minimize
+from scipy.sparse.linalg import splu
+
+try:
+    from sksparse.cholmod import analyze as cholmod_analyze
+except ImportError:
+    cholmod_analyze = None
+
+# Linear mixed model with any number of crossed or nested random-effect terms,
+# fitted the way lme4 does it:
+#
+#   y = X beta + Z b + e,   b = Lambda(theta) u,   u ~ N(0, s2 I),   e ~ N(0, s2 I)
+#
+# Z is sparse (one block of columns per term and level), so Z'Z only has a
+# non-zero for each pair of levels that share a graduate. For every theta the
+# profiled (RE)ML deviance needs one sparse factorization of
+#
+#   A = Lambda' Z'Z Lambda + I
+#
+# plus a handful of solves; beta, u and s2 then have closed forms. Nothing here
+# is ever the size of the product of the factor levels.
+
+TERM = re.compile(r"\(([^()|]+)\|([^()|]+)\)")
+
+
+def parse_random(random):
+    terms = []
+    for lhs, group in TERM.findall(random):
+        lhs, group = lhs.strip(), group.strip()
+        if "/" in group:
+            # (1 | a/b) is (1 | a) + (1 | a:b): b nested within a
+            parts = [p.strip() for p in group.split("/")]
+            for i in range(1, len(parts) + 1):
+                terms.append((lhs, ":".join(parts[:i])))
+        else:
+            terms.append((lhs, group))
+    if not terms:
+        raise ValueError(f"no random-effect terms like '(1 | group)' in {random!r}")
+    return terms
+
+
+def group_keys(data, group):
+    cols = [c.strip() for c in group.split(":")]
+    keys = data[cols[0]].astype(str)
+    for col in cols[1:]:
+        keys = keys + ":" + data[col].astype(str)
+    return keys
+
+
+def group_codes(data, group):
+    codes, levels = pd.factorize(group_keys(data, group), sort=True)
+    return codes, np.asarray(levels, dtype=object)
+
+
+class RandomTerm:
+    def __init__(self, lhs, group, data):
+        self.lhs = lhs
+        self.group = group
+        self.codes, self.levels = group_codes(data, group)
+        design = patsy.dmatrix(lhs, data, return_type="dataframe")
+        self.columns = ["Group" if c == "Intercept" else c for c in design.columns]
+        self.design_info = design.design_info
+        self.X = design.to_numpy(dtype=float)
+
+    @property
+    def name(self):
+        return f"{self.lhs} | {self.group}"
+
+    @property
+    def p(self):
+        return self.X.shape[1]
+
+    @property
+    def q(self):
+        return len(self.levels) * self.p
+
+    @property
+    def n_theta(self):
+        return self.p * (self.p + 1) // 2
+
+    def Z(self, X=None, codes=None):
+        X = self.X if X is None else X
+        codes = self.codes if codes is None else codes
+        n, p = X.shape
+        rows = np.repeat(np.arange(n), p)
+        cols = (codes[:, None] * p + np.arange(p)[None, :]).ravel()
+        keep = cols >= 0  # unseen levels (code -1) get no random effect
+        return sp.csc_matrix((X.ravel()[keep], (rows[keep], cols[keep])), shape=(n, self.q))
+
+
+class SparseFactor:
+    # CHOLMOD when scikit-sparse is installed: the symbolic analysis (fill-
+    # reducing ordering and elimination tree) is done once and every theta is
+    # a numeric refactorization into the same structure. Otherwise fall back
+    # to SuperLU with a symmetric ordering, which is still sparse.
+
+    def __init__(self, pattern):
+        self._symbolic = cholmod_analyze(pattern) if cholmod_analyze is not None else None
+        self._lu = None
+
+    def factor(self, A):
+        if self._symbolic is not None:
+            self._symbolic.cholesky_inplace(A)
+            return self._symbolic.logdet()
+        self._lu = splu(A.tocsc(), permc_spec="MMD_AT_PLUS_A",
+                        options=dict(SymmetricMode=True, DiagPivotThresh=0.0))
+        return float(np.sum(np.log(np.abs(self._lu.U.diagonal()))))
+
+    def solve(self, b):
+        if self._symbolic is not None:
+            return self._symbolic(b)
+        return self._lu.solve(b)
+
+    @property
+    def backend(self):
+        return "cholmod" if self._symbolic is not None else "superlu"
+
+
+class SparseMixedLM:
+    # weights are frequency weights: row i stands for weights[i] graduates
+    # with the same predictors whose salaries average y_i. yty is then the
+    # sum of their squared salaries (see Models/compress.py), which the
+    # weighted rows alone can't give; with both the fit is exactly the one on
+    # the uncompressed rows.
+
+    def __init__(self, formula, data, random, reml=True, weights=None, yty=None):
+        self.formula = formula
+        self.random = random
+        self.reml = reml
+        y, X = patsy.dmatrices(formula, data, return_type="dataframe")
+        self.endog_name = y.columns[0]
+        self.exog_names = list(X.columns)
+        self.fe_design_info = X.design_info
+        self.y = y.to_numpy(dtype=float).ravel()
+        self.X = X.to_numpy(dtype=float)
+        # patsy drops rows with missing values; keep the terms on the same rows
+        rows = data.loc[y.index]
+        self.terms = [RandomTerm(lhs, group, rows) for lhs, group in parse_random(random)]
+        self.Z = sp.hstack([t.Z() for t in self.terms], format="csc")
+        self.n, self.p = self.X.shape
+        self.q = self.Z.shape[1]
+        w = np.ones(self.n) if weights is None else np.asarray(weights, dtype=float)[data.index.get_indexer(y.index)]
+        if weights is not None:
+            self.n = int(round(w.sum()))
+
+        # Every product involving n is formed once; the deviance only touches
+        # q- and p-sized objects.
+        wX = self.X * w[:, None]
+        self.ZtZ = (self.Z.T @ sp.diags(w) @ self.Z).tocsc()
+        self.ZtX = np.asarray((self.Z.T @ wX))
+        self.Zty = np.asarray(self.Z.T @ (w * self.y)).ravel()
+        self.XtX = self.X.T @ wX
+        self.Xty = wX.T @ self.y
+        self.yty = float((w * self.y) @ self.y) if yty is None else float(yty)
+
+        self.Lambda, self.lind = self._lambda_template()
+        # Only the diagonal of each relative covariance factor is bounded (>= 0)
+        diagonal = np.concatenate([np.isin(np.arange(t.n_theta), tri_diag(t.p)) for t in self.terms])
+        self.lower = np.where(diagonal, 0.0, -np.inf)
+        self._diagonal = diagonal
+        self.identity = sp.identity(self.q, format="csc")
+        self._factor = SparseFactor(self._A(self.theta0()))
+
+    def _lambda_template(self):
+        rows, cols, vals = [], [], []
+        offset = 0
+        theta_offset = 0
+        for t in self.terms:
+            i, j = np.tril_indices(t.p)
+            levels = np.arange(len(t.levels))[:, None] * t.p
+            rows.append((offset + levels + i[None, :]).ravel())
+            cols.append((offset + levels + j[None, :]).ravel())
+            vals.append(np.tile(theta_offset + np.arange(t.n_theta), len(t.levels)) + 1)
+            offset += t.q
+            theta_offset += t.n_theta
+        Lambda = sp.csc_matrix((np.concatenate(vals).astype(float),
+                                (np.concatenate(rows), np.concatenate(cols))), shape=(self.q, self.q))
+        lind = Lambda.data.astype(int) - 1
+        return Lambda, lind
+
+    def theta0(self):
+        return self._diagonal.astype(float)
+
+    def _A(self, theta):
+        self.Lambda.data[:] = theta[self.lind]
+        return (self.Lambda.T @ self.ZtZ @ self.Lambda + self.identity).tocsc()
+
+    def solve(self, theta):
+        logdet_A = self._factor.factor(self._A(theta))
+        LtZtX = np.asarray(self.Lambda.T @ self.ZtX)
+        LtZty = self.Lambda.T @ self.Zty
+        M = self._factor.solve(LtZtX)
+        m = self._factor.solve(LtZty)
+        S = self.XtX - LtZtX.T @ M
+        beta = np.linalg.solve(S, self.Xty - LtZtX.T @ m)
+        u = m - M @ beta
+        # Penalized RSS at the joint solution, from the cross-products alone
+        prss = self.yty - u @ LtZty - beta @ self.Xty
+        logdet_S = np.linalg.slogdet(S)[1]
+        return {"beta": beta, "u": u, "prss": max(prss, 1e-300), "logdet_A": logdet_A,
+                "logdet_S": logdet_S, "S": S}
+
+    def deviance(self, theta, reml=None):
+        reml = self.reml if reml is None else reml
+        s = self.solve(theta)
+        if reml:
+            dof = self.n - self.p
+            return s["logdet_A"] + s["logdet_S"] + dof * (1 + np.log(2 * np.pi * s["prss"] / dof))
+        return s["logdet_A"] + self.n * (1 + np.log(2 * np.pi * s["prss"] / self.n))
+
+    def fit(self, start=None, method="L-BFGS-B", maxiter=1000):
+        start_time = time.perf_counter()
+        x0 = self.theta0() if start is None else np.asarray(start, dtype=float)
+        bounds = [(lo if np.isfinite(lo) else None, None) for lo in self.lower]
+        opt = minimize(self.deviance, x0, method=method, bounds=bounds, options={"maxiter": maxiter})
+        return SparseMixedLMResults(self, opt.x, opt, time.perf_counter() - start_time)
+
+
+def group_blocks(model):
+    # With a single grouping factor A = Lambda' Z'Z Lambda + I is block
+    # diagonal, one p x p block per level. For the handful of levels here,
+    # dense batched algebra on the blocks is far cheaper than the sparse
+    # factorization, which matters when a deviance is evaluated thousands of
+    # times (Models/profile.py, Models/permutation.py). The y-dependent
+    # entries (Zty, Xty, yty) can be swapped for another response's.
+    term, = model.terms
+    G, p = len(term.levels), term.p
+    ZtZ = model.ZtZ.toarray().reshape(G, p, G, p)
+    return {"ZtZ": ZtZ[np.arange(G), :, np.arange(G), :], "ZtX": model.ZtX.reshape(G, p, -1),
+            "Zty": model.Zty.reshape(G, p), "XtX": model.XtX, "Xty": model.Xty, "yty": model.yty,
+            "p": p, "dof": model.n - model.p if model.reml else model.n, "reml": model.reml}
+
+
+def block_solve(blocks, theta):
+    # SparseMixedLM.solve() one block at a time
+    T = np.zeros((blocks["p"], blocks["p"]))
+    T[np.tril_indices(blocks["p"])] = theta
+    A = T.T @ blocks["ZtZ"] @ T + np.eye(blocks["p"])
+    L = np.linalg.cholesky(A)
+    LtZtX = T.T @ blocks["ZtX"]
+    LtZty = blocks["Zty"] @ T
+    M = np.linalg.solve(A, LtZtX)
+    m = np.linalg.solve(A, LtZty[..., None])[..., 0]
+    S = blocks["XtX"] - np.einsum("gki,gkj->ij", LtZtX, M)
+    beta = np.linalg.solve(S, blocks["Xty"] - np.einsum("gki,gk->i", LtZtX, m))
+    u = m - M @ beta
+    prss = max(blocks["yty"] - np.sum(u * LtZty) - beta @ blocks["Xty"], 1e-300)
+    return {"beta": beta, "u": u, "prss": prss, "logdet_A": 2 * np.log(np.diagonal(L, axis1=1, axis2=2)).sum(),
+            "logdet_S": np.linalg.slogdet(S)[1], "S": S}
+
+
+def block_deviance(blocks, theta):
+    s = block_solve(blocks, theta)
+    dof = blocks["dof"]
+    deviance = s["logdet_A"] + dof * (1 + np.log(2 * np.pi * s["prss"] / dof))
+    return deviance + s["logdet_S"] if blocks["reml"] else deviance
+
+
+def block_fit(blocks, starts):
+    # Best deviance over the starts; L-BFGS-B with the diagonal of the
+    # relative covariance factor kept non-negative
+    p = blocks["p"]
+    bounds = [(0, None) if i in tri_diag(p) else (None, None) for i in range(p * (p + 1) // 2)]
+    best = None
+    for start in starts:
+        opt = minimize(lambda theta: block_deviance(blocks, theta), start, method="L-BFGS-B", bounds=bounds)
+        if best is None or opt.fun < best.fun:
+            best = opt
+    return best
+
+
+def tri_diag(p):
+    # positions of the diagonal of a p x p lower triangle in row-major tril order
+    i, j = np.tril_indices(p)
+    return np.flatnonzero(i == j)
+
+
+class SparseMixedLMResults:
+    def __init__(self, model, theta, opt, fit_time):
+        self.model = model
+        self.theta = theta
+        self.converged = bool(opt.success)
+        self.n_iter = int(getattr(opt, "nit", 0))
+        self.fit_time = fit_time
+        self.reml = model.reml
+
+        s = model.solve(theta)
+        dof = model.n - model.p if model.reml else model.n
+        self.scale = s["prss"] / dof
+        self.llf = -0.5 * model.deviance(theta)
+        self.fe_params = pd.Series(s["beta"], index=model.exog_names)
+        self.cov_params = pd.DataFrame(self.scale * np.linalg.inv(s["S"]),
+                                       index=model.exog_names, columns=model.exog_names)
+        self.bse_fe = pd.Series(np.sqrt(np.diag(self.cov_params)), index=model.exog_names)
+
+        model.Lambda.data[:] = theta[model.lind]
+        b = model.Lambda @ s["u"]
+        self._b = b
+        self.random_effects = {}
+        self.cov_re = {}
+        offset = 0
+        theta_offset = 0
+        for t in model.terms:
+            block = b[offset:offset + t.q].reshape(len(t.levels), t.p)
+            self.random_effects[t.name] = pd.DataFrame(block, index=t.levels, columns=t.columns)
+            T = np.zeros((t.p, t.p))
+            T[np.tril_indices(t.p)] = theta[theta_offset:theta_offset + t.n_theta]
+            self.cov_re[t.name] = pd.DataFrame(self.scale * T @ T.T, index=t.columns, columns=t.columns)
+            offset += t.q
+            theta_offset += t.n_theta
+
+        self.nnz = {"Z": int(model.Z.nnz), "ZtZ": int(model.ZtZ.nnz), "q": int(model.q), "n": int(model.n)}
+        self.solver = model._factor.backend
+
+    @property
+    def fittedvalues(self):
+        return self.model.X @ self.fe_params.to_numpy() + self.model.Z @ self._b
+
+    @property
+    def resid(self):
+        return self.model.y - self.fittedvalues
+
+    def predict(self, data=None):
+        if data is None:
+            return self.fittedvalues
+        X = patsy.build_design_matrices([self.model.fe_design_info], data, return_type="matrix")[0]
+        pred = np.asarray(X) @ self.fe_params.to_numpy()
+        for t in self.model.terms:
+            Xt = np.asarray(patsy.build_design_matrices([t.design_info], data, return_type="matrix")[0])
+            codes = pd.Index(t.levels).get_indexer(group_keys(data, t.group))
+            effects = self.random_effects[t.name].to_numpy()
+            known = codes >= 0
+            pred[known] += np.einsum("ij,ij->i", Xt[known], effects[codes[known]])
+        return pred
+
+    def summary(self):
+        lines = [
+            f"Sparse mixed model ({'REML' if self.reml else 'ML'}, {self.solver})",
+            f"  {self.model.formula}   random: {self.model.random}",
+            f"  n = {self.nnz['n']}, random effects = {self.nnz['q']}, nnz(Z) = {self.nnz['Z']}, nnz(Z'Z) = {self.nnz['ZtZ']}",
+            f"  log-likelihood = {self.llf:.3f}, scale = {self.scale:.4g}, converged = {self.converged}, "
+            f"{self.n_iter} iterations in {self.fit_time:.2f}s",
+            "",
+            "Fixed effects:",
+        ]
+        for name, value in self.fe_params.items():
+            lines.append(f"  {name:<28} {value:>14.3f}  (se {self.bse_fe[name]:.3f})")
+        lines.append("")
+        lines.append("Random effects (variances / covariances):")
+        for term, cov in self.cov_re.items():
+            lines.append(f"  ({term}), {len(self.random_effects[term])} levels")
+            for row in cov.index:
+                lines.append("    " + "  ".join(f"{cov.loc[row, col]:>14.4g}" for col in cov.columns) + f"   {row}")
+        lines.append(f"  residual variance {self.scale:.4g}")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    import tracemalloc
+
+    parser = argparse.ArgumentParser(description="Fit a crossed/nested mixed model with sparse random effects.")
+    parser.add_argument("data_file")
+    parser.add_argument("--formula", default="first_job_salary ~ masters_gpa + relevant_work_years + years_python + years_sql")
+    parser.add_argument("--random", default="(1 | masters_university) + (1 | graduation_cohort) + (1 | masters_university:graduation_cohort)")
+    parser.add_argument("--ml", action="store_true", help="maximum likelihood instead of REML")
+    args = parser.parse_args()
+
+    data = pd.read_csv(args.data_file)
+    tracemalloc.start()
+    result = SparseMixedLM(args.formula, data, args.random, reml=not args.ml).fit()
+    peak = tracemalloc.get_traced_memory()[1]
+    print(result.summary())
+    print(f"\npeak traced memory during fit: {peak / 2**20:.1f} MiB")
@@ -0,0 +1,249 @@
+import argparse
+import fcntl
+import io
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from refresh import CACHE_DIR, file_digest, write_json
+
+PREDICTORS = ["masters_gpa", "relevant_work_years", "years_python", "years_sql"]
+# Each predictor is left out (0), a fixed effect (1) or a fixed effect with a
+# random slope by university (2); every model has a random intercept.
+ROLES = ("excluded", "fixed", "random")
+# Models with different fixed effects are only comparable by ML, not REML.
+ML_CHAIN = [("bfgs", False), ("lbfgs", False), ("nm", False), ("powell", False)]
+LEADERBOARD_FORMAT = 1
+
+_design = None
+
+
+def all_specs():
+    return list(itertools.product(range(len(ROLES)), repeat=len(PREDICTORS)))
+
+
+def spec_terms(spec):
+    fixed = [p for p, role in zip(PREDICTORS, spec) if role >= 1]
+    random = [p for p, role in zip(PREDICTORS, spec) if role == 2]
+    return fixed, random
+
+
+def spec_formulas(spec):
+    fixed, random = spec_terms(spec)
+    return "first_job_salary ~ " + (" + ".join(fixed) or "1"), "~" + (" + ".join(random) or "1")
+
+
+def design(data):
+    endog = data["first_job_salary"].to_numpy(dtype=float)
+    exog = np.column_stack([np.ones(len(data))] + [data[p].to_numpy(dtype=float) for p in PREDICTORS])
+    return endog, exog, data["masters_university"].to_numpy()
+
+
+def _init_worker(endog, exog, groups):
+    # Each worker process receives the full design matrix once; every model
+    # is a column subset of it, so nothing goes through patsy per fit.
+    from statsmodels.tools.sm_exceptions import ConvergenceWarning
+
+    global _design
+    _design = (endog, exog, groups)
+    # Convergence is recorded per model in the leaderboard; a singular random
+    # effects covariance is expected for slopes that don't vary by university.
+    warnings.filterwarnings("ignore", category=ConvergenceWarning)
+    warnings.filterwarnings("ignore", message="Random effects covariance is singular")
+
+
+def columns(spec):
+    fe = [0] + [i + 1 for i, role in enumerate(spec) if role >= 1]
+    re = [0] + [i + 1 for i, role in enumerate(spec) if role == 2]
+    return fe, re
+
+
+def warm_start(spec, results, exog):
+    # Start from the best fitted model with one term fewer: its fixed effects
+    # and (scale-free) random effects covariance, with zero for a new fixed
+    # effect and a small variance for a new random slope.
+    parents = []
+    for i, role in enumerate(spec):
+        if role:
+            parent = results.get(spec[:i] + (role - 1,) + spec[i + 1:])
+            if parent is not None and parent["llf"] is not None:
+                parents.append(parent)
+    if not parents:
+        return None
+    parent = max(parents, key=lambda r: r["llf"])
+    parent_fe, parent_re = columns(tuple(parent["spec"]))
+    fe, re = columns(spec)
+    fe_params = np.array([parent["fe"][parent_fe.index(c)] if c in parent_fe else 0.0 for c in fe])
+    parent_cov = np.array(parent["cov_re"])
+    cov_re = np.zeros((len(re), len(re)))
+    for a, ca in enumerate(re):
+        for b, cb in enumerate(re):
+            if ca in parent_re and cb in parent_re:
+                cov_re[a, b] = parent_cov[parent_re.index(ca), parent_re.index(cb)]
+        if ca not in parent_re:
+            cov_re[a, a] = 0.01 / max(exog[:, ca].var(), 1e-12)
+    return {"fe": fe_params.tolist(), "cov_re": cov_re.tolist()}
+
+
+def fit_spec(spec, start=None):
+    from statsmodels.regression.mixed_linear_model import MixedLM, MixedLMParams
+    from Models.fitting import FitFailed, fit_mixedlm
+
+    endog, exog, groups = _design
+    fe, re = columns(spec)
+    formula, re_formula = spec_formulas(spec)
+    entry = {"spec": list(spec), "formula": formula, "re_formula": re_formula, "llf": None, "aic": None,
+             "bic": None, "df": None, "converged": False, "method": None, "warm": start is not None,
+             "seconds": 0.0, "error": None}
+    t0 = time.perf_counter()
+    model = MixedLM(endog, exog[:, fe], groups, exog_re=exog[:, re])
+    start_params = None
+    if start is not None:
+        start_params = MixedLMParams.from_components(np.array(start["fe"]), cov_re=np.array(start["cov_re"]))
+    try:
+        result = fit_mixedlm(model, name=f"{formula} | {re_formula}", chain=ML_CHAIN, start_params=start_params)
+    except FitFailed as exc:
+        entry["error"] = str(exc)
+        entry["seconds"] = time.perf_counter() - t0
+        return entry
+    used = [a for a in result.fit_history if a["llf"] is not None]
+    entry.update(
+        llf=float(result.llf),
+        aic=float(result.aic),
+        bic=float(result.bic),
+        df=int(len(result.params) + 1),
+        converged=bool(result.converged),
+        method=used[-1]["method"] if used else None,
+        fe=np.asarray(result.fe_params).tolist(),
+        cov_re=(np.asarray(result.cov_re) / result.scale).tolist(),
+        seconds=time.perf_counter() - t0,
+    )
+    return entry
+
+
+def search(data, workers=None, progress=None):
+    # Fits run in waves by number of terms so that every model can warm start
+    # from an already fitted parent; within a wave they run in parallel.
+    endog, exog, groups = design(data)
+    specs = all_specs()
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(endog, exog, groups)) as pool:
+        for size in range(max(map(sum, specs)) + 1):
+            wave = [s for s in specs if sum(s) == size]
+            futures = {pool.submit(fit_spec, s, warm_start(s, results, exog)): s for s in wave}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress(len(results), len(specs))
+    return leaderboard(list(results.values()))
+
+
+def leaderboard(entries, criterion="bic"):
+    fitted = sorted((e for e in entries if e[criterion] is not None), key=lambda e: e[criterion])
+    failed = [e for e in entries if e[criterion] is None]
+    if fitted:
+        best_aic = min(e["aic"] for e in fitted)
+        best_bic = min(e["bic"] for e in fitted)
+        weights = [math.exp(-(e["aic"] - best_aic) / 2) for e in fitted]
+        for e, w in zip(fitted, weights):
+            e["delta_aic"] = e["aic"] - best_aic
+            e["delta_bic"] = e["bic"] - best_bic
+            e["aic_weight"] = w / sum(weights)
+    for rank, e in enumerate(fitted, start=1):
+        e["rank"] = rank
+    return fitted + failed
+
+
+def leaderboard_path(digest):
+    return os.path.join(CACHE_DIR, f"subsets-{digest[:16]}-f{LEADERBOARD_FORMAT}.json")
+
+
+def load_leaderboard(digest):
+    try:
+        with open(leaderboard_path(digest)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def search_status(digest):
+    if os.path.exists(leaderboard_path(digest)):
+        return {"state": "done"}
+    try:
+        with open(leaderboard_path(digest) + ".progress") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"state": "idle"}
+
+
+def start_search(data_file, workers=None, version=None):
+    # Runs the search in its own process so a web worker only ever reads the
+    # result; the CLI's lock makes a second start a no-op.
+    cmd = [sys.executable, "-m", "Models.subsets", "--data", data_file]
+    if workers:
+        cmd += ["--workers", str(workers)]
+    if version:
+        cmd += ["--version", version]
+    return subprocess.Popen(cmd, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def main():
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="All-subsets search over fixed and random terms of the mixed model.")
+    parser.add_argument("--data", default="Data/masters_salary.csv")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--version", help="save under this dataset version instead of the file's hash (the app "
+                                          "passes an uploaded store's, whose CSV it wrote back out)")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--force", action="store_true", help="rerun even if a leaderboard is saved")
+    args = parser.parse_args()
+
+    with open(args.data, "rb") as f:
+        raw = f.read()
+    digest = args.version or file_digest(args.data)
+    out_path = leaderboard_path(digest)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(out_path + ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            sys.exit("a search for this dataset is already running")
+        board = load_leaderboard(digest)
+        if board is None or args.force:
+            def progress(done, total):
+                write_json(out_path + ".progress", {"state": "running", "done": done, "total": total})
+
+            t0 = time.perf_counter()
+            try:
+                models = search(pd.read_csv(io.BytesIO(raw)), args.workers, progress)
+            except Exception as exc:
+                write_json(out_path + ".progress", {"state": "error", "error": f"{type(exc).__name__}: {exc}"})
+                raise
+            board = {"version": digest, "format": LEADERBOARD_FORMAT, "criterion": "bic", "built_at": time.time(),
+                     "seconds": time.perf_counter() - t0, "workers": args.workers or os.cpu_count(), "models": models}
+            write_json(out_path, board)
+            os.remove(out_path + ".progress")
+
+    print(f"{len(board['models'])} models in {board['seconds']:.1f}s on {board['workers']} processes")
+    print(f"{'rank':>4} {'BIC':>10} {'dBIC':>7} {'AIC':>10} {'logLik':>10} {'df':>3}  fixed | random")
+    for e in board["models"][:args.top]:
+        if e["llf"] is None:
+            continue
+        fixed, random = spec_terms(e["spec"])
+        print(f"{e['rank']:>4} {e['bic']:>10.1f} {e['delta_bic']:>7.1f} {e['aic']:>10.1f} {e['llf']:>10.1f} "
+              f"{e['df']:>3}  {', '.join(fixed) or '-'} | {', '.join(random) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
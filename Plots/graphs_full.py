@@ -3,10 +3,36 @@ import numpy as np
 import plotly.graph_objects as go
 import statsmodels.formula.api as smf
 
-def graphs_full(data_file):
+from Plots.rows import linear, row_meta
+
+HOVER_TEMPLATE = ("<b>%{hovertext}</b><br>"
+                  "Predicted: %{x:.0f}<br>"
+                  "Actual: %{y:.0f}<br>"
+                  "Masters GPA: %{customdata[0]:.2f}<br>"
+                  "Work Years: %{customdata[1]:.0f}<br>"
+                  "Python Years: %{customdata[2]:.0f}<br>"
+                  "SQL Years: %{customdata[3]:.0f}<extra></extra>")
+
+def graphs_full(data_file, hover="embedded"):
+    # hover="embedded" puts every point's details in the figure, as a static
+    # page needs. hover="ids" gives points only their row number and no
+    # tooltip of their own; the app looks the details up on hover instead,
+    # which keeps them out of the figure and its six animation frames.
 
     # Load dataset
-    df = pd.read_csv(data_file)  
+    df = data_file.reset_index(drop=True) if isinstance(data_file, pd.DataFrame) else pd.read_csv(data_file)
+
+    def marker_hover(group, uni):
+        # meta describes the points for assets/rows.js (Plots/rows.py)
+        if hover == "ids":
+            return dict(customdata=group.index.to_numpy(), hoverinfo="none",
+                        meta=row_meta(uni, x=predicted, y="first_job_salary", customdata="_row"))
+        return dict(
+            hovertext=[uni]*len(group),
+            customdata=group[["masters_gpa", "relevant_work_years", "years_python", "years_sql"]].values,
+            hovertemplate=HOVER_TEMPLATE,
+            meta=row_meta(uni, x=predicted, y="first_job_salary"),
+        )
 
     # Fit a MLR model
     model = smf.ols(
@@ -16,6 +42,7 @@ def graphs_full(data_file):
     result = model.fit()
 
     df["predicted_salary"] = result.fittedvalues
+    predicted = linear(result.params)
 
     universities = sorted(df["masters_university"].unique())
 
@@ -42,16 +69,8 @@ def graphs_full(data_file):
                 y=group["first_job_salary"],
                 mode="markers",
                 name=uni,
-                marker=dict(size=7, opacity=0.7, color=colors[uni]),
-                hovertext=[uni]*len(group),
-                customdata=group[["masters_gpa", "relevant_work_years", "years_python", "years_sql"]].values,
-                hovertemplate="<b>%{hovertext}</b><br>"
-                             "Predicted: %{x:.0f}<br>"
-                             "Actual: %{y:.0f}<br>"
-                             "Masters GPA: %{customdata[0]:.2f}<br>"
-                             "Work Years: %{customdata[1]:.0f}<br>"
-                             "Python Years: %{customdata[2]:.0f}<br>"
-                             "SQL Years: %{customdata[3]:.0f}<extra></extra>"
+                marker=dict(size=7, opacity=0.7, color=colors.get(uni, "#999999")),
+                **marker_hover(group, uni),
             )
         )
 
@@ -62,7 +81,7 @@ def graphs_full(data_file):
                 y=y_line,
                 mode="lines",
                 name=f"{uni} Line",
-                line=dict(color=colors[uni], width=2),
+                line=dict(color=colors.get(uni, "#999999"), width=2),
                 showlegend=False
             )
         )
@@ -82,17 +101,9 @@ def graphs_full(data_file):
                 x=group["predicted_salary"],
                 y=group["first_job_salary"],
                 mode="markers",
-                marker=dict(size=7, opacity=0.7, color=colors[uni]),
+                marker=dict(size=7, opacity=0.7, color=colors.get(uni, "#999999")),
                 name=uni,
-                hovertext=[uni]*len(group),
-                customdata=group[["masters_gpa", "relevant_work_years", "years_python", "years_sql"]].values,
-                hovertemplate="<b>%{hovertext}</b><br>"
-                             "Predicted: %{x:.0f}<br>"
-                             "Actual: %{y:.0f}<br>"
-                             "Masters GPA: %{customdata[0]:.2f}<br>"
-                             "Work Years: %{customdata[1]:.0f}<br>"
-                             "Python Years: %{customdata[2]:.0f}<br>"
-                             "SQL Years: %{customdata[3]:.0f}<extra></extra>"
+                **marker_hover(group, uni),
             )
         )
         frame_all.append(
@@ -100,7 +111,7 @@ def graphs_full(data_file):
                 x=x_line,
                 y=y_line,
                 mode="lines",
-                line=dict(color=colors[uni], width=2),
+                line=dict(color=colors.get(uni, "#999999"), width=2),
                 opacity=1,
                 showlegend=False
             )
@@ -122,17 +133,9 @@ def graphs_full(data_file):
                     x=group["predicted_salary"],
                     y=group["first_job_salary"],
                     mode="markers",
-                    marker=dict(size=7, opacity=opacity, color=colors[other_uni]),
+                    marker=dict(size=7, opacity=opacity, color=colors.get(other_uni, "#999999")),
                     name=other_uni,
-                    hovertext=[other_uni]*len(group),
-                    customdata=group[["masters_gpa", "relevant_work_years", "years_python", "years_sql"]].values,
-                    hovertemplate="<b>%{hovertext}</b><br>"
-                                 "Predicted: %{x:.0f}<br>"
-                                 "Actual: %{y:.0f}<br>"
-                                 "Masters GPA: %{customdata[0]:.2f}<br>"
-                                 "Work Years: %{customdata[1]:.0f}<br>"
-                                 "Python Years: %{customdata[2]:.0f}<br>"
-                                 "SQL Years: %{customdata[3]:.0f}<extra></extra>"
+                    **marker_hover(group, other_uni),
                 )
             )
             frame_uni.append(
@@ -140,7 +143,7 @@ def graphs_full(data_file):
                     x=x_line,
                     y=y_line,
                     mode="lines",
-                    line=dict(color=colors[other_uni], width=2),
+                    line=dict(color=colors.get(other_uni, "#999999"), width=2),
                     opacity=opacity,
                     showlegend=False
                 )
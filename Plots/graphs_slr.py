@@ -2,6 +2,8 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 
+from Plots.rows import row_meta
+
 
 
 def ols_fit(x, y):
@@ -66,6 +68,7 @@ def graph_slr(data_file):
                 marker=dict(size=7, opacity=0.6, color=color),
                 visible=(p_idx == 0),
                 showlegend=(p_idx == 0),
+                meta=row_meta(g, x=x_col, y=y_col),
             ))
             n_point_traces += 1
 
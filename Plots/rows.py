@@ -0,0 +1,64 @@
+import base64
+import copy
+
+import numpy as np
+
+# Figures whose traces plot the graduates themselves carry every row again
+# in every trace and animation frame. Such traces get a descriptor instead,
+# in meta["rows"]: which university's rows they show and what x, y and
+# customdata are, as a column name, "_row" (the row number) or a linear
+# predictor {"linear": {"Intercept": b0, column: b, ...}}. strip_rows() drops
+# the arrays the descriptors account for; the page ships the columns once
+# (encode_rows, a dcc.Store) and assets/rows.js puts the arrays back.
+
+ROW_FIELDS = ("x", "y", "customdata")
+GROUP = "masters_university"
+
+
+def linear(params):
+    return {"linear": {str(name): float(value) for name, value in params.items()}}
+
+
+def row_meta(group, **fields):
+    return {"rows": {"group": group, **fields}}
+
+
+def encode_column(values):
+    # The smallest little-endian type that holds the column exactly
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.number) and np.all(np.isfinite(values)) and np.all(values == np.round(values)):
+        for dtype in ("i1", "i2", "i4"):
+            info = np.iinfo(dtype)
+            if values.min(initial=0) >= info.min and values.max(initial=0) <= info.max:
+                break
+        else:
+            dtype = "f8"
+    else:
+        dtype = "f8"
+    return {"dtype": dtype, "bdata": base64.b64encode(values.astype(f"<{dtype}").tobytes()).decode()}
+
+
+def encode_rows(df, columns, group=GROUP):
+    # Only the columns the figures and the hover text use; an upload may
+    # carry others (names, notes) that aren't numeric
+    levels, codes = np.unique(df[group].astype(str).to_numpy(), return_inverse=True)
+    return {
+        "n": len(df),
+        "group": {"column": group, "levels": levels.tolist(), "codes": encode_column(codes)},
+        "columns": {c: encode_column(df[c].to_numpy(dtype=float)) for c in columns},
+    }
+
+
+def strip_rows(figure):
+    # figure: a figure's JSON dict; returns a copy without the row arrays
+    figure = copy.deepcopy(figure)
+    traces = list(figure.get("data", []))
+    for frame in figure.get("frames", []):
+        traces.extend(frame.get("data", []))
+    for trace in traces:
+        meta = trace.get("meta")
+        rows = meta.get("rows") if isinstance(meta, dict) else None
+        for field in ROW_FIELDS:
+            if rows and field in rows:
+                trace.pop(field, None)
+    return figure
@@ -1,22 +1,89 @@
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs
 
-from dash import Dash, html, dcc, Input, Output, State
+from dash import ClientsideFunction, Dash, ctx, html, dcc, Input, Output, State, no_update
 import dash_bootstrap_components as dbc
-import plotly.express as px
-import statsmodels.formula.api as smf
-from graphs import *
-import pandas as pd
-from Plots.graphs_full import *
-from Plots.graphs_slr import *
+from flask import abort, jsonify, request, send_from_directory
+from Models.fitting import recent_fits
+from Models.profile import load_profile, profile_status, start_profile
+from Models.subsets import load_leaderboard, search_status, start_search
+from model_cache import DEFAULT_FIXED, DEFAULT_STRUCTURE, PREDICTORS, RE_STRUCTURES, fit_structure, model_cache
+from refresh import StoreRefresher
+from thumbnails import FIGURES as LAZY_FIGURES, thumbnail_dir, thumbnail_file
+from uploads import (COLUMNS as UPLOAD_COLUMNS, MAX_BYTES, UPLOAD_DIR, UploadError, decode, status as upload_status,
+                     upload_queue)
 
+DATA_FILE = "Data/masters_salary.csv"
 
-salary_data = pd.read_csv("Data/masters_salary.csv")
+# Graphs that plot the graduates themselves. The page gets the rows once, in
+# the "rows" store, and each of these graphs a "-skeleton" store holding its
+# figure without them; assets/rows.js puts the two together.
+ROW_FIGURES = ["slr-graph", "mlr-graph", "me-pred-graph", "re-graph"]
 
+# Importing this module is cheap: no data is read, nothing is fitted and
+# statsmodels/plotly/pandas are not imported. init() loads the store (from the
+# on-disk cache when the data hasn't changed, otherwise by fitting in a
+# subprocess). gunicorn.conf.py calls it in the master so preloaded workers
+# share the result; anything else gets it on first use via current_store().
+refresher = None
+_init_lock = threading.Lock()
+_probe_lock = threading.Lock()
+_init_thread = None
 
-me_fig = build_mixed_effects_figure()
-me_pred_fig = build_predicted_vs_actual_figure(salary_data)
 
-slr_fig = graph_slr("Data/masters_salary.csv")
-mlr_fig = graphs_full("Data/masters_salary.csv")
+def init(data_file=DATA_FILE):
+    global refresher
+    with _init_lock:
+        if refresher is None:
+            refresher = StoreRefresher(data_file)
+        if refresher.store is None:
+            refresher.load()
+    return server
+
+
+def init_in_background():
+    # For health probes, which must answer while the first build runs
+    global _init_thread
+    with _probe_lock:
+        if _init_thread is None or not _init_thread.is_alive():
+            _init_thread = threading.Thread(target=_init_quietly, name="store-init", daemon=True)
+            _init_thread.start()
+
+
+def _init_quietly():
+    try:
+        init()
+    except Exception:
+        pass  # refresher.status() reports it
+
+
+def current_store():
+    if refresher is None or refresher.store is None:
+        init()
+    return refresher.store
+
+
+def dataset_store(digest):
+    # Callbacks pass the uploaded dataset the page is showing, if any.
+    return (digest and upload_queue.store(digest)) or current_store()
+
+
+def analysis_data(store):
+    # CSV and version for the search and profiling CLIs. An upload's CSV is
+    # removed once its store is built, so it is written back out from the
+    # store and the CLI told which version its results belong to.
+    meta = store.json("meta")
+    if store is current_store():
+        return meta["data_file"], None
+    path = os.path.join(UPLOAD_DIR, f"analysis-{meta['version'][:16]}.csv")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        store.frame("salary_data").to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    return path, meta["version"]
 
 code_snippet = """```
                 model1 = smf.mixedlm("first_job_salary ~ masters_gpa",
@@ -91,7 +158,153 @@ random_equation = r"""
 
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
-def serve_layout():
+class _NoFigures:
+    # Stands in for the store when Dash collects component ids for callback
+    # validation, so defining the layout doesn't trigger init().
+    def figure(self, name):
+        return {}
+
+    def skeleton(self, name):
+        return None
+
+    def json(self, name):
+        return {}
+
+
+def stage_label(meta, refined=False):
+    # Children, color and style of the fit-stage alert
+    if meta.get("stage") == "preview":
+        return ("Preview: these figures use quick moment estimates (one least-squares fit per university) "
+                "while the exact REML fits run. They will update by themselves when those finish.",
+                "warning", {})
+    if refined:
+        return "The exact REML fits have finished; every figure now shows them.", "success", {}
+    return None, "warning", {"display": "none"}
+
+
+def figure_output(graph_id, **kwargs):
+    # Where a callback sends graph_id's figure: its skeleton store for the
+    # graphs in ROW_FIGURES, the graph itself for the rest
+    if graph_id in ROW_FIGURES:
+        return Output(f"{graph_id}-skeleton", "data", **kwargs)
+    return Output(graph_id, "figure", **kwargs)
+
+
+def figure_value(store, graph_id, name):
+    return store.skeleton(name) if graph_id in ROW_FIGURES else store.figure(name)
+
+
+def lazy_graph(store, graph_id, lazy=True, **kwargs):
+    # The graph with its pre-rendered image (thumbnails.py) over it, if there
+    # is one; assets/thumbnails.js asks for the figure when it's needed. The
+    # image and the wake store are always there so callbacks validate.
+    name = LAZY_FIGURES[graph_id]
+    if not lazy:
+        return dcc.Graph(id=graph_id, figure=store.figure(name), **kwargs)
+    meta = store.json("meta")
+    image = meta.get("stage") == "exact" and thumbnail_file(meta["version"], name)
+    rows = graph_id in ROW_FIGURES
+    children = [
+        dcc.Graph(id=graph_id, figure={} if image or rows else store.figure(name), **kwargs),
+        html.Img(id=f"{graph_id}-thumb", className="figure-thumb", alt="",
+                 src=f"/thumbnails/{meta['version']}/{name}.webp" if image else None,
+                 style=None if image else {"display": "none"}),
+        dcc.Store(id=f"{graph_id}-wake"),
+    ]
+    if rows:
+        children.append(dcc.Store(id=f"{graph_id}-skeleton", data=None if image else store.skeleton(name)))
+    return html.Div(children, className="lazy-figure", **{"data-graph": graph_id})
+
+
+def leaderboard_table(board, top=10):
+    models = [m for m in board["models"] if m["llf"] is not None]
+    shown = models[:top]
+    full = next((m for m in models if m["spec"] == [2] * len(PREDICTORS)), None)
+    if full is not None and full not in shown:
+        shown.append(full)
+    labels = dict(PREDICTORS)
+
+    def terms(spec, level):
+        return ", ".join(labels[p] for (p, _), role in zip(PREDICTORS, spec) if role >= level) or "none"
+
+    header = ["Rank", "Fixed effects", "Random slopes", "df", "Log-likelihood", "AIC", "ΔAIC", "BIC", "ΔBIC",
+              "Akaike weight"]
+    rows = [
+        html.Tr([
+            html.Td(m["rank"]),
+            html.Td(terms(m["spec"], 1)),
+            html.Td(terms(m["spec"], 2) + (" (our full model)" if m is full else "")),
+            html.Td(m["df"]),
+            html.Td(f"{m['llf']:,.1f}"),
+            html.Td(f"{m['aic']:,.1f}"),
+            html.Td(f"{m['delta_aic']:.1f}"),
+            html.Td(f"{m['bic']:,.1f}"),
+            html.Td(f"{m['delta_bic']:.1f}"),
+            html.Td(f"{m['aic_weight']:.2f}"),
+        ], style={"fontWeight": "bold"} if m is full else None)
+        for m in shown
+    ]
+    return html.Table(
+        [html.Thead(html.Tr([html.Th(h) for h in header])), html.Tbody(rows)],
+        className="table table-sm table-hover",
+    )
+
+
+_leaderboards = {}
+
+
+def saved_leaderboard(version):
+    # Only found leaderboards are kept, so one that appears later is picked up.
+    if version and version not in _leaderboards:
+        board = load_leaderboard(version)
+        if board is not None:
+            _leaderboards[version] = board
+    return _leaderboards.get(version)
+
+
+def profile_table(result):
+    labels = {"Group": "intercept", **{p: label for p, label in PREDICTORS}}
+    names = ["Group", *(p for p, _ in PREDICTORS)]
+
+    def bound(value):
+        return "unbounded" if value is None else f"{value:,.0f}"
+
+    rows = []
+    for entry in result["parameters"]:
+        a, b = entry["terms"]
+        k, l = names.index(a), names.index(b)
+        what = f"Variance of the {labels[a]}" if a == b else f"Covariance of the {labels[b]} and {labels[a]}"
+        rows.append(html.Tr([
+            html.Td(["τ", html.Sub(f"{l}{k}")]),
+            html.Td(what if a == "Group" or b == "Group" else what + " slopes"),
+            html.Td(f"{entry['estimate']:,.0f}"),
+            html.Td(f"{bound(entry['lower'])} to {bound(entry['upper'])}"),
+        ]))
+    header = ["", "Parameter", "REML estimate", f"{result['level']:.0%} profile-likelihood interval"]
+    return html.Table(
+        [html.Thead(html.Tr([html.Th(h) for h in header])), html.Tbody(rows)],
+        className="table table-sm table-hover",
+    )
+
+
+_profiles = {}
+
+
+def saved_profile(version):
+    if version and version not in _profiles:
+        result = load_profile(version)
+        if result is not None:
+            _profiles[version] = result
+    return _profiles.get(version)
+
+
+def serve_layout(store=None, lazy=True):
+    # lazy=False puts every figure in the layout (export.py)
+    store = store or current_store()
+    board = saved_leaderboard(store.json("meta").get("version"))
+    intervals = saved_profile(store.json("meta").get("version"))
+    coefficients = store.json("coefficients")
+    stage_text, stage_color, stage_style = stage_label(store.json("meta"))
     return html.Div(
         id="page-container",
         children=[
@@ -122,6 +335,11 @@ def serve_layout():
                                     dbc.NavLink("Simple Linear Regression", href="#slr", external_link=True),
                                     dbc.NavLink("Multiple Linear Regression", href="#mlr", external_link=True),
                                     dbc.NavLink("Mixed Effect Models", href="#mixed_effect", external_link=True),
+                                    dbc.NavLink("Model Diagnostics", href="#diagnostics", external_link=True),
+                                    dbc.NavLink("Random Effects Structures", href="#re_structure", external_link=True),
+                                    dbc.NavLink("What Would You Earn?", href="#calculator", external_link=True),
+                                    dbc.NavLink("Which Predictors Matter?", href="#subsets", external_link=True),
+                                    dbc.NavLink("Analyze Your Own Data", href="#upload", external_link=True),
                                     dbc.NavLink("Conclusion", href="#conclusion", external_link=True),
                                     dbc.NavLink("References", href="#references", external_link=True),
 
@@ -145,6 +363,12 @@ def serve_layout():
                                 className="subtitle",
                             ),
                             html.Hr(),
+                            dcc.Store(id="dataset"),
+                            dcc.Store(id="rows", data=store.json("rows") if lazy else None),
+                            dbc.Alert(id="dataset-banner", color="info", style={"display": "none"}),
+                            dbc.Alert(stage_text, id="fit-stage", color=stage_color, style=stage_style),
+                            dcc.Interval(id="stage-poll", interval=2000,
+                                         disabled=store.json("meta").get("stage") != "preview"),
                             html.Div(
                                 [
                                     html.H2("Introduction", id="introduction"),
@@ -211,7 +435,7 @@ def serve_layout():
                                         "lineHeight": "1.6",  
                                     }
                                     ), 
-                                    dcc.Graph(figure=slr_fig),
+                                    lazy_graph(store, "slr-graph", lazy),
                                     dcc.Markdown(
                                         '''
                                         In the interactive graph above you can change the graph to reflect how each variable affects the predicted salary in an SLR model.
@@ -273,7 +497,8 @@ def serve_layout():
                                         "maxWidth": "100%",
                                         "whiteSpace": "nowrap"
                                         }),
-                                    dcc.Graph(figure=mlr_fig),
+                                    lazy_graph(store, "mlr-graph", lazy, clear_on_unhover=True),
+                                    dcc.Tooltip(id="mlr-tooltip", direction="right"),
                                     dcc.Markdown(
                                         """
                                         The figure above displays an MLR model for each university. Use the dropdown menu to see each school’s MLR line and data separately from one another.
@@ -366,13 +591,31 @@ def serve_layout():
                                             "fontSize": "18px",  
                                             "lineHeight":"1.6",  
                                         }
-                                    )
+                                    ),
+                                    dcc.Markdown(
+                                        """
+                                        How sure can we be about those taus? With only five universities, not very, and the usual
+                                        estimate ± 1.96 standard errors is a poor guide for variances. Profile-likelihood intervals hold
+                                        one tau at a value, refit everything else, and keep the values the data can't rule out.
+                                        """,
+                                        style={
+                                            "fontSize": "18px",
+                                            "lineHeight":"1.6",
+                                        }
+                                    ),
+                                    html.Div(id="profile-table", children=profile_table(intervals) if intervals else
+                                             "The intervals haven't been computed for this data yet."),
+                                    dbc.Button("Compute the intervals", id="profile-run", color="primary",
+                                               style={"display": "none"} if intervals else None),
+                                    html.Div(id="profile-status", style={"margin": "12px 0"}),
+                                    dcc.Interval(id="profile-poll", interval=1000, disabled=True),
                                 ],
                                 className="section"
                             ), 
                             html.Div(
                                 [
-                                    dcc.Graph(figure=me_fig),
+                                    lazy_graph(store, "me-graph", lazy),
+                                    dcc.Store(id="me-highlight"),
                                     dcc.Markdown(
                                         """
                                         Cycle through the tabs to observe the lines for our random slopes model. What do you notice? 
@@ -393,7 +636,7 @@ def serve_layout():
                                             "lineHeight":"1.6",  
                                         }
                                         ),
-                                    dcc.Graph(figure=me_pred_fig),
+                                    lazy_graph(store, "me-pred-graph", lazy),
                                     dcc.Markdown(
                                         """
                                         Click on the university data you want to see from the drop down menu. How does our fitted line look?
@@ -406,6 +649,177 @@ def serve_layout():
                                 ],
                                 className="section"
                             ),
+                            html.Div(
+                                [
+                                    html.H2("Checking Our Assumptions", id="diagnostics"),
+                                    dcc.Markdown(
+                                        """
+                                        A mixed model makes promises about its errors: the residuals should look normal and show no pattern
+                                        against the fitted values, and each university's random effects should look like draws from a normal distribution.
+                                        The left panel compares the standardized residuals to a normal distribution (points on the dashed line are what we want),
+                                        the middle one shows the average residual and a ±2 SD band across the range of predicted salaries,
+                                        and the right one does the same normal check for the random effects. Use the buttons to switch between the full model
+                                        and the four single-predictor models. With only five universities the random effects panel is, admittedly, five points a term!
+                                        """,
+                                        style={
+                                            "fontSize": "18px",
+                                            "lineHeight":"1.6",
+                                        }
+                                    ),
+                                    lazy_graph(store, "diagnostics-graph", lazy),
+                                ],
+                                className="section"
+                            ),
+                            html.Div(
+                                [
+                                    html.H2("Try a Different Random Effects Structure", id="re_structure"),
+                                    dcc.Markdown(
+                                        """
+                                        Is a random slope for every predictor really worth it? Pick which predictors go in the fixed part of the model
+                                        and which random effects each university gets, and compare the fit with the full model above.
+                                        """,
+                                        style={
+                                            "fontSize": "18px",
+                                            "lineHeight":"1.6",
+                                        }
+                                    ),
+                                    dbc.Row(
+                                        [
+                                            dbc.Col([
+                                                html.Label("Fixed effects"),
+                                                dcc.Checklist(
+                                                    id="re-fixed",
+                                                    options=[{"label": f" {label}", "value": col} for col, label in PREDICTORS],
+                                                    value=DEFAULT_FIXED,
+                                                    inline=True,
+                                                    inputStyle={"marginLeft": "12px"},
+                                                ),
+                                            ], md=6),
+                                            dbc.Col([
+                                                html.Label("Random effects"),
+                                                dcc.Dropdown(
+                                                    id="re-structure",
+                                                    options=[{"label": label, "value": key} for key, (label, _) in RE_STRUCTURES.items()],
+                                                    value=DEFAULT_STRUCTURE,
+                                                    clearable=False,
+                                                ),
+                                            ], md=6),
+                                        ]
+                                    ),
+                                    html.Div(id="re-status", style={"margin": "12px 0"}),
+                                    dbc.Progress(id="re-progress", value=100, striped=True, animated=True,
+                                                 style={"display": "none"}),
+                                    dcc.Graph(id="re-graph", figure={} if lazy else store.figure("me_pred")),
+                                    dcc.Store(id="re-graph-skeleton"),
+                                    dcc.Interval(id="re-poll", interval=500, disabled=True),
+                                ],
+                                className="section"
+                            ),
+                            html.Div(
+                                [
+                                    html.H2("What Would You Earn?", id="calculator"),
+                                    dcc.Markdown(
+                                        """
+                                        Plug in your own numbers. The MLR line uses the equation from earlier (with its university
+                                        terms); the mixed model adds your university's own intercept and slopes to the overall trend.
+                                        Everything is worked out in your browser from the fitted coefficients.
+                                        """,
+                                        style={
+                                            "fontSize": "18px",
+                                            "lineHeight":"1.6",
+                                        }
+                                    ),
+                                    dbc.Row(
+                                        [
+                                            dbc.Col([
+                                                html.Label("University"),
+                                                dcc.Dropdown(id="calc-university", options=[{"label": u, "value": u}
+                                                             for u in sorted(coefficients.get("mixed", {}).get("blups", {}))],
+                                                             value="UC Berkeley", clearable=False),
+                                            ], md=4),
+                                            dbc.Col([html.Label("Master's GPA"),
+                                                     dcc.Input(id="calc-gpa", type="number", value=3.5, min=0, max=4, step=0.01,
+                                                               className="form-control")], md=2),
+                                            dbc.Col([html.Label("Work years"),
+                                                     dcc.Input(id="calc-work", type="number", value=2, min=0, step=1,
+                                                               className="form-control")], md=2),
+                                            dbc.Col([html.Label("Python years"),
+                                                     dcc.Input(id="calc-python", type="number", value=2, min=0, step=1,
+                                                               className="form-control")], md=2),
+                                            dbc.Col([html.Label("SQL years"),
+                                                     dcc.Input(id="calc-sql", type="number", value=1, min=0, step=1,
+                                                               className="form-control")], md=2),
+                                        ]
+                                    ),
+                                    html.Table(
+                                        html.Tbody([
+                                            html.Tr([html.Td("MLR prediction"), html.Td(id="calc-ols")]),
+                                            html.Tr([html.Td("Mixed model, your university"), html.Td(id="calc-mixed")]),
+                                            html.Tr([html.Td("Mixed model, average university"), html.Td(id="calc-fixed")]),
+                                        ]),
+                                        className="table table-sm",
+                                        style={"marginTop": "16px", "maxWidth": "600px", "fontSize": "18px"},
+                                    ),
+                                    dcc.Store(id="calc-coefs", data=coefficients),
+                                ],
+                                className="section"
+                            ),
+                            html.Div(
+                                [
+                                    html.H2("Which Predictors Actually Matter?", id="subsets"),
+                                    dcc.Markdown(
+                                        """
+                                        Remember how SQL didn't make the cut in the MLR summary? Rather than argue about it, we fit every combination:
+                                        each predictor is either left out, a fixed effect, or a fixed effect with its own random slope by university.
+                                        That's 3⁴ = 81 mixed models, all by maximum likelihood so their AIC and BIC can be compared (lower is better).
+                                        Here are the best ten, plus where our full model from above lands.
+                                        """,
+                                        style={
+                                            "fontSize": "18px",
+                                            "lineHeight":"1.6",
+                                        }
+                                    ),
+                                    html.Div(id="subsets-board", children=leaderboard_table(board) if board else
+                                             "The search hasn't been run for this data yet."),
+                                    dbc.Button("Run the search", id="subsets-run", color="primary",
+                                               style={"display": "none"} if board else None),
+                                    html.Div(id="subsets-status", style={"margin": "12px 0"}),
+                                    dcc.Interval(id="subsets-poll", interval=1000, disabled=True),
+                                ],
+                                className="section"
+                            ),
+                            html.Div(
+                                [
+                                    html.H2("Analyze Your Own Data", id="upload"),
+                                    dcc.Markdown(
+                                        f"""
+                                        Got your own cohort? Upload a CSV with the same columns as ours ({", ".join(f"`{c}`" for c in UPLOAD_COLUMNS)})
+                                        and we'll fit every model on this page to it. The same file twice? It's already done, so you'll get it straight back.
+                                        """,
+                                        style={
+                                            "fontSize": "18px",
+                                            "lineHeight":"1.6",
+                                        }
+                                    ),
+                                    dcc.Upload(
+                                        id="upload-data",
+                                        children=html.Div(["Drag and drop or ", html.A("select a CSV file")]),
+                                        accept=".csv,text/csv",
+                                        max_size=MAX_BYTES,
+                                        style={
+                                            "padding": "30px",
+                                            "border": "2px dashed #ccc",
+                                            "borderRadius": "8px",
+                                            "textAlign": "center",
+                                        },
+                                    ),
+                                    html.Div(id="upload-status", style={"margin": "12px 0"}),
+                                    dbc.Progress(id="upload-progress", value=0, style={"display": "none"}),
+                                    dcc.Interval(id="upload-poll", interval=1000, disabled=True),
+                                    dcc.Store(id="upload-digest"),
+                                ],
+                                className="section"
+                            ),
                             html.Div(
                                 [
                                     html.H2("Conclusion", id= "conclusion"),
@@ -455,8 +869,275 @@ def serve_layout():
         ],
     )
 
+app.validation_layout = serve_layout(_NoFigures())
 app.layout = serve_layout
 server = app.server
 
+
+app.clientside_callback(
+    ClientsideFunction(namespace="spaghetti", function_name="highlight"),
+    Output("me-highlight", "data"),
+    Input("me-graph", "hoverData"),
+    Input("me-graph", "clickData"),
+    State("me-graph", "id"),
+)
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="calculator", function_name="predict"),
+    Output("calc-ols", "children"),
+    Output("calc-mixed", "children"),
+    Output("calc-fixed", "children"),
+    Input("calc-university", "value"),
+    Input("calc-gpa", "value"),
+    Input("calc-work", "value"),
+    Input("calc-python", "value"),
+    Input("calc-sql", "value"),
+    Input("calc-coefs", "data"),
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace="calculator", function_name="universities"),
+    Output("calc-university", "options"),
+    Input("calc-coefs", "data"),
+    prevent_initial_call=True,
+)
+
+
+@app.callback(
+    Output("dataset", "data"),
+    Output("dataset-banner", "children"),
+    Output("dataset-banner", "style"),
+    *[figure_output(graph_id) for graph_id in LAZY_FIGURES],
+    Output("rows", "data"),
+    Output("fit-stage", "children"),
+    Output("fit-stage", "color"),
+    Output("fit-stage", "style"),
+    Output("stage-poll", "disabled"),
+    Output("calc-coefs", "data"),
+    Input("url", "search"),
+    Input("stage-poll", "n_intervals"),
+)
+def show_dataset(search, _):
+    # The layout always carries the default dataset's figures; ?data=<sha256>
+    # swaps in an uploaded one's. While the figures come from a preview store
+    # stage-poll runs, and the exact store's figures replace them once built.
+    digest = parse_qs((search or "").lstrip("?")).get("data", [None])[0]
+    polled = ctx.triggered_id == "stage-poll"
+    if not digest and not polled:
+        return (no_update,) * 14
+    store = upload_queue.store(digest) if digest else current_store()
+    if store is None:
+        banner = ["That uploaded dataset isn't available any more, so this is the original data. ",
+                  html.A("Upload it again", href="#upload"), "."]
+        return None, banner, {}, *(no_update,) * 11
+    meta = store.json("meta")
+    if polled and meta.get("stage") == "preview":
+        return (no_update,) * 14
+    banner = [f"You're looking at {meta['label']} ({meta['rows']:,} rows). Every figure is fitted to your data; "
+              "the write-up and the equations still describe ours. ", html.A("Back to the original data", href="/"), "."]
+    figures = [figure_value(store, graph_id, name) for graph_id, name in LAZY_FIGURES.items()]
+    return (digest or None, banner if digest else no_update, {} if digest else no_update, *figures,
+            store.json("rows"), *stage_label(meta, refined=polled), meta.get("stage") != "preview",
+            store.json("coefficients"))
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="thumbnails", function_name="reveal"),
+    [Output(f"{graph_id}-thumb", "style") for graph_id in LAZY_FIGURES],
+    [Input(graph_id, "figure") for graph_id in LAZY_FIGURES],
+)
+
+
+for graph_id in ROW_FIGURES:
+    app.clientside_callback(
+        ClientsideFunction(namespace="rows", function_name="assemble"),
+        Output(graph_id, "figure"),
+        Input("rows", "data"),
+        Input(f"{graph_id}-skeleton", "data"),
+    )
+
+
+@app.callback(
+    [figure_output(graph_id, allow_duplicate=True) for graph_id in LAZY_FIGURES],
+    [Input(f"{graph_id}-wake", "data") for graph_id in LAZY_FIGURES],
+    State("dataset", "data"),
+    prevent_initial_call=True,
+)
+def wake_figure(*args):
+    store = dataset_store(args[-1])
+    return [figure_value(store, graph_id, name) if ctx.triggered_id == f"{graph_id}-wake" else no_update
+            for graph_id, name in LAZY_FIGURES.items()]
+
+
+@app.callback(
+    Output("upload-status", "children"),
+    Output("upload-progress", "value"),
+    Output("upload-progress", "label"),
+    Output("upload-progress", "style"),
+    Output("upload-poll", "disabled"),
+    Output("upload-digest", "data"),
+    Input("upload-data", "contents"),
+    Input("upload-poll", "n_intervals"),
+    State("upload-data", "filename"),
+    State("upload-digest", "data"),
+    prevent_initial_call=True,
+)
+def handle_upload(contents, _, filename, digest):
+    hidden = {"display": "none"}
+    if ctx.triggered_id == "upload-data":
+        try:
+            digest, summary = upload_queue.submit(decode(contents), filename)
+        except UploadError as exc:
+            return f"Could not use {filename}: {exc}", 0, "", hidden, True, None
+
+    state = upload_status(digest)
+    if state["state"] == "done":
+        return [f"{filename} is ready: ", html.A("open its dashboard", href=f"/?data={digest}")], 100, "", hidden, True, digest
+    if state["state"] == "preview":
+        percent = 100 * state["done"] / state["total"]
+        return ([f"A preview of {filename} is ready: ", html.A("open its dashboard", href=f"/?data={digest}"),
+                 f". The exact fits are still running ({state['step']})..."],
+                percent, f"{percent:.0f}%", {"height": "20px"}, False, digest)
+    if state["state"] in ("error", "unknown"):
+        return f"Could not analyse {filename}: {state.get('error', 'the job was lost')}", 0, "", hidden, True, digest
+    percent = 100 * state["done"] / state["total"]
+    return f"Analysing {filename}: {state['step']}...", percent, f"{percent:.0f}%", {"height": "20px"}, False, digest
+
+
+@app.callback(
+    Output("subsets-board", "children"),
+    Output("subsets-run", "style"),
+    Output("subsets-status", "children"),
+    Output("subsets-poll", "disabled"),
+    Input("subsets-run", "n_clicks"),
+    Input("subsets-poll", "n_intervals"),
+    State("dataset", "data"),
+    prevent_initial_call=True,
+)
+def run_subsets_search(_, __, dataset):
+    store = dataset_store(dataset)
+    meta = store.json("meta")
+    state = search_status(meta["version"])
+    if ctx.triggered_id == "subsets-run" and state["state"] in ("idle", "error"):
+        start_search(*analysis_data(store))
+        return no_update, {"display": "none"}, "Starting the search...", False
+    if state["state"] == "done":
+        return leaderboard_table(saved_leaderboard(meta["version"])), {"display": "none"}, "", True
+    if state["state"] == "error":
+        return no_update, None, f"The search failed: {state['error']}", True
+    if state["state"] == "running":
+        return no_update, {"display": "none"}, f"Fitted {state['done']} of {state['total']} models...", False
+    return no_update, {"display": "none"}, "Starting the search...", False
+
+
+@app.callback(
+    Output("profile-table", "children"),
+    Output("profile-run", "style"),
+    Output("profile-status", "children"),
+    Output("profile-poll", "disabled"),
+    Input("profile-run", "n_clicks"),
+    Input("profile-poll", "n_intervals"),
+    State("dataset", "data"),
+    prevent_initial_call=True,
+)
+def run_profile(_, __, dataset):
+    store = dataset_store(dataset)
+    meta = store.json("meta")
+    state = profile_status(meta["version"])
+    if ctx.triggered_id == "profile-run" and state["state"] in ("idle", "error"):
+        start_profile(*analysis_data(store))
+        return no_update, {"display": "none"}, "Starting...", False
+    if state["state"] == "done":
+        return profile_table(saved_profile(meta["version"])), {"display": "none"}, "", True
+    if state["state"] == "error":
+        return no_update, None, f"Profiling failed: {state['error']}", True
+    if state["state"] == "running":
+        return no_update, {"display": "none"}, f"Profiled {state['done']} of {state['total']} interval ends...", False
+    return no_update, {"display": "none"}, "Starting...", False
+
+
+@app.callback(
+    Output("re-graph-skeleton", "data"),
+    Output("re-status", "children"),
+    Output("re-progress", "style"),
+    Output("re-poll", "disabled"),
+    Input("re-fixed", "value"),
+    Input("re-structure", "value"),
+    Input("re-poll", "n_intervals"),
+    Input("dataset", "data"),
+)
+def update_re_structure(fixed, structure, _, dataset):
+    store = dataset_store(dataset)
+    fixed = sorted(fixed or [])
+    key = (store.json("meta")["version"], tuple(fixed), structure)
+    hidden = {"display": "none"}
+
+    if fixed == sorted(DEFAULT_FIXED) and structure == DEFAULT_STRUCTURE:
+        return store.skeleton("me_pred"), "Showing the full model from above.", hidden, True
+
+    entry = model_cache.get(key)
+    if entry is not None:
+        note = "" if entry["converged"] else " (did not fully converge)"
+        status = f"{entry['formula']}, random {entry['re_formula']}: REML log-likelihood {entry['llf']:,.1f}{note}"
+        return json.loads(entry["skeleton"]), status, hidden, True
+
+    job = model_cache.submit(key, fit_structure, store.frame("salary_data"), fixed, structure)
+    if job["state"] == "error":
+        model_cache.forget_job(key)
+        return no_update, f"Could not fit this structure: {job['error']}", hidden, True
+    elapsed = time.time() - job["submitted"]
+    return no_update, f"Fitting model ({job['state']}, {elapsed:.1f}s)...", {"height": "6px"}, False
+
+
+# The MLR figure's points carry only their row id (see graphs_full) and the
+# page has the rows already, so the tooltip is looked up in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace="rows", function_name="tooltip"),
+    Output("mlr-tooltip", "show"),
+    Output("mlr-tooltip", "bbox"),
+    Output("mlr-tooltip", "children"),
+    Input("mlr-graph", "hoverData"),
+    State("rows", "data"),
+    prevent_initial_call=True,
+)
+
+
+@server.route("/thumbnails/<version>/<name>.webp")
+def thumbnail(version, name):
+    # The version is in the URL, so an image never changes under it
+    if name not in LAZY_FIGURES.values() or not version.isalnum():
+        abort(404)
+    return send_from_directory(thumbnail_dir(version), f"{name}.webp", max_age=365 * 24 * 3600)
+
+
+@server.route("/ready")
+def ready():
+    # 503 until the first store is loaded; never waits for it
+    if refresher is None or refresher.store is None:
+        init_in_background()
+        status = refresher.status() if refresher is not None else {"ready": False, "state": "starting"}
+        return jsonify(status), 503
+    return jsonify(ready=True, version=refresher.store.json("meta")["version"])
+
+
+# Dash lays the page out, which loads the store, before the first request of
+# any path; a probe is answered ahead of that
+server.before_request_funcs.setdefault(None, []).insert(0, lambda: ready() if request.path == "/ready" else None)
+
+
+@server.route("/version")
+def version():
+    current_store()
+    return jsonify(refresher.status())
+
+
+@server.route("/fits")
+def fits():
+    return jsonify(store=current_store().json("fits"), interactive=recent_fits())
+
+
 if __name__ == "__main__":
+    init()
+    refresher.start()
     app.run(debug=True)
@@ -0,0 +1,37 @@
+// The what-if calculator. Predictions come from the coefficient bundle the
+// page was served with (shared_store.coefficient_bundle), so typing in the
+// inputs never reaches the server.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    calculator: {
+        predict: function(university, gpa, work, python, sql, coefs) {
+            if (!coefs) {
+                return window.dash_clientside.no_update;
+            }
+            const values = {
+                Intercept: 1,
+                masters_gpa: gpa,
+                relevant_work_years: work,
+                years_python: python,
+                years_sql: sql,
+            };
+            if ([gpa, work, python, sql].some((v) => v === null || v === undefined || v === "")) {
+                return ["-", "-", "-"];
+            }
+            const dot = (names, params) => names.reduce((sum, name, i) => sum + params[i] * values[name], 0);
+            const money = (v) => "$" + Math.round(v).toLocaleString("en-US");
+
+            const ols = dot(coefs.ols.names, coefs.ols.params) + (coefs.ols.universities[university] || 0);
+            const fixed = dot(coefs.mixed.names, coefs.mixed.params);
+            const blup = coefs.mixed.blups[university];
+            const mixed = fixed + (blup ? dot(coefs.mixed.re_names, blup) : 0);
+            return [money(ols), money(mixed), money(fixed)];
+        },
+
+        universities: function(coefs) {
+            if (!coefs) {
+                return window.dash_clientside.no_update;
+            }
+            return Object.keys(coefs.mixed.blups).sort().map((u) => ({label: u, value: u}));
+        }
+    }
+});
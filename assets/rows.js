@@ -0,0 +1,112 @@
+// Puts the graduates back into figures sent without them (Plots/rows.py).
+// The "rows" store holds every column once, typed and base64-encoded; each
+// trace's meta.rows names the university whose rows it shows and what its
+// x, y and customdata are: a column, "_row" (the row number) or a linear
+// predictor.
+(function() {
+    const TYPES = {i1: Int8Array, i2: Int16Array, i4: Int32Array, f8: Float64Array};
+    // Decoded once per rows store, however many figures draw from it
+    const tables = new WeakMap();
+
+    function decode(column) {
+        const bytes = Uint8Array.from(atob(column.bdata), (c) => c.charCodeAt(0));
+        return new TYPES[column.dtype](bytes.buffer);
+    }
+
+    function table(rows) {
+        if (!tables.has(rows)) {
+            const columns = {};
+            Object.entries(rows.columns).forEach(([name, column]) => {
+                columns[name] = decode(column);
+            });
+            const members = {};
+            rows.group.levels.forEach((level) => {
+                members[level] = [];
+            });
+            const codes = decode(rows.group.codes);
+            codes.forEach((code, i) => members[rows.group.levels[code]].push(i));
+            tables.set(rows, {columns, members, codes});
+        }
+        return tables.get(rows);
+    }
+
+    function values(t, index, spec) {
+        if (spec === "_row") {
+            return Int32Array.from(index);
+        }
+        if (typeof spec === "string") {
+            const column = t.columns[spec];
+            return Float64Array.from(index, (i) => column[i]);
+        }
+        const out = new Float64Array(index.length);
+        Object.entries(spec.linear).forEach(([name, coef]) => {
+            const column = name === "Intercept" ? null : t.columns[name];
+            if (name !== "Intercept" && !column) {
+                return;
+            }
+            index.forEach((i, k) => {
+                out[k] += coef * (column ? column[i] : 1);
+            });
+        });
+        return out;
+    }
+
+    function component(type, props) {
+        return {type: type, namespace: "dash_html_components", props: props || {}};
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        rows: {
+            // The MLR figure's hover: its points carry their row number
+            tooltip: function(hover, rows) {
+                const point = ((hover || {}).points || [{}])[0];
+                if (!rows || typeof point.customdata !== "number") {
+                    return [false, window.dash_clientside.no_update, window.dash_clientside.no_update];
+                }
+                const t = table(rows);
+                const i = point.customdata;
+                const value = (name) => t.columns[name][i];
+                const money = (v) => Math.round(v).toLocaleString("en-US");
+                const lines = [
+                    component("B", {children: rows.group.levels[t.codes[i]]}),
+                    `Predicted: ${money(point.x)}`,
+                    `Actual: ${money(point.y)}`,
+                    `Masters GPA: ${value("masters_gpa").toFixed(2)}`,
+                    // Uploads may have fractional years
+                    `Work Years: ${value("relevant_work_years")}`,
+                    `Python Years: ${value("years_python")}`,
+                    `SQL Years: ${value("years_sql")}`,
+                ];
+                const children = lines.flatMap((line, k) => (k ? [component("Br"), line] : [line]));
+                return [true, point.bbox,
+                        component("Div", {children: children, style: {fontSize: "13px", whiteSpace: "nowrap"}})];
+            },
+
+            assemble: function(rows, skeleton) {
+                if (!rows || !skeleton) {
+                    return window.dash_clientside.no_update;
+                }
+                const t = table(rows);
+                const fill = (trace) => {
+                    const spec = trace.meta && trace.meta.rows;
+                    if (!spec) {
+                        return trace;
+                    }
+                    const index = t.members[spec.group] || [];
+                    const out = Object.assign({}, trace);
+                    ["x", "y", "customdata"].forEach((field) => {
+                        if (spec[field] !== undefined) {
+                            out[field] = values(t, index, spec[field]);
+                        }
+                    });
+                    return out;
+                };
+                const figure = Object.assign({}, skeleton, {data: skeleton.data.map(fill)});
+                if (skeleton.frames) {
+                    figure.frames = skeleton.frames.map((frame) => Object.assign({}, frame, {data: frame.data.map(fill)}));
+                }
+                return figure;
+            }
+        }
+    });
+})();
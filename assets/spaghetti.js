@@ -0,0 +1,42 @@
+// Highlights one program's line in the packed ("many groups") spaghetti plot.
+// Lines are stored back to back in a single trace separated by gaps, so the
+// hovered point's line is the run of points between the surrounding gaps.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    spaghetti: {
+        highlight: function(hoverData, clickData, graphId) {
+            const noUpdate = window.dash_clientside.no_update;
+            const triggered = window.dash_clientside.callback_context.triggered;
+            const clicked = triggered.length && triggered[0].prop_id.endsWith(".clickData");
+            const event = clicked ? clickData : hoverData;
+            const point = event && event.points && event.points[0];
+            const container = document.getElementById(graphId);
+            const gd = container && container.querySelector(".js-plotly-plot");
+            if (!point || !gd) {
+                return noUpdate;
+            }
+            const trace = gd.data[point.curveNumber];
+            if (!trace.meta || trace.meta.role !== "groups") {
+                return noUpdate;
+            }
+            const isGap = (v) => v === null || v === undefined || Number.isNaN(v);
+            let lo = point.pointNumber;
+            let hi = point.pointNumber;
+            while (lo > 0 && !isGap(trace.x[lo - 1])) lo--;
+            while (hi < trace.x.length - 1 && !isGap(trace.x[hi + 1])) hi++;
+
+            const target = gd.data.findIndex(
+                (t) => t.meta && t.meta.role === "highlight" && t.meta.block === trace.meta.block
+            );
+            if (target < 0) {
+                return noUpdate;
+            }
+            const name = trace.customdata[point.pointNumber];
+            Plotly.restyle(gd, {
+                x: [Array.from(trace.x.slice(lo, hi + 1))],
+                y: [Array.from(trace.y.slice(lo, hi + 1))],
+                name: [name],
+            }, [target]);
+            return name;
+        }
+    }
+});
@@ -0,0 +1,53 @@
+// Pre-rendered figure images (thumbnails.py). Each .lazy-figure shows its
+// image until the graph's section scrolls into view or the reader points at,
+// taps or tabs into it; then its "-wake" store is set and the server sends
+// the figure. reveal() hides an image as soon as its graph has a figure,
+// whichever callback sent it (an uploaded dataset's figures come straight
+// from show_dataset).
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    thumbnails: {
+        reveal: function(...figures) {
+            return figures.map((figure) => (figure && figure.data ? {display: "none"} : window.dash_clientside.no_update));
+        }
+    }
+});
+
+(function() {
+    function wake(wrapper) {
+        if (wrapper.dataset.woken) {
+            return;
+        }
+        wrapper.dataset.woken = "1";
+        window.dash_clientside.set_props(wrapper.dataset.graph + "-wake", {data: true});
+    }
+
+    const inView = new IntersectionObserver((entries) => {
+        entries.forEach((entry) => {
+            if (entry.isIntersecting) {
+                inView.unobserve(entry.target);
+                wake(entry.target);
+            }
+        });
+    }, {rootMargin: "200px 0px"});
+
+    function watch(wrapper) {
+        const thumb = wrapper.querySelector(".figure-thumb");
+        if (!thumb || thumb.style.display === "none") {
+            return;
+        }
+        ["pointerenter", "touchstart", "focusin", "click"].forEach((type) =>
+            wrapper.addEventListener(type, () => wake(wrapper), {once: true, passive: true}));
+        inView.observe(wrapper);
+    }
+
+    // Dash renders the layout after this script runs; the figures are all in
+    // it, so stop looking once they've turned up
+    const layout = new MutationObserver(() => {
+        const wrappers = document.querySelectorAll(".lazy-figure");
+        if (wrappers.length) {
+            layout.disconnect();
+            wrappers.forEach(watch);
+        }
+    });
+    layout.observe(document.documentElement, {childList: true, subtree: true});
+})();
@@ -0,0 +1,288 @@
+"""Throughput and latency of `gunicorn app:server` under concurrent page loads.
+
+Run from the repository root:
+
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --workers 1 4 --clients 16 --duration 20
+    python -m benchmarks.load_test --save-baseline
+    python -m benchmarks.load_test --url http://staging:8000 --no-compare
+
+Each simulated client loads the page the way a browser does: GET /, then
+/_dash-layout and /_dash-dependencies, then every server-side callback that
+fires on page load with the values from the layout. Requests/s, p50/p95/p99
+latency and bytes are reported per endpoint and compared with
+benchmarks/load_baseline.json. The baseline keeps only what holds on any
+machine: each endpoint's bytes, its share of the page load's p95 latency,
+and each worker count's throughput relative to the first one run. The run
+exits non-zero when an endpoint's response grew, its latency share grew or
+throughput scaled worse by more than the tolerances, and when an endpoint
+is missing from either side (re-record with --save-baseline after a change
+to the page's callbacks or payloads).
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from benchmarks.worker_memory import free_port, wait_ready
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "load_baseline.json")
+HEADERS = {"Accept-Encoding": "gzip", "Connection": "close"}
+
+
+class Client:
+    # One connection per request, like gunicorn's sync workers force anyway.
+    # Bytes are counted as they come off the wire, before any gzip decoding.
+
+    def __init__(self, base):
+        parts = urlsplit(base)
+        self.host, self.port, self.prefix = parts.hostname, parts.port or 80, parts.path.rstrip("/")
+
+    def request(self, method, path, body=None):
+        headers = dict(HEADERS)
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+        try:
+            conn.request(method, self.prefix + path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+            encoding = resp.getheader("Content-Encoding")
+        finally:
+            conn.close()
+        return resp.status, data, encoding
+
+    def json(self, path):
+        status, data, encoding = self.request("GET", path)
+        if status != 200:
+            raise RuntimeError(f"GET {path} returned {status}")
+        return json.loads(gzip.decompress(data) if encoding == "gzip" else data)
+
+
+def component_props(node, found=None):
+    found = {} if found is None else found
+    if isinstance(node, list):
+        for child in node:
+            component_props(child, found)
+    elif isinstance(node, dict) and "props" in node:
+        props = node["props"]
+        if isinstance(props.get("id"), str):
+            found[props["id"]] = props
+        component_props(props.get("children"), found)
+    return found
+
+
+def page_load_callbacks(client):
+    # The callbacks the renderer fires as soon as the layout arrives: every
+    # server-side one without prevent_initial_call, with its inputs and state
+    # as the layout sets them.
+    props = component_props(client.json("/_dash-layout"))
+    callbacks = []
+    for dep in client.json("/_dash-dependencies"):
+        if dep.get("clientside_function") or dep.get("prevent_initial_call"):
+            continue
+        outputs = [{"id": o.split(".")[0], "property": o.split(".")[1]} for o in dep["output"].strip(".").split("...")]
+
+        def values(items):
+            return [dict(i, value=props.get(i["id"], {}).get(i["property"])) for i in items]
+
+        body = {
+            "output": dep["output"],
+            "outputs": outputs if dep["output"].startswith("..") else outputs[0],
+            "inputs": values(dep["inputs"]),
+            "state": values(dep["state"]),
+            "changedPropIds": [],
+        }
+        callbacks.append((f"callback {outputs[0]['id']}.{outputs[0]['property']}", body))
+    return callbacks
+
+
+def page_load(client, callbacks):
+    yield "page", "GET", "/", None
+    yield "layout", "GET", "/_dash-layout", None
+    yield "dependencies", "GET", "/_dash-dependencies", None
+    for name, body in callbacks:
+        yield name, "POST", "/_dash-update-component", body
+
+
+def drive(base, clients, duration, warmup):
+    client = Client(base)
+    callbacks = page_load_callbacks(client)
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+    samples = []
+    lock = threading.Lock()
+
+    def simulate():
+        own = Client(base)
+        while time.perf_counter() < deadline:
+            for name, method, path, body in page_load(own, callbacks):
+                t0 = time.perf_counter()
+                try:
+                    status, data, _ = own.request(method, path, body)
+                    ok = status in (200, 204)
+                except OSError:
+                    status, data, ok = None, b"", False
+                t1 = time.perf_counter()
+                if t0 >= measure_from and t1 <= deadline:
+                    with lock:
+                        samples.append((name, t1 - t0, len(data), ok))
+
+    threads = [threading.Thread(target=simulate, daemon=True) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(samples, duration, [name for name, *_ in page_load(client, callbacks)])
+
+
+def summarize(samples, duration, names):
+    def stats(rows):
+        latency = np.array([r[1] for r in rows]) * 1000
+        p50, p95, p99 = np.percentile(latency, [50, 95, 99]) if len(rows) else (np.nan,) * 3
+        return {
+            "requests": len(rows),
+            "errors": sum(not r[3] for r in rows),
+            "rps": len(rows) / duration,
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "bytes": int(np.mean([r[2] for r in rows if r[3]])) if any(r[3] for r in rows) else 0,
+            "mb_per_s": sum(r[2] for r in rows) / duration / 2**20,
+        }
+
+    return {"endpoints": {n: stats([r for r in samples if r[0] == n]) for n in names}, "total": stats(samples)}
+
+
+def serve(n_workers, timeout):
+    port = free_port()
+    cmd = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py",
+           "--workers", str(n_workers), "--bind", f"127.0.0.1:{port}", "app:server"]
+    proc = subprocess.Popen(cmd, cwd=REPO, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    if not wait_ready(base + "/ready", timeout):
+        proc.terminate()
+        raise RuntimeError(f"gunicorn with {n_workers} workers did not come up in {timeout}s")
+    return proc, base
+
+
+def latency_shares(result):
+    # Each endpoint's part of the summed p95s: how the page load's time splits
+    # up, which unlike the latencies themselves carries across machines
+    p95 = {name: r["p95_ms"] for name, r in result["endpoints"].items()}
+    total = sum(v for v in p95.values() if np.isfinite(v)) or 1.0
+    return {name: v / total for name, v in p95.items()}
+
+
+def baseline_entry(result, scaling):
+    shares = latency_shares(result)
+    return {
+        "endpoints": {name: {"bytes": r["bytes"], "p95_share": round(shares[name], 4)}
+                      for name, r in result["endpoints"].items()},
+        "scaling": round(scaling, 4),
+    }
+
+
+def compare(result, scaling, baseline, args):
+    failures = []
+    shares = latency_shares(result)
+    for name in sorted(set(result["endpoints"]) | set(baseline["endpoints"])):
+        now, then = result["endpoints"].get(name), baseline["endpoints"].get(name)
+        if then is None:
+            failures.append(f"{name}: not in the baseline (re-record it with --save-baseline)")
+            continue
+        if now is None:
+            failures.append(f"{name}: in the baseline but not requested on page load (re-record it)")
+            continue
+        if now["bytes"] > then["bytes"] * (1 + args.bytes_tolerance):
+            failures.append(f"{name}: {now['bytes']:,} bytes, baseline {then['bytes']:,}")
+        # The slack keeps a fast endpoint's scheduling noise from failing the run
+        if "p95_share" in then and shares[name] > then["p95_share"] * (1 + args.latency_tolerance) + args.latency_slack:
+            failures.append(f"{name}: {shares[name]:.0%} of the page's p95, baseline {then['p95_share']:.0%}")
+    if scaling < baseline["scaling"] * (1 - args.throughput_tolerance):
+        failures.append(f"total: throughput {scaling:.2f}x the first run's, baseline {baseline['scaling']:.2f}x")
+    if result["total"]["errors"]:
+        failures.append(f"total: {result['total']['errors']} failed requests")
+    return failures
+
+
+def report(label, result, baseline):
+    print(f"\n{label}")
+    print(f"  {'endpoint':<44} {'req/s':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'bytes':>10} {'MB/s':>6} {'err':>4}")
+    for name, r in [*result["endpoints"].items(), ("total", result["total"])]:
+        then = (baseline or {}).get("endpoints", {}).get(name)
+        delta = f"  ({r['bytes'] - then['bytes']:+,} B)" if then and r["bytes"] != then["bytes"] else ""
+        print(f"  {name[:44]:<44} {r['rps']:>7.1f} {r['p50_ms']:>7.0f} {r['p95_ms']:>7.0f} {r['p99_ms']:>7.0f} "
+              f"{r['bytes']:>10,} {r['mb_per_s']:>6.1f} {r['errors']:>4}{delta}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="gunicorn worker counts to run")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent simulated browsers")
+    parser.add_argument("--duration", type=float, default=15, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--url", help="load an already running server instead of starting gunicorn")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for gunicorn to come up")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="record this run as the baseline")
+    parser.add_argument("--no-compare", action="store_true")
+    parser.add_argument("--bytes-tolerance", type=float, default=0.05)
+    parser.add_argument("--latency-tolerance", type=float, default=0.5)
+    parser.add_argument("--latency-slack", type=float, default=0.05, help="absolute slack on an endpoint's p95 share")
+    parser.add_argument("--throughput-tolerance", type=float, default=0.3)
+    args = parser.parse_args()
+
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    failures = []
+    first_rps = None
+    for n in [None] if args.url else args.workers:
+        key = f"{n or 'url'}w-{args.clients}c"
+        proc, base = (None, args.url) if args.url else serve(n, args.timeout)
+        try:
+            result = drive(base, args.clients, args.duration, args.warmup)
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait(timeout=30)
+        first_rps = first_rps or result["total"]["rps"]
+        scaling = result["total"]["rps"] / first_rps
+        baseline = None if args.no_compare else baselines.get(key)
+        report(f"{n} workers, {args.clients} clients, {args.duration:.0f}s" if n else f"{base}, {args.clients} clients",
+               result, baseline)
+        if baseline is None and not args.no_compare:
+            failures.append(f"{key}: no baseline (record one with --save-baseline)")
+        elif baseline is not None:
+            failures += [f"{key} {failure}" for failure in compare(result, scaling, baseline, args)]
+        if args.save_baseline:
+            baselines[key] = dict(baseline_entry(result, scaling), recorded_at=time.strftime("%Y-%m-%d"))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nsaved baseline to {os.path.relpath(args.baseline, REPO)}")
+    for failure in failures:
+        print(f"REGRESSION: {failure}", file=sys.stderr)
+    # A run that records the baseline only reports how it differs from the old one
+    sys.exit(1 if failures and not args.save_baseline else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Peak and retained memory of every model fit and figure builder, by call site.
+
+Run from the repository root against the real data or a generated dataset:
+
+    python -m benchmarks.memory_profile
+    python -m benchmarks.memory_profile --n-per-uni 20000 --top 8
+"""
+import argparse
+import io
+import functools
+import json
+import linecache
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THIS_FILE = os.path.abspath(__file__)
+
+
+@functools.lru_cache(maxsize=None)
+def repo_path(filename):
+    if filename.startswith("<"):
+        return None
+    filename = os.path.abspath(filename)
+    if filename.startswith(REPO) and filename != THIS_FILE:
+        return os.path.relpath(filename, REPO)
+    return None
+
+
+def call_site(traceback):
+    # Innermost frame in this repository: the line of our code (a .copy(),
+    # a to_plotly_json(), a customdata array) that asked for the memory,
+    # however deep inside pandas/plotly the allocation really happened.
+    for frame in reversed(traceback):
+        path = repo_path(frame.filename)
+        if path is not None:
+            return f"{path}:{frame.lineno}"
+    return "<outside repo>"
+
+
+def growth_by_call_site(after, before):
+    # compare_to groups identical tracebacks first, so this loops over
+    # distinct allocation paths rather than over every live block
+    sizes = {}
+    for stat in after.compare_to(before, "traceback"):
+        if stat.size_diff > 0:
+            key = call_site(stat.traceback)
+            sizes[key] = sizes.get(key, 0) + stat.size_diff
+    return sorted(sizes.items(), key=lambda kv: -kv[1])
+
+
+class PeakSampler:
+    # tracemalloc only reports the peak total, so a sampler thread snapshots
+    # the heap each time it grows past the previous high-water mark; the last
+    # snapshot shows which call sites were holding memory at the peak.
+
+    def __init__(self, interval=0.02, growth=1.05):
+        self.interval = interval
+        self.growth = growth
+        self.snapshot = None
+        self._high = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._high = tracemalloc.get_traced_memory()[0]
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            current = tracemalloc.get_traced_memory()[0]
+            if current > self._high * self.growth:
+                self.snapshot = tracemalloc.take_snapshot()
+                self._high = tracemalloc.get_traced_memory()[0]
+
+
+def profile_step(name, fn):
+    before = tracemalloc.take_snapshot()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    with PeakSampler() as sampler:
+        result = fn()
+    seconds = time.perf_counter() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    # Taken while `result` is still referenced, so this is what the step leaves behind
+    after = tracemalloc.take_snapshot()
+
+    retained = growth_by_call_site(after, before)
+    at_peak = growth_by_call_site(sampler.snapshot, before) if sampler.snapshot is not None else retained
+    return result, {
+        "step": name,
+        "seconds": seconds,
+        "peak_bytes": peak - base,
+        "retained_bytes": current - base,
+        "peak_sites": at_peak,
+        "retained_sites": retained,
+    }
+
+
+def load_data(args):
+    if args.n_per_uni is None:
+        with open(args.data, "rb") as f:
+            return f.read()
+    from Data.DataCreation import generate
+    return generate(n_per_uni=args.n_per_uni, seed=args.seed).to_csv(index=False).encode()
+
+
+def run(raw, frames):
+    from graphs import (build_diagnostics_figure, build_mixed_effects_figure, build_predicted_vs_actual_figure,
+                        fit_full_model, fit_slope_models)
+    from Plots.graphs_full import graphs_full
+    from Plots.graphs_slr import graph_slr
+
+    data = pd.read_csv(io.BytesIO(raw))
+    # One untraced pass first: plotly builds its validators and statsmodels
+    # its formula machinery lazily, and a long-lived worker has already paid
+    # for those. Profile the steady state instead.
+    models = fit_slope_models(data)
+    for fig in [graph_slr(io.BytesIO(raw)), graphs_full(io.BytesIO(raw)), build_mixed_effects_figure(data, models),
+                build_predicted_vs_actual_figure(data, models["model1"]),
+                build_diagnostics_figure(data, {**models, "model_full": models["model1"]})]:
+        fig.to_json()
+    del models, fig
+
+    tracemalloc.start(frames)
+    reports = []
+    held = []  # keep every step's result alive so later steps don't get credit for freeing it
+
+    def step(name, fn):
+        result, report = profile_step(name, fn)
+        held.append(result)
+        reports.append(report)
+        return result
+
+    models = step("fit_slope_models", lambda: fit_slope_models(data))
+    model_full = step("fit_full_model", lambda: fit_full_model(data))
+    slr = step("graph_slr", lambda: graph_slr(io.BytesIO(raw)))
+    mlr = step("graphs_full", lambda: graphs_full(io.BytesIO(raw)))
+    me = step("build_mixed_effects_figure", lambda: build_mixed_effects_figure(data, models))
+    me_pred = step("build_predicted_vs_actual_figure", lambda: build_predicted_vs_actual_figure(data, model_full))
+    diagnostics = step("build_diagnostics_figure",
+                       lambda: build_diagnostics_figure(data, {**models, "model_full": model_full}))
+    for name, fig in [("slr", slr), ("mlr", mlr), ("me", me), ("me_pred", me_pred), ("diagnostics", diagnostics)]:
+        step(f"to_json[{name}]", fig.to_json)
+    return reports
+
+
+def mib(n):
+    return n / 2**20
+
+
+def print_report(reports, top, rows):
+    print(f"dataset rows: {rows}\n")
+    print(f"{'step':<36} {'seconds':>8} {'peak MiB':>9} {'retained MiB':>13}")
+    for r in reports:
+        print(f"{r['step']:<36} {r['seconds']:>8.2f} {mib(r['peak_bytes']):>9.1f} {mib(r['retained_bytes']):>13.1f}")
+    for r in reports:
+        print(f"\n== {r['step']}")
+        for label, key in [("live at peak", "peak_sites"), ("retained", "retained_sites")]:
+            print(f"  {label}:")
+            for site, size in r[key][:top]:
+                path, _, line = site.rpartition(":")
+                source = linecache.getline(os.path.join(REPO, path), int(line)).strip() if path else ""
+                print(f"    {mib(size):>8.2f} MiB  {site:<28} {source[:70]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data", default=os.path.join(REPO, "Data", "masters_salary.csv"))
+    parser.add_argument("--n-per-uni", type=int, default=None,
+                        help="profile a generated dataset of this size instead of --data")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--frames", type=int, default=20, help="traceback depth kept by tracemalloc")
+    parser.add_argument("--top", type=int, default=5, help="call sites shown per step")
+    parser.add_argument("--json", help="also write the full report here")
+    args = parser.parse_args()
+
+    raw = load_data(args)
+    reports = run(raw, args.frames)
+    tracemalloc.stop()
+
+    print_report(reports, args.top, raw.count(b"\n") - 1)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
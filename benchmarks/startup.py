@@ -0,0 +1,106 @@
+"""Import-time profile and worker boot budget for app.py.
+
+Each measurement runs in a fresh interpreter, from the repository root:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --budget-import 1.0 --budget-boot 2.0
+
+Exits non-zero when `import app` or a warm worker boot (import, init() from
+the on-disk store cache, first page and layout) goes over budget. The cold
+boot, which has to fit every model, is reported but not budgeted.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules app.py must not import before the code that needs them runs
+HEAVY = ["pandas", "statsmodels", "scipy", "plotly.graph_objects", "plotly.express", "patsy"]
+
+BOOT = """
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t_import = time.perf_counter() - t0
+app.init()
+t_init = time.perf_counter() - t0 - t_import
+client = app.server.test_client()
+assert client.get("/").status_code == 200
+assert client.get("/_dash-layout").status_code == 200
+t_total = time.perf_counter() - t0
+print(json.dumps({"import": t_import, "init": t_init, "total": t_total,
+                  "loaded": [m for m in HEAVY if m in sys.modules]}))
+"""
+
+
+def python(code, env=None, importtime=False):
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    result = subprocess.run(cmd, cwd=REPO, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return result
+
+
+def import_profile():
+    result = python("import app", importtime=True)
+    by_package = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|").split("|")]
+        package = name.split(".")[0]
+        by_package[package] = by_package.get(package, 0) + int(self_us)
+        if name == "app":
+            total = int(cumulative_us)
+    return total / 1e6, sorted(by_package.items(), key=lambda kv: -kv[1])
+
+
+def boot(cache_dir=None):
+    env = dict(os.environ)
+    if cache_dir is not None:
+        env["STORE_CACHE_DIR"] = cache_dir
+    code = f"HEAVY = {HEAVY!r}\n" + BOOT
+    return json.loads(python(code, env=env).stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-import", type=float, default=float(os.environ.get("BUDGET_IMPORT_SECONDS", 1.5)))
+    parser.add_argument("--budget-boot", type=float, default=float(os.environ.get("BUDGET_BOOT_SECONDS", 3.0)))
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--skip-cold", action="store_true", help="don't measure a boot with an empty store cache")
+    args = parser.parse_args()
+
+    total, packages = import_profile()
+    print(f"import app: {total:.2f}s (budget {args.budget_import:.2f}s)")
+    for package, self_us in packages[:args.top]:
+        print(f"  {self_us / 1e6:>6.3f}s  {package}")
+
+    boot(None)  # make sure the shared cache is populated for the warm run
+    warm = boot(None)
+    print(f"\nwarm boot: {warm['total']:.2f}s (import {warm['import']:.2f}s, init {warm['init']:.2f}s) "
+          f"(budget {args.budget_boot:.2f}s)")
+    print(f"  heavy modules loaded by a warm boot: {', '.join(warm['loaded']) or 'none'}")
+
+    if not args.skip_cold:
+        with tempfile.TemporaryDirectory() as empty_cache:
+            cold = boot(empty_cache)
+        print(f"cold boot: {cold['total']:.2f}s (import {cold['import']:.2f}s, init {cold['init']:.2f}s)")
+
+    failures = []
+    if total > args.budget_import:
+        failures.append(f"import app took {total:.2f}s > {args.budget_import:.2f}s")
+    if warm["total"] > args.budget_boot:
+        failures.append(f"warm boot took {warm['total']:.2f}s > {args.budget_boot:.2f}s")
+    for failure in failures:
+        print(f"OVER BUDGET: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
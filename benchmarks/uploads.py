@@ -0,0 +1,51 @@
+"""Check that an upload with columns of its own validates and builds.
+
+Run from the repository root:
+
+    python -m benchmarks.uploads
+
+Adds a text column and a numeric column the models don't use to the
+bundled data, builds a preview store from it and exits non-zero unless the
+store keeps only the model's columns.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data", default=os.path.join(REPO, "Data", "masters_salary.csv"))
+    args = parser.parse_args()
+
+    import pandas as pd
+
+    import uploads
+    from shared_store import build_store
+
+    df = pd.read_csv(args.data)
+    df.insert(0, "student_name", [f"Graduate {i}" for i in range(len(df))])
+    df["cohort"] = 2024
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "upload.csv")
+        df.to_csv(path, index=False)
+        with open(path, "rb") as f:
+            print(f"validate: {uploads.validate(f.read())}")
+        store = build_store(path, stage="preview")
+
+    expected = uploads.COLUMNS
+    kept = {"salary_data": list(store.frame("salary_data").columns),
+            "rows": [store.json("rows")["group"]["column"], *store.json("rows")["columns"]]}
+    failures = [f"{name} has {columns}, expected {expected}" for name, columns in kept.items() if columns != expected]
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    if not failures:
+        print("built with the extra columns dropped")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
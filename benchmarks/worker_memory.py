@@ -0,0 +1,105 @@
+"""Per-worker memory of `gunicorn app:server` at different worker counts.
+
+Run from the repository root (Linux only, reads /proc):
+
+    python benchmarks/worker_memory.py --workers 1 4 16
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(p) for p in f.read().split()]
+
+
+def memory_kb(pid):
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def wait_ready(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as resp:
+                if resp.status == 200:
+                    return True
+        except OSError:
+            time.sleep(0.25)
+    return False
+
+
+def run(n_workers, preload, timeout):
+    port = free_port()
+    env = dict(os.environ, GUNICORN_PRELOAD="1" if preload else "0")
+    cmd = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py",
+           "--workers", str(n_workers), "--bind", f"127.0.0.1:{port}", "app:server"]
+    start = time.time()
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        if not wait_ready(base + "/", timeout):
+            raise RuntimeError(f"gunicorn with {n_workers} workers did not come up in {timeout}s")
+        # Without preload each worker imports the app lazily; wait until all of them answer.
+        while len(children(proc.pid)) < n_workers and time.time() - start < timeout:
+            time.sleep(0.25)
+        for _ in range(4 * n_workers):
+            for path in ("/", "/_dash-layout"):
+                urllib.request.urlopen(base + path, timeout=60).read()
+        boot = time.time() - start
+
+        workers = [memory_kb(pid) for pid in children(proc.pid)]
+        master = memory_kb(proc.pid)
+        return {
+            "workers": n_workers,
+            "preload": preload,
+            "boot_s": boot,
+            "worker_rss_mb": sum(w["rss"] for w in workers) / len(workers) / 1024,
+            "worker_pss_mb": sum(w["pss"] for w in workers) / len(workers) / 1024,
+            "worker_uss_mb": sum(w["uss"] for w in workers) / len(workers) / 1024,
+            "total_pss_mb": (master["pss"] + sum(w["pss"] for w in workers)) / 1024,
+        }
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--no-compare", action="store_true", help="only measure the preloaded configuration")
+    args = parser.parse_args()
+
+    modes = [True] if args.no_compare else [False, True]
+    print(f"{'workers':>7} {'preload':>7} {'boot s':>7} {'RSS/w MB':>9} {'PSS/w MB':>9} {'USS/w MB':>9} {'total PSS MB':>12}")
+    for n in args.workers:
+        for preload in modes:
+            r = run(n, preload, args.timeout)
+            print(f"{r['workers']:>7} {str(r['preload']):>7} {r['boot_s']:>7.1f} {r['worker_rss_mb']:>9.1f} "
+                  f"{r['worker_pss_mb']:>9.1f} {r['worker_uss_mb']:>9.1f} {r['total_pss_mb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
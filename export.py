@@ -0,0 +1,315 @@
+import argparse
+import html
+import json
+import os
+import re
+import shutil
+import textwrap
+
+import plotly.offline
+
+MATHJAX_URL = "https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-chtml.js"
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+# Callbacks don't exist in a static page, so controls that only make sense
+# with a server behind them are exported disabled, with this note instead.
+STATIC_NOTES = {
+    "re-status": "Refitting other random effects structures needs the live app; this is the full model from above.",
+    "upload-status": "Uploading your own data needs the live app.",
+    "calc-ols": "The calculator needs the live app.",
+}
+
+VOID_TAGS = {"img", "hr", "br", "input"}
+ATTRIBUTES = {"id": "id", "href": "href", "src": "src", "alt": "alt", "title": "title", "target": "target",
+              "htmlFor": "for", "role": "role"}
+UNITLESS = {"lineHeight", "opacity", "zIndex", "flex", "fontWeight", "order"}
+
+MATH = re.compile(r"\$\$.+?\$\$|\$[^$\n]+?\$|\\\(.+?\\\)", re.S)
+HEADING = re.compile(r"(#{1,6})\s+(.*?)\s*#*$")
+LIST_ITEM = re.compile(r"[-*+]\s+(.*)")
+
+FIGURE_LOADER = """
+document.querySelectorAll("div[data-figure]").forEach(function (div) {
+    var inline = document.getElementById(div.id + "-figure");
+    var figure = inline ? Promise.resolve(JSON.parse(inline.textContent))
+                        : fetch(div.dataset.figure).then(function (r) { return r.json(); });
+    figure.then(function (fig) {
+        Plotly.newPlot(div, fig.data, fig.layout, {responsive: true});
+    });
+});
+"""
+
+
+def css(style):
+    rules = []
+    for key, value in (style or {}).items():
+        if isinstance(value, (int, float)) and key not in UNITLESS:
+            value = f"{value}px"
+        name = re.sub("([A-Z])", r"-\1", key).lower()
+        rules.append(f"{name}: {value}")
+    return "; ".join(rules)
+
+
+def attrs(component, classes=(), **extra):
+    class_names = [c for c in classes if c]
+    own = getattr(component, "className", None) or getattr(component, "class_name", None)
+    if own:
+        class_names.append(own)
+    pairs = {}
+    for prop, attribute in ATTRIBUTES.items():
+        value = getattr(component, prop, None)
+        if isinstance(value, str):
+            pairs[attribute] = value[1:] if value.startswith("/assets/") else value
+    if class_names:
+        pairs["class"] = " ".join(class_names)
+    if getattr(component, "style", None):
+        pairs["style"] = css(component.style)
+    pairs.update(extra)
+    return "".join(f' {k}="{html.escape(str(v))}"' if v is not True else f" {k}"
+                   for k, v in pairs.items() if v is not None and v is not False)
+
+
+def inline(text):
+    text = html.escape(text, quote=False)
+    text = re.sub(r"`([^`]+)`", r"<code>\1</code>", text)
+    text = re.sub(r"\*\*(.+?)\*\*", r"<strong>\1</strong>", text)
+    text = re.sub(r"\*([^*\s][^*]*?)\*", r"<em>\1</em>", text)
+    return re.sub(r"\[([^\]]+)\]\(([^)\s]+)\)", r'<a href="\2">\1</a>', text)
+
+
+def markdown(text, mathjax=False):
+    # Enough Markdown for the case study (headings, paragraphs, lists, fenced
+    # code, emphasis, links). With mathjax=True, $...$, \(...\) and $$...$$
+    # are kept verbatim for MathJax to typeset in the browser.
+    math = []
+    if mathjax:
+        def stash(match):
+            math.append(match.group(0))
+            return f"\x00{len(math) - 1}\x00"
+        text = MATH.sub(stash, text)
+
+    out, paragraph, items, code = [], [], [], None
+
+    def flush():
+        if paragraph:
+            out.append(f"<p>{inline(' '.join(paragraph))}</p>")
+            paragraph.clear()
+        if items:
+            out.append("<ul>" + "".join(f"<li>{inline(item)}</li>" for item in items) + "</ul>")
+            items.clear()
+
+    for line in textwrap.dedent(text).splitlines():
+        stripped = line.strip()
+        if code is not None:
+            if stripped.startswith("```"):
+                out.append(f"<pre><code>{html.escape(textwrap.dedent(chr(10).join(code)))}</code></pre>")
+                code = None
+            else:
+                code.append(line)
+            continue
+        if stripped.startswith("```"):
+            flush()
+            code = [stripped[3:]] if stripped[3:].strip("`") else []
+            continue
+        if not stripped:
+            flush()
+            continue
+        heading = HEADING.match(stripped)
+        item = LIST_ITEM.match(stripped)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            out.append(f"<h{level}>{inline(heading.group(2))}</h{level}>")
+        elif item:
+            if paragraph:
+                flush()
+            items.append(item.group(1))
+        elif items:
+            items[-1] += " " + stripped
+        else:
+            paragraph.append(stripped)
+    flush()
+
+    rendered = "\n".join(out)
+    return re.sub("\x00(\\d+)\x00", lambda m: html.escape(math[int(m.group(1))], quote=False), rendered)
+
+
+class StaticPage:
+    # Walks a Dash layout and writes the HTML that the browser would
+    # otherwise build from it, collecting each dcc.Graph's figure on the way.
+
+    def __init__(self):
+        self.figures = {}
+
+    def render(self, component):
+        if component is None:
+            return ""
+        if isinstance(component, (list, tuple)):
+            return "".join(self.render(c) for c in component)
+        if isinstance(component, (str, int, float)):
+            return html.escape(str(component), quote=False)
+        method = getattr(self, f"_{component._namespace}_{component._type}", None)
+        if method is not None:
+            return method(component)
+        if component._namespace == "dash_html_components":
+            return self.element(component._type.lower(), component)
+        raise ValueError(f"don't know how to export {component._namespace}.{component._type}")
+
+    def element(self, tag, component, classes=(), children=None, **extra):
+        if tag in VOID_TAGS:
+            return f"<{tag}{attrs(component, classes, **extra)}>"
+        children = getattr(component, "children", None) if children is None else children
+        return f"<{tag}{attrs(component, classes, **extra)}>{self.render(children)}</{tag}>"
+
+    def _dash_core_components_Markdown(self, component):
+        mathjax = getattr(component, "mathjax", False)
+        body = markdown(component.children or "", mathjax)
+        return f"<div{attrs(component, ['tex2jax_process' if mathjax else None])}>{body}</div>"
+
+    def _dash_core_components_Graph(self, component):
+        graph_id = getattr(component, "id", None) or f"graph-{len(self.figures) + 1}"
+        self.figures[graph_id] = component.figure
+        return f'<div id="{html.escape(graph_id)}" class="dash-graph" data-figure="figures/{graph_id}.json"></div>'
+
+    def _dash_core_components_Checklist(self, component):
+        options = []
+        for option in component.options:
+            checked = " checked" if option["value"] in (component.value or []) else ""
+            input_style = css(getattr(component, "inputStyle", None))
+            options.append(f'<label><input type="checkbox" disabled{checked} style="{input_style}">'
+                           f"{html.escape(option['label'])}</label>")
+        return f"<div{attrs(component)}>{''.join(options)}</div>"
+
+    def _dash_core_components_Dropdown(self, component):
+        options = "".join(f'<option{" selected" if o["value"] == component.value else ""}>'
+                          f"{html.escape(o['label'])}</option>" for o in component.options)
+        return f'<select{attrs(component, ["form-select"])} disabled>{options}</select>'
+
+    def _dash_core_components_Input(self, component):
+        value = getattr(component, "value", None)
+        return self.element("input", component, type=getattr(component, "type", None) or "text",
+                            value=value, disabled=True)
+
+    def _dash_core_components_Upload(self, component):
+        return self.element("div", component)
+
+    def _dash_core_components_Location(self, component):
+        return ""
+
+    _dash_core_components_Store = _dash_core_components_Interval = _dash_core_components_Location
+    _dash_core_components_Tooltip = _dash_core_components_Location
+
+    def _dash_bootstrap_components_Navbar(self, component):
+        expand = component.expand if isinstance(getattr(component, "expand", None), str) else None
+        return self.element("nav", component, ["navbar", f"navbar-expand-{expand}" if expand else "navbar-expand",
+                                               "navbar-light", "bg-light"])
+
+    def _dash_bootstrap_components_Nav(self, component):
+        return self.element("div", component, ["nav", "nav-pills" if getattr(component, "pills", None) else None,
+                                               "flex-column" if getattr(component, "vertical", None) else None])
+
+    def _dash_bootstrap_components_NavLink(self, component):
+        return self.element("a", component, ["nav-link"])
+
+    def _dash_bootstrap_components_Row(self, component):
+        return self.element("div", component, ["row"])
+
+    def _dash_bootstrap_components_Col(self, component):
+        sizes = [f"col-{size}-{getattr(component, size)}" for size in ("xs", "sm", "md", "lg", "xl")
+                 if getattr(component, size, None)]
+        return self.element("div", component, sizes or ["col"])
+
+    def _dash_bootstrap_components_Button(self, component):
+        return self.element("button", component, ["btn", f"btn-{getattr(component, 'color', None) or 'primary'}"],
+                            disabled=True)
+
+    def _dash_bootstrap_components_Alert(self, component):
+        return self.element("div", component, ["alert", f"alert-{getattr(component, 'color', None) or 'success'}"],
+                            role="alert")
+
+    def _dash_bootstrap_components_Progress(self, component):
+        return self.element("div", component, ["progress"], children=[])
+
+
+def figure_json(figure):
+    return json.dumps(figure, separators=(",", ":"))
+
+
+def export_site(out_dir, data_file=None, sidecar=False, mathjax_url=MATHJAX_URL):
+    import app
+    from refresh import load_store
+
+    store = app.current_store() if data_file is None else load_store(data_file)
+    layout = app.serve_layout(store, lazy=False)
+    for component_id, note in STATIC_NOTES.items():
+        layout[component_id].children = note
+    # The app's MLR figure leaves hover details to a callback; a static page
+    # needs them in the figure
+    from Plots.graphs_full import graphs_full
+    layout["mlr-graph"].figure = json.loads(graphs_full(store.frame("salary_data")).to_json())
+
+    page = StaticPage()
+    body = page.render(layout)
+
+    os.makedirs(os.path.join(out_dir, "assets"), exist_ok=True)
+    stylesheets = list(app.app.config.external_stylesheets)
+    for name in sorted(os.listdir(ASSETS_DIR)):
+        # assets/*.js only holds clientside callbacks, which need Dash
+        if not name.endswith(".js"):
+            shutil.copy2(os.path.join(ASSETS_DIR, name), os.path.join(out_dir, "assets", name))
+        if name.endswith(".css"):
+            stylesheets.append(f"assets/{name}")
+    with open(os.path.join(out_dir, "plotly.min.js"), "w") as f:
+        f.write(plotly.offline.get_plotlyjs())
+
+    scripts = []
+    if sidecar:
+        os.makedirs(os.path.join(out_dir, "figures"), exist_ok=True)
+        for graph_id, figure in page.figures.items():
+            with open(os.path.join(out_dir, "figures", f"{graph_id}.json"), "w") as f:
+                f.write(figure_json(figure))
+    else:
+        for graph_id, figure in page.figures.items():
+            data = figure_json(figure).replace("</", "<\\/")
+            scripts.append(f'<script type="application/json" id="{graph_id}-figure">{data}</script>')
+
+    mathjax_config = {
+        "tex": {"inlineMath": [["$", "$"], ["\\(", "\\)"]], "displayMath": [["$$", "$$"]]},
+        "options": {"ignoreHtmlClass": "tex2jax_ignore", "processHtmlClass": "tex2jax_process"},
+    }
+    links = "\n".join(f'<link rel="stylesheet" href="{html.escape(href)}">' for href in stylesheets)
+    document = f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{html.escape(app.app.title)}</title>
+{links}
+<script>window.MathJax = {json.dumps(mathjax_config)};</script>
+<script src="{html.escape(mathjax_url)}" async></script>
+<script src="plotly.min.js"></script>
+</head>
+<body class="tex2jax_ignore">
+{body}
+{chr(10).join(scripts)}
+<script>{FIGURE_LOADER}</script>
+</body>
+</html>
+"""
+    with open(os.path.join(out_dir, "index.html"), "w", encoding="utf-8") as f:
+        f.write(document)
+    return {"version": store.json("meta")["version"], "figures": sorted(page.figures)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the case study as a static HTML site.")
+    parser.add_argument("out", nargs="?", default="site")
+    parser.add_argument("--data", help="dataset to build from (default: the one the app serves)")
+    parser.add_argument("--sidecar", action="store_true",
+                        help="write figures to figures/*.json instead of inlining them; "
+                             "the page then has to be served over HTTP rather than opened as a file")
+    parser.add_argument("--mathjax-url", default=MATHJAX_URL)
+    args = parser.parse_args()
+
+    result = export_site(args.out, args.data, args.sidecar, args.mathjax_url)
+    print(f"exported store {result['version'][:12]} with figures {', '.join(result['figures'])} to {args.out}/")
@@ -1,43 +1,34 @@
 import plotly.graph_objects as go
-import plotly.express as px
 import numpy as np
 import pandas as pd
-import scipy.stats as stats
-import statsmodels.api as sm
 import statsmodels.formula.api as smf
 import warnings
 from statsmodels.tools.sm_exceptions import ConvergenceWarning
+from Models.compress import fit_records, worth_compressing
+from Models.fitting import fit_mixedlm
+from Plots.rows import linear, row_meta
+# Convergence is tracked per fit by fit_mixedlm (see /fits), not by warnings
 warnings.filterwarnings("ignore", category=ConvergenceWarning)
 
-salary_data = pd.read_csv("Data/masters_salary.csv")
-
-model1 = smf.mixedlm(
-    "first_job_salary ~ masters_gpa",
-    data=salary_data,
-    groups=salary_data["masters_university"],
-    re_formula="~masters_gpa"
-).fit()
-
-model2 = smf.mixedlm(
-    "first_job_salary ~ relevant_work_years",
-    data=salary_data,
-    groups=salary_data["masters_university"],
-    re_formula="~relevant_work_years"
-).fit()
-
-model3 = smf.mixedlm(
-    "first_job_salary ~ years_python",
-    data=salary_data,
-    groups=salary_data["masters_university"],
-    re_formula="~years_python"
-).fit()
-
-model4 = smf.mixedlm(
-    "first_job_salary ~ years_sql",
-    data=salary_data,
-    groups=salary_data["masters_university"],
-    re_formula="~years_sql"
-).fit()
+SLOPE_PREDICTORS = ["masters_gpa", "relevant_work_years", "years_python", "years_sql"]
+
+def fit_slope_model(data: pd.DataFrame, x_var, name=None, stage="exact", records=None):
+    if stage == "preview":
+        from Models.moments import fit_moments
+        return fit_moments(data, [x_var], name=name or x_var)
+    # Same REML fit from the frequency-weighted records (Models/compress.py)
+    # when duplicate rows make that much smaller than the data
+    if worth_compressing(data, [x_var]):
+        return fit_records(data, [x_var], name=name or x_var, records=records)
+    return fit_mixedlm(smf.mixedlm(
+        f"first_job_salary ~ {x_var}",
+        data=data,
+        groups=data["masters_university"],
+        re_formula=f"~{x_var}"
+    ), name=name or x_var)
+
+def fit_slope_models(data: pd.DataFrame):
+    return {f"model{i}": fit_slope_model(data, x_var, f"model{i}") for i, x_var in enumerate(SLOPE_PREDICTORS, start=1)}
 
 def create_spaghetti_traces(model, x_var, data, group_name='masters_university'):
     colors = {
@@ -77,11 +68,87 @@ def create_spaghetti_traces(model, x_var, data, group_name='masters_university')
         ))
     return traces
 
-def build_mixed_effects_figure():
-    traces_gpa   = create_spaghetti_traces(model1, 'masters_gpa', salary_data)
-    traces_work  = create_spaghetti_traces(model2, 'relevant_work_years', salary_data)
-    traces_py    = create_spaghetti_traces(model3, 'years_python', salary_data)
-    traces_sql   = create_spaghetti_traces(model4, 'years_sql', salary_data)
+MANY_GROUPS_THRESHOLD = 12
+
+def group_lines(model, x_var, x_vals):
+    groups = list(model.random_effects)
+    effects = np.vstack([model.random_effects[g][['Group', x_var]].to_numpy(dtype=float) for g in groups])
+    intercepts = model.fe_params['Intercept'] + effects[:, 0]
+    slopes = model.fe_params[x_var] + effects[:, 1]
+    # (groups, points) in one broadcast instead of one evaluation per group
+    return np.array(groups, dtype=object), intercepts[:, None] + slopes[:, None] * x_vals[None, :]
+
+def pack_lines(x_vals, y_lines):
+    # One NaN column after every line so a single trace draws all of them.
+    n_groups = y_lines.shape[0]
+    gap = np.full((n_groups, 1), np.nan)
+    x = np.hstack([np.broadcast_to(x_vals, y_lines.shape), gap]).ravel()
+    y = np.hstack([y_lines, gap]).ravel()
+    return x, y
+
+def create_packed_spaghetti_traces(model, x_var, data, top_k=None, block=0):
+    # Group lines are straight, so their endpoints are all the browser needs.
+    x_vals = np.array([data[x_var].min(), data[x_var].max()], dtype=float)
+    groups, y_lines = group_lines(model, x_var, x_vals)
+    y_fixed = model.fe_params['Intercept'] + model.fe_params[x_var] * x_vals
+
+    deviation = y_lines - y_fixed[None, :]
+    # RMS distance from the population line over the plotted range
+    spread = np.sqrt((deviation[:, 0] ** 2 + deviation[:, 0] * deviation[:, 1] + deviation[:, 1] ** 2) / 3)
+    if top_k is not None and top_k < len(groups):
+        keep = np.argsort(spread)[::-1][:top_k]
+        groups, y_lines, deviation = groups[keep], y_lines[keep], deviation[keep]
+
+    traces = [go.Scatter(
+        x=x_vals,
+        y=y_fixed,
+        mode='lines',
+        line=dict(color='black', dash='dash'),
+        name='Population Average'
+    )]
+
+    above = deviation.mean(axis=1) >= 0
+    for mask, label, color in [(above, 'Above average', '#00629B'), (~above, 'Below average', '#D62728')]:
+        x, y = pack_lines(x_vals, y_lines[mask])
+        traces.append(go.Scatter(
+            x=x,
+            y=y,
+            mode='lines',
+            name=f'{label} ({int(mask.sum())} programs)',
+            line=dict(color=color, width=1),
+            opacity=0.35,
+            customdata=np.repeat(groups[mask], len(x_vals) + 1),
+            hovertemplate="<b>%{customdata}</b><br>%{x}<br>Salary: %{y:.0f}<extra></extra>",
+            meta={'role': 'groups', 'block': block},
+        ))
+
+    # Filled in the browser (assets/spaghetti.js) with the hovered or clicked line.
+    traces.append(go.Scatter(
+        x=[],
+        y=[],
+        mode='lines',
+        name='Highlighted program',
+        line=dict(color='black', width=3),
+        hoverinfo='skip',
+        meta={'role': 'highlight', 'block': block},
+    ))
+    return traces
+
+def build_mixed_effects_figure(salary_data: pd.DataFrame, models=None, many_groups=None, top_k=None):
+    if models is None:
+        models = fit_slope_models(salary_data)
+    if many_groups is None:
+        many_groups = salary_data['masters_university'].nunique() > MANY_GROUPS_THRESHOLD
+
+    def traces(name, x_var, block):
+        if many_groups:
+            return create_packed_spaghetti_traces(models[name], x_var, salary_data, top_k, block)
+        return create_spaghetti_traces(models[name], x_var, salary_data)
+
+    traces_gpa   = traces("model1", 'masters_gpa', 0)
+    traces_work  = traces("model2", 'relevant_work_years', 1)
+    traces_py    = traces("model3", 'years_python', 2)
+    traces_sql   = traces("model4", 'years_sql', 3)
 
     fig = go.Figure()
 
@@ -167,7 +234,20 @@ def build_mixed_effects_figure():
 
     return fig
 
-def build_predicted_vs_actual_figure(data: pd.DataFrame):
+def fit_full_model(data: pd.DataFrame, stage="exact", records=None):
+    if stage == "preview":
+        from Models.moments import fit_moments
+        return fit_moments(data, SLOPE_PREDICTORS, name="model_full")
+    if worth_compressing(data, SLOPE_PREDICTORS):
+        return fit_records(data, SLOPE_PREDICTORS, name="model_full", records=records)
+    return fit_mixedlm(smf.mixedlm(
+        "first_job_salary ~ masters_gpa + relevant_work_years + years_python + years_sql",
+        data=data,
+        groups=data["masters_university"],
+        re_formula="~masters_gpa + relevant_work_years + years_python + years_sql"
+    ), name="model_full")
+
+def build_predicted_vs_actual_figure(data: pd.DataFrame, model_full=None):
 
     colors = {
         "UC Berkeley": "#FDB515",
@@ -179,12 +259,8 @@ def build_predicted_vs_actual_figure(data: pd.DataFrame):
 
     universities = sorted(data['masters_university'].unique())
 
-    model_full = smf.mixedlm(
-        "first_job_salary ~ masters_gpa + relevant_work_years + years_python + years_sql",
-        data=data,
-        groups=data["masters_university"],
-        re_formula="~masters_gpa + relevant_work_years + years_python + years_sql"
-    ).fit()
+    if model_full is None:
+        model_full = fit_full_model(data)
 
     data = data.copy()
     data['pred_full'] = model_full.predict()
@@ -209,8 +285,10 @@ def build_predicted_vs_actual_figure(data: pd.DataFrame):
             y=subset['first_job_salary'],
             mode='markers',
             name=uni,
-            marker=dict(size=7, opacity=0.8, color=colors[uni]),
-            hovertemplate=f"<b>{uni}</b><br>Predicted: %{{x:.0f}}<br>Actual: %{{y:.0f}}<extra></extra>"
+            marker=dict(size=7, opacity=0.8, color=colors.get(uni, "#999999")),
+            hovertemplate=f"<b>{uni}</b><br>Predicted: %{{x:.0f}}<br>Actual: %{{y:.0f}}<extra></extra>",
+            # model_full.predict() is the fixed part, X @ fe_params
+            meta=row_meta(uni, x=linear(model_full.fe_params), y='first_job_salary'),
         ))
 
     frames = []
@@ -284,4 +362,136 @@ def build_predicted_vs_actual_figure(data: pd.DataFrame):
         legend_title_text="University"
     )
 
-    return fig
\ No newline at end of file
+    return fig
+
+
+DIAGNOSTIC_MODELS = [
+    ("model_full", "Full Model"),
+    ("model1", "GPA"),
+    ("model2", "Work Experience"),
+    ("model3", "Python Experience"),
+    ("model4", "SQL Experience"),
+]
+
+def create_diagnostic_traces(diagnostics, max_points=101, per_group=True):
+    from Models.diagnostics import qq_points
+
+    colors = {
+        "UC Berkeley": "#FDB515",
+        "Stanford": "#d62728",
+        "UC San Diego": "#00629B",
+        "San Jose State": "#7ee081",
+        "UCLA": "#bf94e4"
+    }
+    # (trace, subplot column) pairs; every trace is a fixed number of points
+    # whatever the number of rows behind it.
+    traces = []
+
+    x, y = qq_points(diagnostics["residuals"], max_points)
+    traces.append((go.Scatter(
+        x=x, y=y, mode='markers', name='All Universities', legendgroup='all',
+        marker=dict(color='black', size=6),
+        hovertemplate="Normal: %{x:.2f}<br>Residual: %{y:.2f}<extra>All Universities</extra>"
+    ), 1))
+    bins = diagnostics["bins"].summary()
+    upper, lower = bins["mean"] + 2 * bins["sd"], bins["mean"] - 2 * bins["sd"]
+    traces.append((go.Scatter(
+        x=np.concatenate([bins["center"], bins["center"][::-1]]),
+        y=np.concatenate([upper, lower[::-1]]),
+        fill='toself', fillcolor='rgba(0,0,0,0.1)', line=dict(width=0),
+        name='±2 SD', legendgroup='all', showlegend=False, hoverinfo='skip'
+    ), 2))
+    traces.append((go.Scatter(
+        x=bins["center"], y=bins["mean"], mode='lines+markers', name='All Universities', legendgroup='all',
+        showlegend=False, line=dict(color='black'), customdata=np.column_stack([bins["count"], bins["sd"]]),
+        hovertemplate="Fitted: %{x:,.0f}<br>Mean residual: %{y:,.0f}<br>SD: %{customdata[1]:,.0f}"
+                      "<br>Rows: %{customdata[0]:,.0f}<extra>All Universities</extra>"
+    ), 2))
+
+    if per_group:
+        for uni, sketch in diagnostics["residuals_by_group"].items():
+            x, y = qq_points(sketch, max_points)
+            traces.append((go.Scatter(
+                x=x, y=y, mode='markers', name=uni, legendgroup=uni,
+                marker=dict(size=5, opacity=0.7, color=colors.get(uni)),
+                hovertemplate=f"Normal: %{{x:.2f}}<br>Residual: %{{y:.2f}}<extra>{uni}</extra>"
+            ), 1))
+            bins = diagnostics["bins_by_group"][uni].summary()
+            traces.append((go.Scatter(
+                x=bins["center"], y=bins["mean"], mode='lines', name=uni, legendgroup=uni, showlegend=False,
+                line=dict(color=colors.get(uni), width=1.5), customdata=bins["count"],
+                hovertemplate=f"Fitted: %{{x:,.0f}}<br>Mean residual: %{{y:,.0f}}"
+                              f"<br>Rows: %{{customdata:,.0f}}<extra>{uni}</extra>"
+            ), 2))
+
+    for term, sketch in diagnostics["random_effects"].items():
+        term = "Intercept" if term == "Group" else term
+        x, y = qq_points(sketch, max_points)
+        traces.append((go.Scatter(
+            x=x, y=y, mode='markers', name=f"u: {term}", marker=dict(size=8, symbol='diamond'),
+            hovertemplate=f"Normal: %{{x:.2f}}<br>Standardized effect: %{{y:.2f}}<extra>{term}</extra>"
+        ), 3))
+    return traces
+
+def build_diagnostics_figure(data: pd.DataFrame, models, max_points=101, many_groups=None):
+    from plotly.subplots import make_subplots
+    from Models.diagnostics import residual_diagnostics
+
+    if many_groups is None:
+        many_groups = data['masters_university'].nunique() > MANY_GROUPS_THRESHOLD
+
+    fig = make_subplots(rows=1, cols=3, horizontal_spacing=0.07, subplot_titles=[
+        "Normal Q-Q: Standardized Residuals",
+        "Residuals vs Fitted (binned)",
+        "Normal Q-Q: Random Effects",
+    ])
+    for col in (1, 3):
+        fig.add_trace(go.Scatter(
+            x=[-3.5, 3.5], y=[-3.5, 3.5], mode='lines', line=dict(color='grey', dash='dash'),
+            showlegend=False, hoverinfo='skip'
+        ), row=1, col=col)
+    fig.add_hline(y=0, line=dict(color='grey', dash='dash'), row=1, col=2)
+
+    owners = [None, None]
+    for i, (name, label) in enumerate(DIAGNOSTIC_MODELS):
+        diagnostics = residual_diagnostics(models[name], data['masters_university'])
+        for trace, col in create_diagnostic_traces(diagnostics, max_points, per_group=not many_groups):
+            trace.visible = i == 0
+            fig.add_trace(trace, row=1, col=col)
+            owners.append(name)
+
+    buttons = [
+        dict(
+            label=label,
+            method='update',
+            args=[
+                {'visible': [owner is None or owner == name for owner in owners]},
+                {'title': {'text': f'Residual Diagnostics: {label}'}}
+            ]
+        )
+        for name, label in DIAGNOSTIC_MODELS
+    ]
+
+    fig.update_layout(
+        updatemenus=[dict(
+            type='buttons',
+            direction='right',
+            x=0.5, y=1.18,
+            xanchor='center',
+            buttons=buttons,
+            showactive=True
+        )],
+        title={'text': f'Residual Diagnostics: {DIAGNOSTIC_MODELS[0][1]}'},
+        legend={'title': {'text': "Master's Program University"}},
+        template='plotly_white',
+        height=550,
+        width=1300,
+        margin=dict(t=140)
+    )
+    fig.update_xaxes(title_text="Normal quantile", row=1, col=1)
+    fig.update_yaxes(title_text="Standardized residual", row=1, col=1)
+    fig.update_xaxes(title_text="Fitted salary", row=1, col=2)
+    fig.update_yaxes(title_text="Residual", row=1, col=2)
+    fig.update_xaxes(title_text="Normal quantile", row=1, col=3)
+    fig.update_yaxes(title_text="Standardized random effect", row=1, col=3)
+    return fig
@@ -0,0 +1,24 @@
+import gc
+import os
+
+# Fit models and build figures once in the master, then fork. Workers inherit
+# the SharedStore pages from app.py instead of refitting on their own.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def when_ready(server):
+    if preload_app:
+        import app
+        app.init()
+        # Move everything allocated during preload into the permanent generation so
+        # the cyclic GC in each worker never writes to (and copies) those pages.
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    import app
+    app.init()  # no-op when the master already did it
+    # Threads don't survive fork, so each worker starts its own data watcher.
+    # A new store is built once (under a file lock) and every worker maps the
+    # cached file read-only, so hot-swapped stores stay shared too.
+    app.refresher.start()
@@ -0,0 +1,214 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from refresh import CACHE_DIR
+
+PREDICTORS = [
+    ("masters_gpa", "GPA"),
+    ("relevant_work_years", "Work Experience"),
+    ("years_python", "Python Years"),
+    ("years_sql", "SQL Years"),
+]
+
+RE_STRUCTURES = {
+    "intercept": ("Random intercept only", []),
+    "masters_gpa": ("Random intercept + GPA slope", ["masters_gpa"]),
+    "relevant_work_years": ("Random intercept + Work Experience slope", ["relevant_work_years"]),
+    "years_python": ("Random intercept + Python slope", ["years_python"]),
+    "years_sql": ("Random intercept + SQL slope", ["years_sql"]),
+    "full": ("Random intercept + all four slopes", [p for p, _ in PREDICTORS]),
+}
+
+DEFAULT_FIXED = [p for p, _ in PREDICTORS]
+DEFAULT_STRUCTURE = "full"
+
+
+def formulas(fixed, structure):
+    fixed = [p for p, _ in PREDICTORS if p in fixed]
+    formula = "first_job_salary ~ " + (" + ".join(fixed) if fixed else "1")
+    slopes = RE_STRUCTURES[structure][1]
+    re_formula = "~" + " + ".join(slopes) if slopes else None
+    return formula, re_formula
+
+
+def fit_structure(data, fixed, structure):
+    import statsmodels.formula.api as smf
+    from graphs import build_predicted_vs_actual_figure
+    from Models.fitting import fit_mixedlm
+    from Plots.rows import strip_rows
+    from shared_store import model_params
+
+    formula, re_formula = formulas(fixed, structure)
+    result = fit_mixedlm(smf.mixedlm(formula, data=data, groups=data["masters_university"], re_formula=re_formula),
+                         name=f"{formula} | {re_formula or '~1'}")
+    fig = build_predicted_vs_actual_figure(data, result)
+    fig.update_layout(title=f"Mixed Effect Model: {formula}  |  random: {re_formula or '~1'}")
+    return {
+        # The page has the rows already (Plots/rows.py)
+        "skeleton": json.dumps(strip_rows(json.loads(fig.to_json()))).encode(),
+        "params": model_params(result),
+        "llf": float(result.llf),
+        "converged": bool(result.converged),
+        "formula": formula,
+        "re_formula": re_formula or "~1",
+    }
+
+
+def entry_size(entry):
+    size = len(entry["skeleton"])
+    for value in entry["params"].values():
+        size += value.nbytes if isinstance(value, np.ndarray) else len(repr(value))
+    return size
+
+
+def mtime(path):
+    # Another worker may prune the file between the glob and the stat
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+
+def key_path(key, directory):
+    return os.path.join(directory, hashlib.sha256(json.dumps(key).encode()).hexdigest()[:24])
+
+
+class ModelCache:
+    # Bounded by entry count and by approximate bytes; least recently used
+    # entries go first. Misses are fitted on a small thread pool so Dash
+    # callbacks only ever look things up. With a directory, a key is fitted by
+    # one process only: the others wait on its lock file and load its result.
+
+    def __init__(self, max_entries=32, max_bytes=64 * 2**20, workers=2, directory=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        # False, and nothing stored, for an entry bigger than the whole cache
+        size = entry_size(entry)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= entry_size(self._entries.pop(key))
+            self._entries[key] = entry
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= entry_size(evicted)
+        return True
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                return job
+            if self._executor is None:
+                # Created lazily so each gunicorn worker owns its pool after fork.
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="model-fit")
+            job = {"state": "queued", "submitted": time.time(), "error": None}
+            self._jobs[key] = job
+        self._executor.submit(self._run, key, job, fn, args)
+        return job
+
+    def _run(self, key, job, fn, args):
+        job["state"] = "fitting"
+        job["started"] = time.time()
+        try:
+            entry = self._fit_once(key, job, fn, args)
+            if not self.put(key, entry):
+                raise ValueError(f"the fitted model takes {entry_size(entry) / 2**20:.1f} MB, more than the "
+                                 f"{self.max_bytes / 2**20:.0f} MB model cache (MODEL_CACHE_MB)")
+            job["state"] = "done"
+        except Exception as exc:
+            job["state"] = "error"
+            job["error"] = f"{type(exc).__name__}: {exc}"
+        finally:
+            with self._lock:
+                # Keep failed jobs around so the UI can show the error once;
+                # finished ones are served from the cache from now on.
+                if job["state"] == "done":
+                    self._jobs.pop(key, None)
+
+    def _fit_once(self, key, job, fn, args):
+        if self.directory is None:
+            return fn(*args)
+        os.makedirs(self.directory, exist_ok=True)
+        path = key_path(key, self.directory)
+        with open(path + ".lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                job["state"] = "waiting"  # on another worker's fit
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                job["state"] = "fitting"
+            try:
+                with open(path + ".pkl", "rb") as f:
+                    return pickle.load(f)
+            except FileNotFoundError:
+                pass
+            entry = fn(*args)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path + ".pkl")
+        self._prune()
+        return entry
+
+    def _prune(self):
+        files = sorted(glob.glob(os.path.join(self.directory, "*.pkl")), key=mtime, reverse=True)
+        for stale in files[self.max_entries:]:
+            lock_path = stale[:-len(".pkl")] + ".lock"
+            with open(lock_path, "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # being fitted or read right now
+                for path in (stale, lock_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def job(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def forget_job(self, key):
+        with self._lock:
+            self._jobs.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "pending": len(self._jobs)}
+
+
+model_cache = ModelCache(
+    max_entries=int(os.environ.get("MODEL_CACHE_ENTRIES", 32)),
+    max_bytes=int(float(os.environ.get("MODEL_CACHE_MB", 64)) * 2**20),
+    directory=os.path.join(CACHE_DIR, "models"),
+)
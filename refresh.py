@@ -0,0 +1,234 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from shared_store import STORE_FORMAT, SharedStore
+
+CACHE_DIR = os.environ.get("STORE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+KEEP_CACHED = 3
+# Data files at least this big are served from a moment-based preview store
+# while the exact REML fits run in the background (see load_store()).
+PROGRESSIVE_MIN_BYTES = int(float(os.environ.get("PROGRESSIVE_MIN_MB", 2)) * 2**20)
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(digest, cache_dir=CACHE_DIR, stage="exact"):
+    suffix = "-preview" if stage == "preview" else ""
+    return os.path.join(cache_dir, f"store-{digest[:16]}-f{STORE_FORMAT}{suffix}.store")
+
+
+def progress_path(digest, cache_dir=CACHE_DIR):
+    # One progress file per dataset; the preview and exact builds take turns.
+    return cache_path(digest, cache_dir) + ".progress"
+
+
+def write_json(path, obj):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def load_cached(digest, cache_dir=CACHE_DIR, stage="exact"):
+    # Mapped read-only, so every worker that loads it shares the page cache
+    # instead of holding its own copy
+    try:
+        return SharedStore.open(cache_path(digest, cache_dir, stage))
+    except FileNotFoundError:
+        return None
+
+
+def load_or_build(data_file, digest, cache_dir=CACHE_DIR, keep=KEEP_CACHED, label=None, stage="exact"):
+    # One process builds, the others (gunicorn workers polling the same file)
+    # block on the lock in their watcher thread and then load the result.
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(digest, cache_dir, stage)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            # A fresh interpreter keeps the fit off this process's GIL, so the
+            # old store keeps serving at full speed while we wait. It reports
+            # each step in the .progress file next to the cached store.
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), data_file, path, digest, label or data_file, stage],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True,
+            )
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else
+                                   f"rebuild exited with status {result.returncode}")
+            if stage == "exact":
+                try:
+                    os.remove(cache_path(digest, cache_dir, "preview"))
+                except FileNotFoundError:
+                    pass
+            prune_cache(cache_dir, keep)
+    return load_cached(digest, cache_dir, stage)
+
+
+def progressive(data_file):
+    return os.path.getsize(data_file) >= PROGRESSIVE_MIN_BYTES
+
+
+def load_store(data_file):
+    # Big files come back as a preview store when the exact one isn't cached
+    # yet; StoreRefresher then builds the exact store and swaps it in.
+    digest = file_digest(data_file)
+    if progressive(data_file):
+        return load_cached(digest) or load_or_build(data_file, digest, stage="preview")
+    return load_or_build(data_file, digest)
+
+
+def prune_cache(cache_dir=CACHE_DIR, keep=KEEP_CACHED):
+    files = sorted(glob.glob(os.path.join(cache_dir, "store-*.store")), key=os.path.getmtime, reverse=True)
+    for stale in files[keep:]:
+        for p in (stale, stale + ".lock", stale + ".progress"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+
+class StoreRefresher:
+    # Without a store it is "refreshing" until load() has built the first one
+    def __init__(self, data_file, store=None, interval=5.0, settle=1.0):
+        self.data_file = data_file
+        self.interval = interval
+        self.settle = settle
+        self._store = store
+        self._mtime = os.stat(data_file).st_mtime_ns
+        self._thread = None
+        self._stop = threading.Event()
+        self.state = "ready" if store is not None else "refreshing"
+        self.last_error = None
+        self.last_checked = None
+
+    def load(self):
+        try:
+            self._mtime = os.stat(self.data_file).st_mtime_ns
+            self._store = load_store(self.data_file)
+        except Exception as exc:
+            self.state = "error"
+            self.last_error = f"{type(exc).__name__}: {exc}"
+            raise
+        self.state = "ready"
+        self.last_error = None
+        return self._store
+
+    @property
+    def preview(self):
+        return self._store is not None and self._store.json("meta").get("stage") == "preview"
+
+    @property
+    def store(self):
+        # Readers grab the reference once per request; swapping it is a single
+        # attribute assignment, so a page never mixes two versions.
+        return self._store
+
+    def status(self):
+        if self._store is None:
+            return {"ready": False, "state": self.state, "last_error": self.last_error,
+                    "watching": self._thread is not None and self._thread.is_alive()}
+        meta = self._store.json("meta")
+        return {
+            "ready": True,
+            "state": self.state,
+            "version": meta["version"],
+            "stage": meta.get("stage", "exact"),
+            "rows": meta["rows"],
+            "built_at": meta["built_at"],
+            "last_checked": self.last_checked,
+            "last_error": self.last_error,
+            "watching": self._thread is not None and self._thread.is_alive(),
+        }
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="store-refresher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # A preview store starts its exact build straight away
+        delay = 0 if self.preview else self.interval
+        while not self._stop.wait(delay):
+            delay = self.interval
+            try:
+                self.check()
+            except Exception as exc:
+                # Reported by status(); keep watching
+                self.state = "error"
+                self.last_error = f"{type(exc).__name__}: {exc}"
+
+    def check(self):
+        self.last_checked = time.time()
+        if self._store is None:
+            return False
+        try:
+            mtime = os.stat(self.data_file).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime and not self.preview:
+            return False
+        if mtime != self._mtime:
+            # Don't pick up a file that is still being written.
+            time.sleep(self.settle)
+            if os.stat(self.data_file).st_mtime_ns != mtime:
+                return False
+
+        digest = file_digest(self.data_file)
+        self._mtime = mtime
+        same = digest == self._store.json("meta")["version"]
+        if same and not self.preview:
+            return False
+
+        # On failure _run() reports the error and the old store keeps serving
+        # until the file changes again. A changed big file gets a
+        # preview first, then the exact store on the next check.
+        self.state = "refining" if same else "refreshing"
+        stage = "preview" if not same and progressive(self.data_file) else "exact"
+        self._store = load_cached(digest) or load_or_build(self.data_file, digest, stage=stage)
+        self.state = "ready"
+        self.last_error = None
+        return True
+
+
+if __name__ == "__main__":
+    from shared_store import build_store
+
+    data_file, out_path, expected, label, stage = sys.argv[1:6]
+    progress_file = progress_path(expected, os.path.dirname(out_path))
+
+    def progress(done, total, step):
+        write_json(progress_file, {"state": "building", "stage": stage, "done": done, "total": total, "step": step,
+                                   "updated": time.time()})
+
+    store = build_store(data_file, progress=progress, label=label, stage=stage)
+    if store.json("meta")["version"] != expected:
+        sys.exit(f"{data_file} changed during rebuild")
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    store.save(tmp_path)
+    os.replace(tmp_path, out_path)
+    # After a preview the exact build takes the progress file over
+    if stage == "exact":
+        try:
+            os.remove(progress_file)
+        except FileNotFoundError:
+            pass
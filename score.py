@@ -0,0 +1,189 @@
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from Models.compress import ENDOG, GROUP, compress, fit_ols
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Data", "masters_salary.csv")
+PREDICTORS = ["masters_gpa", "relevant_work_years", "years_python", "years_sql"]
+PREDICTION = "predicted_salary"
+RESIDUAL = "residual"
+
+# Scores graduate files of any size with a model fitted on the app's data:
+#
+#   python score.py graduates.csv scored.csv
+#   python score.py graduates.parquet scored.parquet --model ols --residuals --workers 8
+#
+# The input is read in chunks, each chunk is scored in a worker process with
+# a couple of matrix products against the coefficients, and the chunks are
+# written back in input order, so memory depends on --chunk-size and
+# --workers but not on the file. Coefficients come from the cached store of
+# --data (the one the app serves by default), built first if needed.
+
+
+def coefficients(store, model="mixed"):
+    # model="mixed" is model_full: fixed effects plus each university's BLUP.
+    # model="ols" is the pooled regression behind graphs_full.
+    if model == "ols":
+        records, _ = compress(store.frame("salary_data"), PREDICTORS)
+        beta = fit_ols(records, PREDICTORS)["params"]
+        return {"model": model, "names": list(beta.index), "beta": beta.to_numpy(), "groups": [],
+                "effects": np.zeros((0, len(beta)))}
+    params = store.params("model_full")
+    names = params["fe_names"]
+    # The random intercept is called "Group"; line the effects up with X
+    columns = [names.index("Intercept" if re == "Group" else re) for re in params["re_names"]]
+    effects = np.zeros((len(params["groups"]), len(names)))
+    effects[:, columns] = params["random_effects"]
+    return {"model": model, "names": names, "beta": np.asarray(params["fe_params"]), "groups": params["groups"],
+            "effects": effects}
+
+
+_coefs = None
+
+
+def _init(coefs):
+    global _coefs
+    _coefs = coefs
+
+
+def score_chunk(chunk, coefs=None, residuals=False):
+    coefs = coefs or _coefs
+    X = np.column_stack([np.ones(len(chunk))] +
+                        [chunk[name].to_numpy(dtype=float) for name in coefs["names"][1:]])
+    prediction = X @ coefs["beta"]
+    unknown = 0
+    if len(coefs["groups"]):
+        # Universities the model never saw get code -1, which picks the zero
+        # row appended below: the population-level prediction
+        codes = pd.Index(coefs["groups"]).get_indexer(chunk[GROUP].to_numpy())
+        effects = np.vstack([coefs["effects"], np.zeros(len(coefs["beta"]))])
+        prediction += np.einsum("ij,ij->i", X, effects[codes])
+        unknown = int((codes == -1).sum())
+    chunk = chunk.assign(**{PREDICTION: prediction})
+    if residuals:
+        chunk[RESIDUAL] = chunk[ENDOG].to_numpy(dtype=float) - prediction
+    return chunk, unknown
+
+
+def read_chunks(path, chunk_size, columns=None):
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("reading Parquet needs pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, usecols=columns)
+
+
+class ChunkWriter:
+    def __init__(self, path):
+        self.path = path
+        self._parquet = path.endswith(".parquet")
+        self._writer = None
+        self._file = None
+
+    def write(self, chunk):
+        if self._parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            header = self._file is None
+            if header:
+                self._file = open(self.path, "w", newline="")
+            chunk.to_csv(self._file, header=header, index=False)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def score_file(source, target, coefs, chunk_size=100_000, workers=None, residuals=False, columns=None,
+               progress=None):
+    workers = workers or os.cpu_count() or 1
+    required = [GROUP, *PREDICTORS] + ([ENDOG] if residuals else [])
+    usecols = None if columns is None else list(dict.fromkeys([*columns, *required]))
+    keep = None if columns is None else [*columns, PREDICTION] + ([RESIDUAL] if residuals else [])
+    rows = unknown = 0
+    writer = ChunkWriter(target)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(coefs,)) as pool:
+            # Futures in input order; the oldest is written as soon as the
+            # queue is full, so at most two chunks per worker are held.
+            pending = deque()
+
+            def flush_oldest():
+                nonlocal rows, unknown
+                chunk, missing = pending.popleft().result()
+                writer.write(chunk if keep is None else chunk[keep])
+                rows += len(chunk)
+                unknown += missing
+                if progress is not None:
+                    progress(rows)
+
+            for i, chunk in enumerate(read_chunks(source, chunk_size, usecols)):
+                if i == 0:
+                    absent = [c for c in required if c not in chunk]
+                    if absent:
+                        raise SystemExit(f"{source} has no column {', '.join(absent)}")
+                pending.append(pool.submit(score_chunk, chunk, None, residuals))
+                if len(pending) >= 2 * workers:
+                    flush_oldest()
+            while pending:
+                flush_oldest()
+    finally:
+        writer.close()
+    return {"rows": rows, "unknown_university": unknown}
+
+
+def load_coefficients(data_file, model):
+    from refresh import file_digest, load_or_build
+
+    # Always the exact store: a moment-based preview is fine for a first
+    # look at the figures, not for predictions that leave the app
+    store = load_or_build(data_file, file_digest(data_file))
+    return coefficients(store, model), store.json("meta")["version"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score a graduate file (CSV or Parquet) with a fitted model.")
+    parser.add_argument("source")
+    parser.add_argument("target", help="where to write the scored rows; .parquet for Parquet, CSV otherwise")
+    parser.add_argument("--model", choices=["mixed", "ols"], default="mixed",
+                        help="mixed: model_full with university effects; ols: the pooled regression")
+    parser.add_argument("--data", default=DATA_FILE, help="dataset the model is fitted on (default: the app's)")
+    parser.add_argument("--residuals", action="store_true", help=f"also write {ENDOG} minus the prediction")
+    parser.add_argument("--columns", nargs="+", help="input columns to carry over (default: all)")
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, help="scoring processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    coefs, version = load_coefficients(args.data, args.model)
+    start = time.perf_counter()
+
+    def progress(rows):
+        print(f"\rscored {rows:,} rows", end="", file=sys.stderr, flush=True)
+
+    result = score_file(args.source, args.target, coefs, args.chunk_size, args.workers, args.residuals,
+                        args.columns, progress)
+    seconds = time.perf_counter() - start
+    print(f"\rscored {result['rows']:,} rows with the {args.model} model of store {version[:12]} "
+          f"in {seconds:.1f}s ({result['rows'] / max(seconds, 1e-9):,.0f} rows/s)", file=sys.stderr)
+    if result["unknown_university"]:
+        print(f"{result['unknown_university']:,} rows from universities the model has no effect for "
+              f"got the population-level prediction", file=sys.stderr)
@@ -0,0 +1,285 @@
+import hashlib
+import io
+import json
+import mmap
+import time
+
+import numpy as np
+
+# Bump whenever build_store() adds or changes entries, so stores cached on
+# disk by an older build are rebuilt instead of served without them.
+STORE_FORMAT = 8
+
+
+class SharedStore:
+    # Everything a worker serves lives in one shared mapping that is written
+    # once and only read after that, so the pages stay shared no matter how
+    # often Python touches the wrappers. A store built in the gunicorn master
+    # (--preload) is shared by fork; one loaded from the cache with open() maps
+    # the file read-only, so every worker that loads it shares the page cache.
+
+    def __init__(self):
+        self._pending = {}
+        self._index = {}
+        self._buf = None
+
+    def add_array(self, name, arr):
+        arr = np.ascontiguousarray(arr)
+        if arr.dtype == object:
+            raise TypeError(f"{name}: object arrays can't be placed in shared memory")
+        self._pending[name] = ("array", arr)
+
+    def add_bytes(self, name, data):
+        self._pending[name] = ("bytes", bytes(data))
+
+    def add_json(self, name, obj):
+        self.add_bytes(name, json.dumps(obj).encode())
+
+    def add_figure(self, name, fig, rows=False):
+        # rows=True also keeps the figure without its row arrays, for pages
+        # that get the rows separately (Plots/rows.py)
+        data = fig.to_json()
+        self.add_bytes(f"figure/{name}", data.encode())
+        if rows:
+            from Plots.rows import strip_rows
+
+            self.add_json(f"skeleton/{name}", strip_rows(json.loads(data)))
+
+    def add_frame(self, name, df):
+        import pandas as pd
+
+        columns = []
+        for col in df.columns:
+            values = df[col]
+            if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(values):
+                codes, categories = pd.factorize(values)
+                self.add_array(f"frame/{name}/{col}", codes.astype(np.int32))
+                columns.append({"name": col, "categories": [str(c) for c in categories]})
+            else:
+                self.add_array(f"frame/{name}/{col}", values.to_numpy())
+                columns.append({"name": col, "categories": None})
+        self.add_json(f"frame/{name}", columns)
+
+    def add_params(self, name, result):
+        for key, value in model_params(result).items():
+            if isinstance(value, np.ndarray):
+                self.add_array(f"params/{name}/{key}", value)
+            else:
+                self.add_json(f"params/{name}/{key}", value)
+
+    def seal(self):
+        offsets = {}
+        size = 0
+        for name, (kind, value) in self._pending.items():
+            nbytes = value.nbytes if kind == "array" else len(value)
+            size = (size + 63) & ~63
+            offsets[name] = size
+            size += nbytes
+
+        # mmap(-1, ...) is MAP_SHARED | MAP_ANONYMOUS: forked workers map the
+        # same physical pages instead of copying them.
+        self._buf = mmap.mmap(-1, max(size, 1))
+        for name, (kind, value) in self._pending.items():
+            start = offsets[name]
+            if kind == "array":
+                raw = value.tobytes()
+                self._index[name] = (kind, start, len(raw), value.dtype.str, value.shape)
+            else:
+                raw = value
+                self._index[name] = (kind, start, len(raw), None, None)
+            self._buf[start:start + len(raw)] = raw
+        self._pending = {}
+        return self
+
+    def save(self, path):
+        # An 8-byte header length, the index as JSON, then the sealed buffer
+        # from the next 64-byte boundary
+        if self._buf is None:
+            self.seal()
+        header = json.dumps(self._index).encode()
+        start = (8 + len(header) + 63) & ~63
+        with open(path, "wb") as f:
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            f.write(b"\0" * (start - 8 - len(header)))
+            f.write(self._buf)
+
+    @classmethod
+    def open(cls, path):
+        store = cls()
+        with open(path, "rb") as f:
+            store._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = int.from_bytes(store._buf[:8], "little")
+        start = (8 + size + 63) & ~63
+        for name, (kind, offset, nbytes, dtype, shape) in json.loads(store._buf[8:8 + size]).items():
+            store._index[name] = (kind, start + offset, nbytes, dtype, tuple(shape) if shape is not None else None)
+        return store
+
+    @property
+    def nbytes(self):
+        return 0 if self._buf is None else len(self._buf)
+
+    def names(self):
+        return list(self._index)
+
+    def array(self, name):
+        kind, start, nbytes, dtype, shape = self._index[name]
+        dtype = np.dtype(dtype)
+        arr = np.frombuffer(self._buf, dtype=dtype, count=nbytes // dtype.itemsize, offset=start).reshape(shape)
+        arr.flags.writeable = False
+        return arr
+
+    def bytes(self, name):
+        if name in self._pending:
+            return memoryview(self._pending[name][1]).toreadonly()
+        kind, start, nbytes, _, _ = self._index[name]
+        return memoryview(self._buf)[start:start + nbytes].toreadonly()
+
+    def json(self, name):
+        return json.loads(self.bytes(name).tobytes())
+
+    def figure(self, name):
+        # Parsed per call on purpose: the dict is request-scoped garbage, the
+        # serialized bytes are the only copy a worker keeps.
+        return json.loads(self.bytes(f"figure/{name}").tobytes())
+
+    def skeleton(self, name):
+        return self.json(f"skeleton/{name}")
+
+    def frame(self, name):
+        import pandas as pd
+
+        data = {}
+        for col in self.json(f"frame/{name}"):
+            values = self.array(f"frame/{name}/{col['name']}")
+            if col["categories"] is not None:
+                values = np.asarray(col["categories"], dtype=object)[values]
+            data[col["name"]] = values
+        return pd.DataFrame(data, copy=False)
+
+    def params(self, name):
+        prefix = f"params/{name}/"
+        out = {}
+        for key, (kind, *_rest) in self._index.items():
+            if key.startswith(prefix):
+                field = key[len(prefix):]
+                out[field] = self.array(key) if kind == "array" else self.json(key)
+        return out
+
+
+def model_params(result):
+    random_effects = result.random_effects
+    groups = list(random_effects)
+    return {
+        "fe_names": list(result.fe_params.index),
+        "fe_params": result.fe_params.to_numpy(dtype=float),
+        "re_names": list(result.cov_re.columns),
+        "cov_re": result.cov_re.to_numpy(dtype=float),
+        "scale": np.array([result.scale], dtype=float),
+        "groups": [str(g) for g in groups],
+        "random_effects": np.vstack([random_effects[g].to_numpy(dtype=float) for g in groups]),
+    }
+
+
+def coefficient_bundle(records, model_full, columns):
+    # Everything the what-if calculator (assets/calculator.js) evaluates in
+    # the browser: the OLS with university indicators that the equation in
+    # app.py shows, and model_full's fixed effects and per-university BLUPs.
+    from Models.compress import GROUP, fit_ols
+
+    universities = sorted(records[GROUP].unique())
+    indicators = {uni: (records[GROUP] == uni).astype(float) for uni in universities[1:]}
+    ols = fit_ols(records.assign(**indicators), [*columns, *indicators])["params"]
+    params = model_params(model_full)
+    return {
+        "ols": {"names": ["Intercept", *columns], "params": ols[["Intercept", *columns]].round(4).tolist(),
+                "universities": {uni: round(float(ols.get(uni, 0.0)), 4) for uni in universities}},
+        "mixed": {"names": params["fe_names"], "params": params["fe_params"].round(4).tolist(),
+                  "re_names": ["Intercept" if n == "Group" else n for n in params["re_names"]],
+                  "blups": {g: row.round(4).tolist() for g, row in zip(params["groups"], params["random_effects"])}},
+    }
+
+
+def build_store(data_file, seal=True, progress=None, label=None, stage="exact"):
+    # stage="preview" swaps every REML fit for the one-pass moment estimates
+    # in Models/moments.py, so the figures exist within seconds on data where
+    # the exact fits take minutes; the app replaces it when "exact" is ready.
+    import pandas as pd
+
+    from Models.compress import ENDOG, GROUP, compress
+    from Models.influence import model_influence
+    from graphs import (SLOPE_PREDICTORS, build_diagnostics_figure, build_mixed_effects_figure,
+                        build_predicted_vs_actual_figure, fit_full_model, fit_slope_model)
+    from Plots.graphs_full import graphs_full
+    from Plots.graphs_slr import graph_slr
+    from Plots.rows import encode_rows
+
+    total = len(SLOPE_PREDICTORS) + (8 if stage == "exact" else 7)
+    done = 0
+
+    def step(name, fn, *args):
+        nonlocal done
+        if progress is not None:
+            progress(done, total, name)
+        result = fn(*args)
+        done += 1
+        return result
+
+    # Read the file once so the version hash always matches what was fitted,
+    # even if the file is replaced while we work.
+    with open(data_file, "rb") as f:
+        raw = f.read()
+    # Uploads may carry columns of their own; keep the ones the models use
+    salary_data = pd.read_csv(io.BytesIO(raw))[[GROUP, *SLOPE_PREDICTORS, ENDOG]]
+    # One record per (university, predictors) pattern; each exact fit that
+    # is worth it collapses these further instead of the rows again
+    records = step("Compressing duplicate rows", compress, salary_data, SLOPE_PREDICTORS)
+    models = {
+        f"model{i}": step(f"Fitting the {x_var} model", fit_slope_model, salary_data, x_var, f"model{i}", stage,
+                          records)
+        for i, x_var in enumerate(SLOPE_PREDICTORS, start=1)
+    }
+    model_full = step("Fitting the full model", fit_full_model, salary_data, stage, records)
+    # Leave-one-university-out refits, from the records with each university's
+    # cross-products subtracted (Models/influence.py); not worth it for a preview
+    influence = None
+    if stage == "exact":
+        influence = step("Dropping one university at a time", model_influence, records[0],
+                         {**models, "model_full": model_full}, SLOPE_PREDICTORS)
+
+    store = SharedStore()
+    store.add_json("meta", {
+        "version": hashlib.sha256(raw).hexdigest(),
+        "format": STORE_FORMAT,
+        "data_file": str(data_file),
+        "label": label or str(data_file),
+        "stage": stage,
+        "rows": len(salary_data),
+        "patterns": len(records[0]),
+        "built_at": time.time(),
+    })
+    store.add_frame("salary_data", salary_data)
+    # The columns every row-plotting figure draws from, encoded once for the page
+    store.add_json("rows", encode_rows(salary_data, [*SLOPE_PREDICTORS, ENDOG]))
+    fits = []
+    for name, result in [*models.items(), ("model_full", model_full)]:
+        store.add_params(name, result)
+        fits.extend(result.fit_history)
+    # Telemetry travels with the store because the fits may have run in the
+    # gunicorn master or in a refresh subprocess.
+    store.add_json("fits", fits)
+    store.add_json("coefficients", coefficient_bundle(records[0], model_full, SLOPE_PREDICTORS))
+    store.add_json("influence", influence)
+
+    store.add_figure("slr", step("Drawing the regression plots", graph_slr, io.BytesIO(raw)), rows=True)
+    # Points carry only their row id; the page looks hover details up in "rows"
+    store.add_figure("mlr", step("Drawing the multiple regression plots", graphs_full, io.BytesIO(raw), "ids"),
+                     rows=True)
+    store.add_figure("me", step("Drawing the random slopes", build_mixed_effects_figure, salary_data, models))
+    store.add_figure("me_pred", step("Drawing predicted vs actual", build_predicted_vs_actual_figure,
+                                     salary_data, model_full), rows=True)
+    store.add_figure("diagnostics", step("Drawing the diagnostics", build_diagnostics_figure,
+                                         salary_data, {**models, "model_full": model_full}))
+    if progress is not None:
+        progress(done, total, "Saving")
+    return store.seal() if seal else store
@@ -0,0 +1,74 @@
+import argparse
+import os
+import time
+
+from refresh import CACHE_DIR, file_digest, load_or_build
+
+# Static images of the page's figures, so the first paint doesn't wait for
+# Plotly. The app shows a figure's image in place of the graph and asks for
+# the interactive figure only when its section scrolls into view or the
+# reader reaches for it (assets/thumbnails.js); until then the layout carries
+# no figure JSON at all. Rendering needs kaleido, so it happens here, offline:
+#
+#   python thumbnails.py
+#
+# Images are kept per dataset version next to the store cache; a store
+# without them is served with its interactive figures straight away.
+
+# Graph id in app.py -> figure in the store
+FIGURES = {
+    "slr-graph": "slr",
+    "mlr-graph": "mlr",
+    "me-graph": "me",
+    "me-pred-graph": "me_pred",
+    "diagnostics-graph": "diagnostics",
+}
+WIDTH = 1000
+HEIGHT = 450  # dcc.Graph's default, used when a figure doesn't set one
+
+
+def thumbnail_dir(version, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"thumbnails-{version[:16]}")
+
+
+def thumbnail_file(version, name, cache_dir=CACHE_DIR):
+    # Only images of the exact fits exist, so a preview store of the same
+    # version must not ask for them (see app.lazy_graph)
+    path = os.path.join(thumbnail_dir(version, cache_dir), f"{name}.webp")
+    return path if os.path.exists(path) else None
+
+
+def render_thumbnails(store, width=WIDTH, cache_dir=CACHE_DIR, progress=None):
+    try:
+        import kaleido  # noqa: F401
+    except ImportError:
+        raise SystemExit("rendering thumbnails needs kaleido (pip install kaleido)")
+    import plotly.io as pio
+
+    out_dir = thumbnail_dir(store.json("meta")["version"], cache_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    sizes = {}
+    for name in FIGURES.values():
+        fig = pio.from_json(store.bytes(f"figure/{name}").decode())
+        # WebP is a fraction of the PNG's size for plots like these
+        image = fig.to_image(format="webp", width=width, height=fig.layout.height or HEIGHT)
+        path = os.path.join(out_dir, f"{name}.webp")
+        with open(path + ".tmp", "wb") as f:
+            f.write(image)
+        os.replace(path + ".tmp", path)
+        sizes[name] = len(image)
+        if progress is not None:
+            progress(name, len(image))
+    return sizes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the page's figures to static images for a fast first paint.")
+    parser.add_argument("--data", default="Data/masters_salary.csv")
+    parser.add_argument("--width", type=int, default=WIDTH, help="image width in pixels")
+    args = parser.parse_args()
+
+    store = load_or_build(args.data, file_digest(args.data))
+    t0 = time.perf_counter()
+    render_thumbnails(store, args.width, progress=lambda name, size: print(f"{name:<12} {size / 1024:8.1f} KiB"))
+    print(f"rendered into {thumbnail_dir(store.json('meta')['version'])}/ in {time.perf_counter() - t0:.1f}s")
@@ -0,0 +1,205 @@
+import base64
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from model_cache import PREDICTORS
+from refresh import CACHE_DIR, cache_path, load_cached, load_or_build, progress_path, progressive, write_json
+
+UPLOAD_DIR = os.environ.get("UPLOAD_CACHE_DIR", os.path.join(CACHE_DIR, "uploads"))
+COLUMNS = ["masters_university", *[p for p, _ in PREDICTORS], "first_job_salary"]
+MAX_BYTES = int(float(os.environ.get("UPLOAD_MAX_MB", 20)) * 2**20)
+MAX_ROWS = int(os.environ.get("UPLOAD_MAX_ROWS", 200_000))
+MAX_GROUPS = int(os.environ.get("UPLOAD_MAX_GROUPS", 20))
+MIN_ROWS = 30
+# Builds running at once across every gunicorn worker (one fcntl lock each).
+WORKERS = int(os.environ.get("UPLOAD_WORKERS", 2))
+# Uploads accepted by this process that haven't finished yet.
+MAX_PENDING = int(os.environ.get("UPLOAD_MAX_PENDING", 8))
+KEEP_UPLOADS = int(os.environ.get("UPLOAD_KEEP", 20))
+# A queued or building upload whose progress file hasn't been touched for this
+# long belonged to a process that died.
+STALE_SECONDS = 600
+
+DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+class UploadError(ValueError):
+    pass
+
+
+def decode(contents):
+    # dcc.Upload hands over a data URL: "data:<type>;base64,<payload>"
+    try:
+        return base64.b64decode(contents.split(",", 1)[1], validate=True)
+    except (IndexError, ValueError):
+        raise UploadError("The upload could not be decoded.")
+
+
+def validate(raw):
+    import pandas as pd
+
+    if len(raw) > MAX_BYTES:
+        raise UploadError(f"The file is {len(raw) / 2**20:.1f} MB; the limit is {MAX_BYTES / 2**20:.0f} MB.")
+    try:
+        df = pd.read_csv(io.BytesIO(raw))
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise UploadError(f"Could not read the file as CSV: {exc}")
+
+    missing = [c for c in COLUMNS if c not in df.columns]
+    if missing:
+        raise UploadError(f"Missing columns: {', '.join(missing)}.")
+    for col in COLUMNS:
+        empty = int(df[col].isna().sum())
+        if empty:
+            raise UploadError(f"Column {col} has {empty} empty values.")
+    for col in COLUMNS[1:]:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            bad = pd.to_numeric(df[col], errors="coerce").isna().idxmax()
+            raise UploadError(f"Column {col} must be numeric (line {bad + 2}: {df[col][bad]!r}).")
+
+    groups = df["masters_university"].nunique()
+    if not MIN_ROWS <= len(df) <= MAX_ROWS:
+        raise UploadError(f"The file has {len(df):,} rows; between {MIN_ROWS} and {MAX_ROWS:,} are supported.")
+    if not 2 <= groups <= MAX_GROUPS:
+        raise UploadError(f"The file has {groups} universities; between 2 and {MAX_GROUPS} are supported.")
+    return {"rows": len(df), "groups": groups}
+
+
+def upload_path(digest):
+    return os.path.join(UPLOAD_DIR, f"data-{digest[:16]}.csv")
+
+
+def status(digest):
+    # Read from disk rather than from this process's jobs, so whichever
+    # worker the browser's next poll lands on can answer it.
+    if os.path.exists(cache_path(digest, UPLOAD_DIR)):
+        return {"state": "done"}
+    try:
+        with open(progress_path(digest, UPLOAD_DIR)) as f:
+            # The open file's age: the exact build may remove it meanwhile
+            age = time.time() - os.fstat(f.fileno()).st_mtime
+            progress = json.load(f)
+    except FileNotFoundError:
+        # Removed by a build that finished since the check above
+        if os.path.exists(cache_path(digest, UPLOAD_DIR)):
+            return {"state": "done"}
+        progress, age = {"state": "unknown"}, 0
+    except ValueError:
+        progress, age = {"state": "unknown"}, 0
+    if progress["state"] in ("queued", "building") and age > STALE_SECONDS:
+        return {"state": "error", "error": "The analysis was interrupted. Upload the file again."}
+    # The preview dashboard can be opened while the exact fits still run
+    if os.path.exists(cache_path(digest, UPLOAD_DIR, "preview")) and progress["state"] != "error":
+        if progress.get("stage") == "exact":
+            return dict(progress, state="preview")
+        return {"state": "preview", "done": 0, "total": 1, "step": "Waiting for the exact fit"}
+    return progress
+
+
+class UploadQueue:
+    # Validated uploads are written to UPLOAD_DIR under their content hash
+    # and built by refresh.load_or_build (a subprocess per build) on a small
+    # thread pool, so page requests never wait on a fit. A hash that was
+    # built before is served straight from the on-disk cache.
+
+    def __init__(self, max_pending=MAX_PENDING, max_loaded=4):
+        self.max_pending = max_pending
+        self.max_loaded = max_loaded
+        self._pending = set()
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, raw, filename):
+        summary = validate(raw)
+        digest = hashlib.sha256(raw).hexdigest()
+        if status(digest)["state"] in ("done", "preview", "queued", "building"):
+            return digest, summary
+        with self._lock:
+            if digest in self._pending:
+                return digest, summary
+            if len(self._pending) >= self.max_pending:
+                raise UploadError("Too many uploads are being analysed right now. Try again in a minute.")
+            self._pending.add(digest)
+            if self._executor is None:
+                # Created lazily so each gunicorn worker owns its pool after fork.
+                self._executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="upload")
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        with open(upload_path(digest) + ".tmp", "wb") as f:
+            f.write(raw)
+        os.replace(upload_path(digest) + ".tmp", upload_path(digest))
+        write_json(progress_path(digest, UPLOAD_DIR), {"state": "queued", "done": 0, "total": 1,
+                                                       "step": "Waiting for a free worker", "updated": time.time()})
+        self._executor.submit(self._run, digest, filename)
+        return digest, summary
+
+    def _run(self, digest, filename):
+        try:
+            with build_slot(digest):
+                if progressive(upload_path(digest)):
+                    self._remember(digest, load_or_build(upload_path(digest), digest, UPLOAD_DIR, KEEP_UPLOADS,
+                                                         label=filename, stage="preview"))
+                store = load_or_build(upload_path(digest), digest, UPLOAD_DIR, KEEP_UPLOADS, label=filename)
+            self._remember(digest, store)
+        except Exception as exc:
+            write_json(progress_path(digest, UPLOAD_DIR), {"state": "error", "error": str(exc), "updated": time.time()})
+        finally:
+            try:
+                os.remove(upload_path(digest))
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self._pending.discard(digest)
+
+    def store(self, digest):
+        if not DIGEST.fullmatch(digest or ""):
+            return None
+        with self._lock:
+            store = self._loaded.get(digest)
+            if store is not None:
+                self._loaded.move_to_end(digest)
+        # A preview is only kept until the exact store shows up on disk,
+        # possibly built by another worker.
+        if store is not None and store.json("meta").get("stage") != "preview":
+            return store
+        store = load_cached(digest, UPLOAD_DIR) or store or load_cached(digest, UPLOAD_DIR, "preview")
+        if store is not None:
+            self._remember(digest, store)
+        return store
+
+    def _remember(self, digest, store):
+        with self._lock:
+            self._loaded[digest] = store
+            self._loaded.move_to_end(digest)
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+
+
+@contextlib.contextmanager
+def build_slot(digest):
+    # Holds one of WORKERS lock files for the duration of a build. The locks
+    # are shared by every process using UPLOAD_DIR, so the bound is global.
+    while True:
+        for i in range(WORKERS):
+            with open(os.path.join(UPLOAD_DIR, f"slot-{i}.lock"), "w") as slot:
+                try:
+                    fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                yield
+                return
+        # Keep the progress file fresh so status() doesn't call us stale.
+        os.utime(progress_path(digest, UPLOAD_DIR))
+        time.sleep(0.5)
+
+
+upload_queue = UploadQueue()